@@ -3,20 +3,56 @@
 
 import sys
 import os.path
+import re
+import mmap
 import json
+import sqlite3
 import cjson
+import msgpack
 import base64
-from collections import defaultdict, namedtuple, Counter
-from itertools import islice
-from random import sample, random
+import hashlib
+import argparse
+import threading
+import resource
+import cProfile
+import pstats
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from array import array
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from collections import defaultdict, namedtuple, Counter, deque
+from itertools import islice, chain, imap
+from contextlib import contextmanager
+from random import Random, random
+from math import ceil, exp, log, sqrt
+import heapq
+import types
+from bisect import bisect_right
+from time import time, sleep, strftime, localtime
+
+try:
+    # Several times faster than json on vacancies, optional
+    import ujson as fast_json
+except ImportError:
+    fast_json = json
 
 import requests
 requests.packages.urllib3.disable_warnings()
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
+import matplotlib
+if 'MPLBACKEND' not in os.environ and 'IPython' not in sys.modules:
+    # Figures only go to files, interactive backends just add import
+    # time. Notebooks keep theirs for inline figures
+    matplotlib.use('Agg')
 import seaborn as sns
 from matplotlib import pyplot as plt
 from matplotlib import rc
+from matplotlib import cbook
 # For cyrillic labels
 rc('font', family='Verdana', weight='normal')
 
@@ -25,13 +61,29 @@ DATA_DIR = 'data'
 RAW_RESUMES = os.path.join(DATA_DIR, 'resumes.repr')
 TOTAL_RESUMES = 5985469
 RESUMES = os.path.join(DATA_DIR, 'resumes.json')
+RESUME_COLUMNS = os.path.join(DATA_DIR, 'resume_columns')
+PARTITIONS = os.path.join(DATA_DIR, 'partitions')
+STRINGS = os.path.join(DATA_DIR, 'strings.json')
+STRINGS_VERSION = 1
+PARTITIONS_VERSION = 3
 AREAS = os.path.join(DATA_DIR, 'areas.json')
+RUSSIA_AREA_ID = 113
 SCHOOLS = os.path.join(DATA_DIR, 'schools.json')
 UNIVERSITIES_DIR = os.path.join(DATA_DIR, 'universities')
+UNIVERSITIES_DB = os.path.join(DATA_DIR, 'universities.db')
 UNIVERSITIES = os.path.join(DATA_DIR, 'universities.xlsx')
+UNIVERSITY_NAMES = os.path.join(DATA_DIR, 'university_names.json')
+UNIVERSITY_NAMES_VERSION = 1
+UNIVERSITY_SUGGEST_URL = 'https://api.hh.ru/suggests/educational_institutions'
 VACANCIES = os.path.join(DATA_DIR, 'vacancies.json')
 TOTAL_VACANCIES = 302374
+VACANCY_COLUMNS = os.path.join(DATA_DIR, 'vacancy_columns')
+SPECIALIZATIONS = os.path.join(DATA_DIR, 'specializations.json')
+SPECIALIZATIONS_VERSION = 1
 SCHOOL_SPECIALIZATIONS = os.path.join(DATA_DIR, 'school_specializations.json')
+FIGURES = os.path.join(DATA_DIR, 'figures')
+FIGURES_VERSION = 1
+PROFILES = os.path.join(DATA_DIR, 'profiles')
 
 
 Resume = namedtuple(
@@ -41,14 +93,370 @@ Resume = namedtuple(
      'area_id', 'languages',
      'specializations', 'educations']
 )
+ResumeColumns = namedtuple(
+    'ResumeColumns',
+    ['age', 'gender',
+     'salary', 'currency',
+     'area_id',
+     'language_offsets', 'language_ids', 'language_scores',
+     'specialization_offsets', 'specializations',
+     'education_offsets', 'educations',
+     'currencies', 'education_names']
+)
 Area = namedtuple('Area', ['id', 'parent_id', 'level', 'name'])
 Salary = namedtuple('Salary', ['min', 'max', 'currency'])
 Profarea = namedtuple('Profarea', ['id', 'name'])
 Specialization = namedtuple('Specialization', ['group', 'id', 'name'])
 Vacancy= namedtuple('Vacancy', ['area_id', 'salary', 'specializations'])
+VacancyColumns = namedtuple(
+    'VacancyColumns',
+    ['area_id',
+     'salary', 'salary_min', 'salary_max', 'currency',
+     'specialization_offsets', 'specializations', 'profareas',
+     'currencies', 'profarea_names']
+)
+ProfareaIndex = namedtuple('ProfareaIndex', ['profareas', 'names'])
+Accumulator = namedtuple('Accumulator', ['init', 'update', 'merge', 'finalize'])
 
 
-def iterate_chunks(path, chunksize=8192):
+PROFILE_PHASES = ['decode', 'aggregate', 'plot']
+
+
+def get_peak_rss():
+    # Peak of the whole process so far. Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_rss():
+    # Current resident size, None where /proc is missing
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except IOError:
+        return None
+    return pages * resource.getpagesize()
+
+
+class StageStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.records = 0
+        self.bytes = 0
+        self.seconds = Counter()
+        self.start = None
+        self.stop = None
+        # Current RSS and process peak RSS when the stage last finished,
+        # the peak may come from any earlier stage. Stats merged from
+        # pool workers keep the largest of any process
+        self.rss = None
+        self.process_peak_rss = 0
+
+    def merge(self, other):
+        # Seconds of workers add up, so rates are per process
+        self.calls += other.calls
+        self.records += other.records
+        self.bytes += other.bytes
+        self.seconds.update(other.seconds)
+        if self.start is None or other.start < self.start:
+            self.start = other.start
+        self.stop = max(self.stop, other.stop)
+        self.rss = max(self.rss, other.rss)
+        self.process_peak_rss = max(
+            self.process_peak_rss,
+            other.process_peak_rss
+        )
+
+    def get_report(self):
+        seconds = sum(self.seconds.itervalues())
+        rate = speed = None
+        if seconds:
+            rate = self.records / seconds
+            speed = self.bytes / seconds
+        return {
+            'calls': self.calls,
+            'records': self.records,
+            'bytes': self.bytes,
+            'seconds': dict(self.seconds),
+            'records_per_second': rate,
+            'bytes_per_second': speed,
+            'start': self.start,
+            'stop': self.stop,
+            'rss': self.rss,
+            'process_peak_rss': self.process_peak_rss,
+        }
+
+
+class Profiler(object):
+    # Time of a stage excludes time of stages nested in it: resumes
+    # decoded inside show_* aggregation count as load_resumes decode.
+    # Only the thread that runs the pipeline is measured
+    def __init__(self, sinks=(), stages=(), dir=PROFILES):
+        self.sinks = list(sinks)
+        self.dir = dir
+        self.stats = defaultdict(StageStats)
+        self.stack = []
+        self.profiles = {stage: cProfile.Profile() for stage in stages}
+        self.worker_profiles = defaultdict(list)
+        self.profiled = None
+        self.start = time()
+        self.pid = os.getpid()
+
+    def enter(self, stage, phase):
+        stats = self.stats[stage]
+        if stats.start is None:
+            stats.start = time()
+        stats.calls += 1
+        if self.profiled is None and stage in self.profiles:
+            # cProfile can't nest, the outermost profiled stage wins
+            self.profiled = len(self.stack)
+            self.profiles[stage].enable()
+        self.stack.append([stage, phase, time(), 0.0])
+
+    def exit(self, records=0, bytes=0):
+        stage, phase, start, nested = self.stack.pop()
+        stop = time()
+        if self.profiled == len(self.stack):
+            self.profiles[stage].disable()
+            self.profiled = None
+        duration = stop - start
+        stats = self.stats[stage]
+        stats.seconds[phase] += duration - nested
+        stats.records += records
+        stats.bytes += bytes
+        stats.stop = stop
+        if self.stack:
+            self.stack[-1][3] += duration
+
+    def finish(self, stage):
+        stats = self.stats[stage]
+        stats.rss = get_rss()
+        stats.process_peak_rss = get_peak_rss()
+
+    def measure_stream(self, stage, stream, size=None, load=None, bytes=0):
+        self.stats[stage].bytes += bytes
+        stream = iter(stream)
+        try:
+            while True:
+                self.enter(stage, 'decode')
+                records = length = 0
+                try:
+                    try:
+                        item = next(stream)
+                    except StopIteration:
+                        break
+                    if size is not None:
+                        length = size(item)
+                    if load is not None:
+                        item = load(item)
+                    records = 1
+                finally:
+                    self.exit(records, length)
+                yield item
+        finally:
+            self.finish(stage)
+
+    def get_worker_report(self):
+        # Stats of a pool task, sent back to the parent with the result
+        return {
+            'stats': dict(self.stats),
+            'profiles': {
+                stage: get_profile_stats(profile)
+                for stage, profile in self.profiles.iteritems()
+                if stage in self.stats
+            }
+        }
+
+    def merge_worker_report(self, report):
+        for stage, stats in report['stats'].iteritems():
+            self.stats[stage].merge(stats)
+        for stage, stats in report['profiles'].iteritems():
+            self.worker_profiles[stage].append(stats)
+
+    def dump_profiles(self):
+        paths = {}
+        for stage, profile in self.profiles.iteritems():
+            if stage not in self.stats:
+                continue
+            sources = [get_profile_stats(profile)]
+            sources.extend(self.worker_profiles[stage])
+            sources = [ProfileStats(_) for _ in sources if _]
+            if not sources:
+                continue
+            stats = pstats.Stats(sources[0])
+            for source in sources[1:]:
+                stats.add(source)
+            if not os.path.exists(self.dir):
+                os.makedirs(self.dir)
+            path = os.path.join(self.dir, stage + '.prof')
+            stats.dump_stats(path)
+            paths[stage] = path
+        return paths
+
+    def get_report(self):
+        return {
+            'pid': self.pid,
+            'start': self.start,
+            'stop': time(),
+            'peak_rss': get_peak_rss(),
+            'stages': {
+                stage: stats.get_report()
+                for stage, stats in self.stats.iteritems()
+            },
+            'profiles': self.dump_profiles()
+        }
+
+    def report(self):
+        report = self.get_report()
+        for sink in self.sinks:
+            sink.write(report)
+        return report
+
+
+class JsonProfileSink(object):
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, report):
+        with open(self.path, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+
+class ConsoleProfileSink(object):
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+
+    def write(self, report):
+        stages = sorted(
+            report['stages'].iteritems(),
+            key=lambda item: item[1]['start']
+        )
+        for stage, stats in stages:
+            seconds = ' '.join(
+                '{phase} {seconds:0.2f}s'.format(
+                    phase=phase,
+                    seconds=stats['seconds'][phase]
+                )
+                for phase in PROFILE_PHASES
+                if phase in stats['seconds']
+            )
+            line = '{stage}: {seconds}'.format(stage=stage, seconds=seconds)
+            if stats['records_per_second']:
+                line += ', {rate:0.0f} records/s'.format(
+                    rate=stats['records_per_second']
+                )
+            if stats['bytes_per_second']:
+                line += ', {speed:0.2f} MB/s'.format(
+                    speed=stats['bytes_per_second'] / 1024 / 1024
+                )
+            if stats['rss'] is not None:
+                line += ', RSS {size:0.1f} MB'.format(
+                    size=float(stats['rss']) / 1024 / 1024
+                )
+            print >>self.stream, line
+        line = 'Process peak RSS: {size:0.1f} MB, {seconds:0.2f}s'.format(
+            size=float(report['peak_rss']) / 1024 / 1024,
+            seconds=report['stop'] - report['start']
+        )
+        print >>self.stream, line
+        for stage, path in sorted(report['profiles'].iteritems()):
+            line = '{stage} profile: {path}'.format(stage=stage, path=path)
+            print >>self.stream, line
+
+
+class ProfileStats(object):
+    # Raw cProfile stats in the form pstats.Stats loads, unlike Profile
+    # they pickle
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def get_profile_stats(profile):
+    profile.create_stats()
+    return profile.stats
+
+
+PROFILER = None
+
+
+def get_profiler():
+    # Forked workers inherit the profiler but never report, only the
+    # process that started it measures
+    if PROFILER is not None and PROFILER.pid == os.getpid():
+        return PROFILER
+
+
+def start_profiling(sinks=(), stages=(), dir=PROFILES):
+    # Stages listed in stages are also run under cProfile, stats go to
+    # dir/<stage>.prof. Pid and stage times in the report line up with
+    # samples of an external profiler like py-spy
+    global PROFILER
+    PROFILER = Profiler(sinks, stages, dir)
+    return PROFILER
+
+
+def run_profiled_task(task):
+    # Pool task (function, args). Workers inherit PROFILER of the parent
+    # but get_profiler ignores it, so when the parent profiles the task
+    # runs under a profiler of its own and its stats go back with the
+    # result to merge_profiled_result
+    global PROFILER
+    function, args = task
+    parent = PROFILER
+    if parent is None:
+        return function(args), None
+    PROFILER = Profiler(stages=list(parent.profiles), dir=parent.dir)
+    try:
+        result = function(args)
+        return result, PROFILER.get_worker_report()
+    finally:
+        PROFILER = parent
+
+
+def merge_profiled_result(result):
+    result, report = result
+    profiler = get_profiler()
+    if profiler is not None and report is not None:
+        profiler.merge_worker_report(report)
+    return result
+
+
+def stop_profiling():
+    global PROFILER
+    profiler = PROFILER
+    PROFILER = None
+    if profiler is not None:
+        return profiler.report()
+
+
+def measure_stream(stage, stream, size=None, load=None, bytes=0):
+    # Size gives bytes of an item, load decodes it, bytes is added once
+    # when the size of the whole stream is known upfront
+    profiler = get_profiler()
+    if profiler is None:
+        if load is not None:
+            return imap(load, stream)
+        return stream
+    return profiler.measure_stream(stage, stream, size, load, bytes)
+
+
+@contextmanager
+def measure_stage(stage, phase):
+    profiler = get_profiler()
+    if profiler is None:
+        yield
+    else:
+        profiler.enter(stage, phase)
+        try:
+            yield
+        finally:
+            profiler.exit()
+            profiler.finish(stage)
+
+
+def read_chunks(path, chunksize=8192):
     with open(path, 'rb') as file:
         while True:
             chunk = file.read(chunksize)
@@ -58,58 +466,79 @@ def iterate_chunks(path, chunksize=8192):
                 break
 
 
+def iterate_chunks(path, chunksize=8192):
+    return measure_stream('iterate_chunks', read_chunks(path, chunksize), len)
+
+
+RESUME_START = "{'desireable_compensation'"
+RESUME_DELIMITER = "}, {'desireable_compensation'"
+
+
+def open_raw_resumes(path=RAW_RESUMES):
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iterate_resume_spans(data, start=0, stop=None):
+    # Data is anything with find and rfind: mmap, bytearray or str. Since
+    # the whole range is addressable delimiters never fall on a boundary
+    # and every byte is scanned once
+    if stop is None:
+        stop = len(data)
+    start = data.find(RESUME_START, start, stop)
+    while start != -1:
+        index = data.find(RESUME_DELIMITER, start, stop)
+        if index == -1:
+            # Last resume is followed by "]" or by the next range
+            index = data.rfind('}', start, stop)
+            if index != -1:
+                yield start, index + 1 - start
+            break
+        yield start, index + 1 - start
+        start = index + 3
+
+
+def slice_resumes(path=RAW_RESUMES):
+    data = open_raw_resumes(path)
+    try:
+        for offset, length in iterate_resume_spans(data):
+            yield data[offset:offset + length]
+    finally:
+        data.close()
+
+
 def iterate_resumes(path=RAW_RESUMES):
-    OUTSIDE = 0
-    INSIDE = 1
-    state = OUTSIDE
-    buffer = ''
-    for chunk in iterate_chunks(path):
-        start = 0
-        while True:
-            if state == OUTSIDE:
-                index = chunk.find('{\'desireable_compensation\'', start)
-                if index == -1:
-                    break
-                else:
-                    start = index
-                    state = INSIDE
-            if state == INSIDE:
-                index = chunk.find('}, {\'desireable_compensation\'', start)
-                if index == -1:
-                    buffer += chunk[start:]
-                    break
-                else:
-                    yield buffer + chunk[start:index + 1]
-                    buffer = ''
-                    start = index
-                    state = OUTSIDE
-                
+    return measure_stream('iterate_resumes', slice_resumes(path), len)
+
 
 def none_or_int(value):
     if value is not None:
         return int(value)
 
 
-def parse_resume(data):
-    age = none_or_int(data['age'])
-    gender = data['gender']
+def build_resume(age, gender, salary, currency, area_id,
+                 language, specialization, primary_education):
+    age = none_or_int(age)
     if gender == -1:
         gender = None
-    area_id = none_or_int(data['area_id'])
+    area_id = none_or_int(area_id)
     languages = {}
-    for pair in data['language']:
+    for pair in language:
         if pair:
-            language, score = pair.split(': ', 1)
-            language = int(language)
+            id, score = pair.split(': ', 1)
+            id = int(id)
             score = int(score)
-            languages[language] = score
-    specializations = [int(_) for _ in data['specialization'] if _]
-    educations = [_.decode('utf8') for _ in data['primary_education'] if _]
+            languages[id] = score
+    specializations = [int(_) for _ in specialization if _]
+    educations = [
+        _ if isinstance(_, unicode) else _.decode('utf8')
+        for _ in primary_education if _
+    ]
     return Resume(
         age,
         gender,
-        data['desireable_compensation'],
-        data['desireable_compensation_currency_code'],
+        salary,
+        currency,
         area_id,
         languages,
         specializations,
@@ -117,7 +546,20 @@ def parse_resume(data):
     )
 
 
-def parse_resumes(data):
+def parse_resume(data):
+    return build_resume(
+        data['age'],
+        data['gender'],
+        data['desireable_compensation'],
+        data['desireable_compensation_currency_code'],
+        data['area_id'],
+        data['language'],
+        data['specialization'],
+        data['primary_education']
+    )
+
+
+def eval_resumes(data):
     data = eval(data, None, {'nan': None})
     # Since the delimiter between resumes is very long "},
     # {'desireable_compensation" one may need to split data once again
@@ -129,7 +571,303 @@ def parse_resumes(data):
         yield parse_resume(data)
 
 
-def read_resumes(path=RESUMES):
+# Tokenizer for the subset of Python repr used in resumes.repr: dicts,
+# lists, tuples, str/unicode literals, ints, floats and nan
+REPR_SCALAR = r'''
+    (u?)('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")         # string
+  | ([-+]?\d+)(\.\d*(?:[eE][-+]?\d+)?|[eE][-+]?\d+)?L?  # number
+  | (nan|None|True|False)                            # name
+'''
+REPR_TOKEN = re.compile(r'''
+    \s*(?:([\[\]{}(),:])|%s)
+''' % REPR_SCALAR, re.VERBOSE | re.DOTALL)
+REPR_SCALAR_TOKEN = re.compile(REPR_SCALAR, re.VERBOSE | re.DOTALL)
+# Same as REPR_SCALAR but without groups
+REPR_ITEM = r'''
+    u?(?:'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | [-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?L?
+  | nan|None|True|False
+'''
+# Resume fields are scalars or flat lists of scalars, so usually
+# whole "'key': value," is taken by one match
+REPR_FIELD = re.compile(r'''
+    \s*'(\w+)'\s*:\s*
+    (?:
+        %s
+      | \[\s*((?:(?:%s)\s*,\s*)*(?:%s)?)\s*\]
+    )
+    \s*([,}])
+''' % (REPR_SCALAR, REPR_ITEM, REPR_ITEM), re.VERBOSE | re.DOTALL)
+# Whole resume in the layout of resumes.repr: pandas column order, flat
+# values and single quoted strings. One match takes the record, so the
+# common case is faster than eval. Anything else goes field by field
+REPR_FLAT_STRING = r"u?'[^'\\]*(?:\\.[^'\\]*)*'"
+REPR_FLAT_SCALAR = r'(nan|None|[-+]?\d+(?:\.\d*)?|%s)' % REPR_FLAT_STRING
+REPR_FLAT_LIST = r'\[((?:%s(?:, %s)*)?)\]' % (
+    REPR_FLAT_STRING,
+    REPR_FLAT_STRING
+)
+REPR_RESUME = re.compile(
+    r'\s*\{' + ', '.join(
+        "'{key}': {value}".format(key=key, value=value)
+        for key, value in [
+            ('desireable_compensation', REPR_FLAT_SCALAR),
+            ('desireable_compensation_currency_code', REPR_FLAT_SCALAR),
+            ('age', REPR_FLAT_SCALAR),
+            ('gender', REPR_FLAT_SCALAR),
+            ('area_id', REPR_FLAT_SCALAR),
+            ('language', REPR_FLAT_LIST),
+            ('specialization', REPR_FLAT_LIST),
+            ('primary_education', REPR_FLAT_LIST),
+        ]
+    ) + r'\}'
+)
+REPR_FLAT_ITEM = re.compile(r"(u?)'([^'\\]*(?:\\.[^'\\]*)*)'")
+REPR_SPACE = re.compile(r'\s*')
+REPR_PUNCTUATION = 1
+REPR_NAMES = {
+    'nan': None,
+    'None': None,
+    'True': True,
+    'False': False
+}
+
+
+def read_repr_token(data, offset):
+    match = REPR_TOKEN.match(data, offset)
+    if match is None:
+        raise ValueError('Bad repr at offset {offset}: {sample!r}'.format(
+            offset=offset,
+            sample=data[offset:offset + 20]
+        ))
+    return match
+
+
+def read_repr_punctuation(data, offset, expected):
+    match = read_repr_token(data, offset)
+    punctuation = match.group(REPR_PUNCTUATION)
+    if punctuation is None or punctuation not in expected:
+        raise ValueError('Expected {expected!r} at offset {offset}'.format(
+            expected=expected,
+            offset=match.start(REPR_PUNCTUATION if punctuation else 0)
+        ))
+    return punctuation, match.end()
+
+
+def parse_repr_string(prefix, string, start=1, stop=-1):
+    # Body of the literal is string[start:stop], by default quotes are
+    # cut off. Bodies matched without quotes pass 0 and None
+    string = string[start:stop]
+    if prefix:
+        return string.decode('unicode_escape')
+    elif '\\' in string:
+        return string.decode('string_escape')
+    else:
+        return string
+
+
+def parse_repr_items(data, offset, close):
+    items = []
+    while True:
+        match = read_repr_token(data, offset)
+        # Empty container or trailing comma as in "(1,)"
+        if match.group(REPR_PUNCTUATION) == close:
+            return items, match.end()
+        item, offset = parse_repr_match(data, match)
+        items.append(item)
+        punctuation, offset = read_repr_punctuation(data, offset, (',', close))
+        if punctuation == close:
+            return items, offset
+
+
+def parse_repr_dict(data, offset):
+    items = {}
+    while True:
+        match = read_repr_token(data, offset)
+        if match.group(REPR_PUNCTUATION) == '}':
+            return items, match.end()
+        key, offset = parse_repr_match(data, match)
+        _, offset = read_repr_punctuation(data, offset, (':',))
+        items[key], offset = parse_repr_value(data, offset)
+        punctuation, offset = read_repr_punctuation(data, offset, (',', '}'))
+        if punctuation == '}':
+            return items, offset
+
+
+def parse_repr_scalar(prefix, string, integer, fraction, name):
+    if string:
+        return parse_repr_string(prefix, string)
+    elif integer:
+        if fraction:
+            return float(integer + fraction)
+        return int(integer)
+    else:
+        return REPR_NAMES[name]
+
+
+def parse_repr_match(data, match):
+    offset = match.end()
+    if match.lastindex == REPR_PUNCTUATION:
+        punctuation = match.group(REPR_PUNCTUATION)
+        if punctuation == '[':
+            return parse_repr_items(data, offset, ']')
+        elif punctuation == '(':
+            items, offset = parse_repr_items(data, offset, ')')
+            return tuple(items), offset
+        elif punctuation == '{':
+            return parse_repr_dict(data, offset)
+        raise ValueError('Unexpected {punctuation!r} at offset {offset}'.format(
+            punctuation=punctuation,
+            offset=match.start(REPR_PUNCTUATION)
+        ))
+    return parse_repr_scalar(*match.groups()[1:]), offset
+
+
+def parse_repr_value(data, offset):
+    return parse_repr_match(data, read_repr_token(data, offset))
+
+
+def parse_flat_scalar(value):
+    if value[0] == "'":
+        return parse_repr_string('', value)
+    elif value[0] == 'u':
+        return parse_repr_string('u', value, 2)
+    elif value in REPR_NAMES:
+        return REPR_NAMES[value]
+    elif '.' in value:
+        return float(value)
+    return int(value)
+
+
+def parse_flat_list(items):
+    if not items:
+        return []
+    elif (items[0] == "'" and "\\'" not in items
+            and ", u'" not in items):
+        # Without escaped quotes and unicode items "', '" only ever
+        # separates items
+        return [
+            parse_repr_string('', _, 0, None)
+            for _ in items[1:-1].split("', '")
+        ]
+    return [
+        parse_repr_string(prefix, string, 0, None)
+        for prefix, string in REPR_FLAT_ITEM.findall(items)
+    ]
+
+
+def parse_raw_field(data, offset):
+    match = REPR_FIELD.match(data, offset)
+    if match is not None:
+        (key, prefix, string, integer, fraction, name,
+         items, punctuation) = match.groups()
+        if items is None:
+            value = parse_repr_scalar(prefix, string, integer, fraction, name)
+        else:
+            value = [
+                parse_repr_scalar(*_)
+                for _ in REPR_SCALAR_TOKEN.findall(items)
+            ]
+        return key, value, punctuation, match.end()
+    # Nested or unusual value, take the slow path
+    key, offset = parse_repr_value(data, offset)
+    _, offset = read_repr_punctuation(data, offset, (':',))
+    value, offset = parse_repr_value(data, offset)
+    punctuation, offset = read_repr_punctuation(data, offset, (',', '}'))
+    return key, value, punctuation, offset
+
+
+def parse_raw_resume(data, offset=0):
+    match = REPR_RESUME.match(data, offset)
+    if match is not None:
+        (salary, currency, age, gender, area_id,
+         language, specialization, primary_education) = match.groups()
+        resume = build_resume(
+            parse_flat_scalar(age),
+            parse_flat_scalar(gender),
+            parse_flat_scalar(salary),
+            parse_flat_scalar(currency),
+            parse_flat_scalar(area_id),
+            parse_flat_list(language),
+            parse_flat_list(specialization),
+            parse_flat_list(primary_education)
+        )
+        return resume, match.end()
+    # Fields go straight into locals, resume dict is never built
+    age = gender = salary = currency = area_id = None
+    language = specialization = primary_education = ()
+    _, offset = read_repr_punctuation(data, offset, ('{',))
+    match = read_repr_token(data, offset)
+    if match.group(REPR_PUNCTUATION) == '}':
+        punctuation = '}'
+        offset = match.end()
+    else:
+        punctuation = ','
+    while punctuation != '}':
+        key, value, punctuation, offset = parse_raw_field(data, offset)
+        if key == 'desireable_compensation':
+            salary = value
+        elif key == 'desireable_compensation_currency_code':
+            currency = value
+        elif key == 'age':
+            age = value
+        elif key == 'gender':
+            gender = value
+        elif key == 'area_id':
+            area_id = value
+        elif key == 'language':
+            language = value
+        elif key == 'specialization':
+            specialization = value
+        elif key == 'primary_education':
+            primary_education = value
+    resume = build_resume(
+        age, gender, salary, currency, area_id,
+        language, specialization, primary_education
+    )
+    return resume, offset
+
+
+def parse_raw_resumes(data):
+    # Data may hold several resumes separated by commas, same as
+    # eval_resumes accepts tuples
+    offset = 0
+    size = len(data)
+    while True:
+        resume, offset = parse_raw_resume(data, offset)
+        yield resume
+        offset = REPR_SPACE.match(data, offset).end()
+        if offset >= size:
+            break
+        _, offset = read_repr_punctuation(data, offset, (',',))
+
+
+def parse_resumes(data):
+    return measure_stream('parse_resumes', parse_raw_resumes(data),
+                          bytes=len(data))
+
+
+def benchmark_resume_parsers(path=RAW_RESUMES, count=10000):
+    records = list(islice(iterate_resumes(path), count))
+    size = sum(len(_) for _ in records)
+    results = {}
+    for name, parse in [('eval', eval_resumes), ('repr', parse_resumes)]:
+        start = time()
+        results[name] = [
+            resume
+            for record in records
+            for resume in parse(record)
+        ]
+        duration = time() - start
+        print '{name}: {rate:0.0f} resumes/s, {speed:0.2f} MB/s'.format(
+            name=name,
+            rate=len(results[name]) / duration,
+            speed=size / duration / 1024 / 1024
+        )
+    assert results['eval'] == results['repr']
+
+
+def read_resumes(path=RAW_RESUMES):
     for data in iterate_resumes(path):
         for resume in parse_resumes(data):
             yield resume
@@ -156,23 +894,33 @@ def parse_specializations(data):
         yield Specialization(group, id, name)
 
 
-def iterate_vacancies():
-    with open(VACANCIES) as file:
+def iterate_vacancies(path=VACANCIES):
+    with open(path) as file:
         for line in file:
-            yield json.loads(line)
+            yield fast_json.loads(line)
+
+
+def parse_vacancy(data):
+    area_id = int(data['area']['id'])
+    salary = parse_salary(data)
+    specializations = list(parse_specializations(data))
+    return Vacancy(area_id, salary, specializations)
 
 
-def read_vacancies():
-    for data in iterate_vacancies():
-        area_id = int(data['area']['id'])
-        salary = parse_salary(data)
-        specializations = list(parse_specializations(data))
-        yield Vacancy(area_id, salary, specializations)
+def load_vacancy(line):
+    return parse_vacancy(fast_json.loads(line))
+
+
+def read_vacancies(path=VACANCIES):
+    with open(path) as file:
+        for vacancy in measure_stream('read_vacancies', file, len,
+                                      load_vacancy):
+            yield vacancy
 
 
 def log_progress(stream, every=1000, total=None):
     if total:
-        every = total / 200     # every 0.5%
+        every = max(total / 200, 1)     # every 0.5%
     for index, record in enumerate(stream):
         if index % every == 0:
             if total:
@@ -196,24 +944,667 @@ def dump_resumes(resumes):
             file.write(dump + '\n')
 
 
-def load_resume(dump):
+RESUME_RANGE_SIZE = 16 * 1024 * 1024
+
+
+def split_resume_ranges(data, size=RESUME_RANGE_SIZE, start=0):
+    # Every range starts at a resume and ends right before the next one
+    ranges = []
+    total = len(data)
+    start = data.find(RESUME_START, start)
+    while start != -1 and start < total:
+        stop = start + size
+        if stop < total:
+            index = data.find(RESUME_DELIMITER, stop)
+            if index != -1:
+                stop = index + 3
+            else:
+                stop = total
+        else:
+            stop = total
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def convert_resume_range(task):
+    path, start, stop = task
+    data = open_raw_resumes(path)
+    try:
+        dumps = []
+        records = (
+            data[offset:offset + length]
+            for offset, length in iterate_resume_spans(data, start, stop)
+        )
+        for record in measure_stream('iterate_resumes', records, len):
+            for resume in parse_resumes(record):
+                dump = dump_resume(resume)
+                dumps.append(dump.encode('utf8') + '\n')
+    finally:
+        data.close()
+    return ''.join(dumps)
+
+
+def convert_resumes(path=RAW_RESUMES, target=RESUMES, processes=None,
+                    size=RESUME_RANGE_SIZE, start=0):
+    # Converts resumes that begin at or after start. Returns end of the
+    # last converted resume and number of resumes
+    data = open_raw_resumes(path)
+    try:
+        ranges = split_resume_ranges(data, size, start)
+        stop = start
+        if ranges:
+            for offset, length in iterate_resume_spans(data, *ranges[-1]):
+                stop = offset + length
+    finally:
+        data.close()
+    tasks = [
+        (convert_resume_range, (path, begin, end))
+        for begin, end in ranges
+    ]
+    count = 0
+    pool = Pool(processes)
+    try:
+        with open(target, 'w') as file:
+            # imap keeps the original order of ranges
+            dumps = imap(
+                merge_profiled_result,
+                pool.imap(run_profiled_task, tasks)
+            )
+            for dump in log_progress(dumps, total=len(tasks)):
+                file.write(dump)
+                count += dump.count('\n')
+    finally:
+        pool.close()
+        pool.join()
+    return stop, count
+
+
+class FrozenDict(dict):
+    # Dict shared by many resumes, so it must not change
+    def readonly(self, *args, **kwargs):
+        raise TypeError('FrozenDict is read-only')
+
+    __setitem__ = __delitem__ = readonly
+    clear = pop = popitem = setdefault = update = readonly
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+class FrozenList(list):
+    # List shared by many resumes, equal to a plain list of same items
+    def readonly(self, *args, **kwargs):
+        raise TypeError('FrozenList is read-only')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = readonly
+    __iadd__ = __imul__ = readonly
+    append = extend = insert = pop = remove = reverse = sort = readonly
+
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+
+RESUME_VALUES_LIMIT = 100000
+
+
+class ResumeValues(object):
+    # Flyweight tables for compact resumes. Currencies and education
+    # names are shared strings, languages are shared FrozenDicts,
+    # specializations and educations are shared FrozenLists, so compact
+    # resumes compare equal to plain ones. A few thousand distinct values
+    # serve millions of resumes. A table that reaches limit is cleared,
+    # values handed out before stay valid but are not shared with later
+    # ones, so a stream of unique values does not grow memory
+    def __init__(self, limit=RESUME_VALUES_LIMIT):
+        self.limit = limit
+        self.strings = {}
+        self.languages = {}
+        self.lists = {}
+
+    def share(self, table, key, value):
+        shared = table.get(key)
+        if shared is None:
+            if len(table) >= self.limit:
+                table.clear()
+            shared = value
+            table[key] = shared
+        return shared
+
+    def share_string(self, value):
+        if value is None:
+            return None
+        return self.share(self.strings, value, value)
+
+    def share_languages(self, languages):
+        key = tuple(sorted(languages.iteritems()))
+        shared = self.languages.get(key)
+        if shared is None:
+            shared = self.share(self.languages, key, FrozenDict(languages))
+        return shared
+
+    def share_list(self, values):
+        key = tuple(values)
+        shared = self.lists.get(key)
+        if shared is None:
+            shared = self.share(self.lists, key, FrozenList(key))
+        return shared
+
+    def compact(self, resume):
+        return Resume(
+            resume.age,
+            resume.gender,
+            resume.salary,
+            self.share_string(resume.currency),
+            resume.area_id,
+            self.share_languages(resume.languages),
+            self.share_list(resume.specializations),
+            self.share_list(
+                [self.share_string(_) for _ in resume.educations]
+            )
+        )
+
+
+def load_resume(dump, values=None):
     dump = dump.decode('utf8')
     data = cjson.decode(dump)
     (age, gender, salary, currency, area_id,
      languages, specializations, educations) = data
-    return Resume(
+    resume = Resume(
         age, gender, salary, currency, area_id,
         languages, specializations, educations
     )
+    if values is not None:
+        resume = values.compact(resume)
+    return resume
 
 
-def load_resumes():
-    with open(RESUMES) as file:
-        for line in file:
-            yield load_resume(line)
+def load_resumes(path=RESUMES, compact=False):
+    # Compact resumes share equal values, use them to hold many resumes
+    # in memory
+    values = ResumeValues() if compact else None
+    with open(path) as file:
+        for resume in measure_stream('load_resumes', file, len,
+                                     lambda line: load_resume(line, values)):
+            yield resume
+
+
+def get_deep_size(value, seen=None):
+    # Bytes of value and everything it references, shared objects are
+    # counted once
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += get_deep_size(key, seen) + get_deep_size(item, seen)
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            size += get_deep_size(item, seen)
+    return size
+
+
+def benchmark_resume_memory(path=RESUMES, count=100000):
+    for compact in (False, True):
+        start = time()
+        resumes = list(islice(load_resumes(path, compact), count))
+        duration = time() - start
+        size = get_deep_size(resumes)
+        print (
+            '{name}: {size:0.1f} MB, {record:0.0f} bytes/resume, '
+            '{rate:0.0f} resumes/s'
+        ).format(
+            name='compact' if compact else 'namedtuple',
+            size=float(size) / 1024 / 1024,
+            record=float(size) / len(resumes),
+            rate=len(resumes) / duration
+        )
+
+
+JSON_RANGE_SIZE = 4 * 1024 * 1024
+
+
+def split_line_ranges(data, size=JSON_RANGE_SIZE):
+    # Every range starts at a line and ends right after a newline
+    ranges = []
+    total = len(data)
+    start = 0
+    while start < total:
+        stop = start + size
+        if stop < total:
+            index = data.find('\n', stop - 1)
+            if index != -1:
+                stop = index + 1
+            else:
+                stop = total
+        else:
+            stop = total
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def decode_line_range(task):
+    path, start, stop, load, stage = task
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        lines = data[start:stop].splitlines()
+    finally:
+        data.close()
+    lines = [_ for _ in lines if _]
+    return list(measure_stream(stage, lines, len, load))
+
+
+def get_ready_result(results):
+    while True:
+        for result in results:
+            if result.ready():
+                return result
+        results[0].wait(0.01)
+
+
+def iterate_json_batches(path, load, stage, processes=None, ordered=True,
+                         prefetch=None, size=JSON_RANGE_SIZE):
+    # Yields lists of load(line) for ranges of a JSON-lines file decoded in
+    # a process pool, workers measure decoding as stage. At most prefetch
+    # ranges are submitted and not yet consumed, so a slow consumer does
+    # not pile up decoded batches
+    if processes is None:
+        processes = cpu_count()
+    if prefetch is None:
+        prefetch = 2 * processes
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        ranges = split_line_ranges(data, size)
+    finally:
+        data.close()
+    tasks = (
+        (decode_line_range, (path, start, stop, load, stage))
+        for start, stop in ranges
+    )
+    pool = Pool(processes)
+    try:
+        pending = deque(
+            pool.apply_async(run_profiled_task, (task,))
+            for task in islice(tasks, prefetch)
+        )
+        while pending:
+            if ordered:
+                result = pending.popleft()
+            else:
+                result = get_ready_result(pending)
+                pending.remove(result)
+            batch = merge_profiled_result(result.get())
+            for task in islice(tasks, 1):
+                pending.append(pool.apply_async(run_profiled_task, (task,)))
+            yield batch
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def load_resume_batches(path=RESUMES, **options):
+    return iterate_json_batches(path, load_resume, 'load_resumes', **options)
+
+
+def load_vacancy_batches(path=VACANCIES, **options):
+    return iterate_json_batches(
+        path,
+        load_vacancy,
+        'read_vacancies',
+        **options
+    )
 
 
-def show_age_distribution(resumes):
+# Array typecodes of ResumeColumns, None is stored as -1 or nan
+RESUME_COLUMN_TYPES = [
+    ('age', 'i'),
+    ('gender', 'b'),
+    ('salary', 'd'),
+    ('currency', 'b'),
+    ('area_id', 'i'),
+    ('language_offsets', 'l'),
+    ('language_ids', 'i'),
+    ('language_scores', 'b'),
+    ('specialization_offsets', 'l'),
+    ('specializations', 'i'),
+    ('education_offsets', 'l'),
+    ('educations', 'i'),
+]
+COLUMN_TABLES = 'tables.json'
+
+
+def get_column_path(name, dir):
+    return os.path.join(dir, '{name}.npy'.format(name=name))
+
+
+def encode_none(value, default=-1):
+    if value is None:
+        return default
+    return value
+
+
+def decode_none(value):
+    if value == -1:
+        return None
+    return value
+
+
+def encode_string(strings, value):
+    if value is None:
+        return -1
+    code = strings.get(value)
+    if code is None:
+        code = len(strings)
+        strings[value] = code
+    return code
+
+
+def get_string_table(strings):
+    table = [None] * len(strings)
+    for string, code in strings.iteritems():
+        table[code] = string
+    return table
+
+
+class StringTable(object):
+    # Global string dictionary: one append-only string -> code mapping
+    # per kind ('currency', 'education', 'profarea', 'university'), so a
+    # code means the same string in every store, partial and process
+    # that loads the same table. New strings get the next codes
+    def __init__(self, tables=None):
+        self.codes = {}
+        for kind, strings in (tables or {}).iteritems():
+            self.codes[kind] = {
+                string: code
+                for code, string in enumerate(strings)
+            }
+        self.sizes = self.get_sizes()
+
+    def get_sizes(self):
+        return {kind: len(codes) for kind, codes in self.codes.iteritems()}
+
+    def get_codes(self, kind):
+        return self.codes.setdefault(kind, {})
+
+    def encode(self, kind, string):
+        return encode_string(self.get_codes(kind), string)
+
+    def encode_all(self, kind, strings):
+        # Sorted, so processes that add the same strings to the same
+        # table agree on codes
+        codes = self.get_codes(kind)
+        for string in sorted(set(strings) - set(codes)):
+            encode_string(codes, string)
+        return codes
+
+    def get_strings(self, kind):
+        return get_string_table(self.get_codes(kind))
+
+    def get_tables(self):
+        return {kind: self.get_strings(kind) for kind in self.codes}
+
+    def is_extension(self, tables):
+        # Codes of tables mean the same strings in this table, it only
+        # appended strings to them
+        return all(
+            self.get_strings(kind)[:len(strings)] == strings
+            for kind, strings in tables.iteritems()
+        )
+
+    def is_changed(self):
+        return self.get_sizes() != self.sizes
+
+
+def load_string_table(path=STRINGS):
+    cache = read_cache(path, STRINGS_VERSION)
+    if cache is None:
+        return StringTable()
+    return StringTable(cache['tables'])
+
+
+def dump_string_table(strings, path=STRINGS):
+    if strings.is_changed() or not os.path.exists(path):
+        write_cache({
+            'version': STRINGS_VERSION,
+            'tables': strings.get_tables()
+        }, path)
+        strings.sizes = strings.get_sizes()
+
+
+def dump_resume_columns(resumes, dir=RESUME_COLUMNS, strings=None):
+    columns = {name: array(code) for name, code in RESUME_COLUMN_TYPES}
+    age = columns['age']
+    gender = columns['gender']
+    salary = columns['salary']
+    currency = columns['currency']
+    area_id = columns['area_id']
+    language_offsets = columns['language_offsets']
+    language_ids = columns['language_ids']
+    language_scores = columns['language_scores']
+    specialization_offsets = columns['specialization_offsets']
+    specializations = columns['specializations']
+    education_offsets = columns['education_offsets']
+    educations = columns['educations']
+    if strings is None:
+        strings = StringTable()
+    currencies = strings.get_codes('currency')
+    education_names = strings.get_codes('education')
+    language_offsets.append(0)
+    specialization_offsets.append(0)
+    education_offsets.append(0)
+    for resume in resumes:
+        age.append(encode_none(resume.age))
+        gender.append(encode_none(resume.gender))
+        salary.append(encode_none(resume.salary, float('nan')))
+        currency.append(encode_string(currencies, resume.currency))
+        area_id.append(encode_none(resume.area_id))
+        for language, score in resume.languages.iteritems():
+            language_ids.append(int(language))
+            language_scores.append(score)
+        language_offsets.append(len(language_ids))
+        specializations.extend(resume.specializations)
+        specialization_offsets.append(len(specializations))
+        for education in resume.educations:
+            educations.append(encode_string(education_names, education))
+        education_offsets.append(len(educations))
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    for name, code in RESUME_COLUMN_TYPES:
+        column = np.frombuffer(columns[name], dtype=np.dtype(code))
+        np.save(get_column_path(name, dir), column)
+    with open(os.path.join(dir, COLUMN_TABLES), 'w') as file:
+        json.dump({
+            'currencies': get_string_table(currencies),
+            'education_names': get_string_table(education_names)
+        }, file)
+
+
+def load_resume_columns(dir=RESUME_COLUMNS):
+    columns = {
+        name: np.load(get_column_path(name, dir), mmap_mode='r')
+        for name, _ in RESUME_COLUMN_TYPES
+    }
+    with open(os.path.join(dir, COLUMN_TABLES)) as file:
+        columns.update(json.load(file))
+    return ResumeColumns(**columns)
+
+
+def iterate_resume_rows(columns, start=0, stop=None, block=100000):
+    if stop is None:
+        stop = len(columns.age)
+    currencies = columns.currencies
+    education_names = columns.education_names
+    for begin in xrange(start, stop, block):
+        end = min(begin + block, stop)
+        ages = columns.age[begin:end].tolist()
+        genders = columns.gender[begin:end].tolist()
+        salaries = columns.salary[begin:end].tolist()
+        currency_codes = columns.currency[begin:end].tolist()
+        area_ids = columns.area_id[begin:end].tolist()
+        language_offsets = columns.language_offsets[begin:end + 1].tolist()
+        first, last = language_offsets[0], language_offsets[-1]
+        # Ids are stored as ints, load_resumes gives JSON object keys
+        language_ids = [
+            unicode(_)
+            for _ in columns.language_ids[first:last].tolist()
+        ]
+        language_scores = columns.language_scores[first:last].tolist()
+        language_first = first
+        specialization_offsets = (
+            columns.specialization_offsets[begin:end + 1].tolist()
+        )
+        first, last = specialization_offsets[0], specialization_offsets[-1]
+        specializations = columns.specializations[first:last].tolist()
+        specialization_first = first
+        education_offsets = columns.education_offsets[begin:end + 1].tolist()
+        first, last = education_offsets[0], education_offsets[-1]
+        educations = columns.educations[first:last].tolist()
+        education_first = first
+        for index in xrange(end - begin):
+            salary = salaries[index]
+            if salary != salary:    # nan
+                salary = None
+            currency = currency_codes[index]
+            if currency != -1:
+                currency = currencies[currency]
+            else:
+                currency = None
+            first = language_offsets[index] - language_first
+            last = language_offsets[index + 1] - language_first
+            languages = dict(zip(
+                language_ids[first:last],
+                language_scores[first:last]
+            ))
+            first = specialization_offsets[index] - specialization_first
+            last = specialization_offsets[index + 1] - specialization_first
+            first_education = education_offsets[index] - education_first
+            last_education = education_offsets[index + 1] - education_first
+            yield Resume(
+                decode_none(ages[index]),
+                decode_none(genders[index]),
+                salary,
+                currency,
+                decode_none(area_ids[index]),
+                languages,
+                specializations[first:last],
+                [
+                    education_names[_]
+                    for _ in educations[first_education:last_education]
+                ]
+            )
+
+
+class ResumeRows(object):
+    # Lazy Resume view over ResumeColumns for code that iterates or
+    # samples resumes
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns.age)
+
+    def __getitem__(self, index):
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError(index)
+        return next(iterate_resume_rows(self.columns, index, index + 1))
+
+    def __iter__(self):
+        return iterate_resume_rows(self.columns)
+
+
+# Array typecodes of VacancyColumns, salary is 1 when vacancy has salary
+# at all, missing bounds are nan. profareas are group ids of
+# specializations
+VACANCY_COLUMN_TYPES = [
+    ('area_id', 'i'),
+    ('salary', 'b'),
+    ('salary_min', 'd'),
+    ('salary_max', 'd'),
+    ('currency', 'b'),
+    ('specialization_offsets', 'l'),
+    ('specializations', 'i'),
+    ('profareas', 'i'),
+]
+
+
+def dump_vacancy_columns(vacancies, dir=VACANCY_COLUMNS, strings=None):
+    columns = {name: array(code) for name, code in VACANCY_COLUMN_TYPES}
+    area_id = columns['area_id']
+    salary = columns['salary']
+    salary_min = columns['salary_min']
+    salary_max = columns['salary_max']
+    currency = columns['currency']
+    specialization_offsets = columns['specialization_offsets']
+    specializations = columns['specializations']
+    profareas = columns['profareas']
+    if strings is None:
+        strings = StringTable()
+    currencies = strings.get_codes('currency')
+    profarea_names = {}
+    specialization_offsets.append(0)
+    for vacancy in vacancies:
+        area_id.append(vacancy.area_id)
+        if vacancy.salary is not None:
+            salary.append(1)
+            salary_min.append(encode_none(vacancy.salary.min, float('nan')))
+            salary_max.append(encode_none(vacancy.salary.max, float('nan')))
+            currency.append(encode_string(currencies, vacancy.salary.currency))
+        else:
+            salary.append(0)
+            salary_min.append(float('nan'))
+            salary_max.append(float('nan'))
+            currency.append(-1)
+        for specialization in vacancy.specializations:
+            group = specialization.group
+            specializations.append(specialization.id)
+            profareas.append(group.id)
+            profarea_names[group.id] = group.name
+        specialization_offsets.append(len(specializations))
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    for name, code in VACANCY_COLUMN_TYPES:
+        column = np.frombuffer(columns[name], dtype=np.dtype(code))
+        np.save(get_column_path(name, dir), column)
+    with open(os.path.join(dir, COLUMN_TABLES), 'w') as file:
+        json.dump({
+            'currencies': get_string_table(currencies),
+            'profarea_names': sorted(profarea_names.iteritems())
+        }, file)
+
+
+def load_vacancy_columns(dir=VACANCY_COLUMNS):
+    columns = {
+        name: np.load(get_column_path(name, dir), mmap_mode='r')
+        for name, _ in VACANCY_COLUMN_TYPES
+    }
+    with open(os.path.join(dir, COLUMN_TABLES)) as file:
+        tables = json.load(file)
+    columns['currencies'] = tables['currencies']
+    columns['profarea_names'] = dict(tables['profarea_names'])
+    return VacancyColumns(**columns)
+
+
+def take_column(column, index=None):
+    if index is None:
+        return np.asarray(column)
+    return column[index]
+
+
+def count_values(values):
+    keys, counts = np.unique(values, return_counts=True)
+    return Counter(dict(zip(keys.tolist(), counts.tolist())))
+
+
+def get_age_distribution(resumes):
     data = Counter()
     total = 0
     undefined = 0
@@ -228,18 +1619,49 @@ def show_age_distribution(resumes):
                 data[age] += 1
             else:
                 unbound += 1
+    return data, total, undefined, unbound
+
+
+def get_age_distribution_batch(columns):
+    age = take_column(columns.age)
+    total = len(age)
+    defined = age != -1
+    bound = defined & (age > 15) & (age < 80)
+    undefined = total - int(defined.sum())
+    unbound = int(defined.sum()) - int(bound.sum())
+    data = count_values(age[bound])
+    return data, total, undefined, unbound
+
+
+def save_figure(fig, path, dpi=300):
+    fig.savefig(path, dpi=dpi, bbox_inches='tight')
+
+
+def plot_age_distribution(data, path):
     fig, ax = plt.subplots()
     table = pd.Series(data)
     table.plot(ax=ax)
     ax.set_xlabel(u'Возраст')
     ax.set_ylabel(u'Число резюме')
     fig.set_size_inches(6, 4)
-    fig.savefig('fig.png', dpi=300, bbox_inches='tight')
+    save_figure(fig, path)
+    return fig
+
+
+def show_age_distribution(resumes, path=None):
+    with measure_stage('show_age_distribution', 'aggregate'):
+        if isinstance(resumes, ResumeColumns):
+            distribution = get_age_distribution_batch(resumes)
+        else:
+            distribution = get_age_distribution(resumes)
+    data, total, undefined, unbound = distribution
     print 'Undefined: {0:0.2f}%'.format(float(undefined) / total * 100)
     print 'Unbound: {0:0.2f}%'.format(float(unbound) / total * 100)
+    with measure_stage('show_age_distribution', 'plot'):
+        return draw_figure('age_distribution', (data,), path)
 
 
-def show_gender_distribution(resumes):
+def get_gender_distribution(resumes):
     data = Counter()
     total = 0
     undefined = 0
@@ -250,17 +1672,42 @@ def show_gender_distribution(resumes):
             undefined += 1
         else:
             data[gender] += 1
+    return data, total, undefined
+
+
+def get_gender_distribution_batch(columns):
+    gender = take_column(columns.gender)
+    total = len(gender)
+    defined = gender != -1
+    undefined = total - int(defined.sum())
+    data = count_values(gender[defined])
+    return data, total, undefined
+
+
+def plot_gender_distribution(data, path):
     fig, ax = plt.subplots()
     table = pd.Series(data)
     table.plot(ax=ax, kind='bar')
     ax.set_xlabel(u'Пол')
     ax.set_ylabel(u'Число вакансий')
     fig.set_size_inches(6, 4)
-    fig.savefig('fig.png', dpi=300, bbox_inches='tight')
+    save_figure(fig, path)
+    return fig
+
+
+def show_gender_distribution(resumes, path=None):
+    with measure_stage('show_gender_distribution', 'aggregate'):
+        if isinstance(resumes, ResumeColumns):
+            distribution = get_gender_distribution_batch(resumes)
+        else:
+            distribution = get_gender_distribution(resumes)
+    data, total, undefined = distribution
     print 'Undefined: {0:0.2f}%'.format(float(undefined) / total * 100)
+    with measure_stage('show_gender_distribution', 'plot'):
+        return draw_figure('gender_distribution', (data,), path)
 
 
-def show_currency_distribution(resumes):
+def get_currency_distribution(resumes):
     data = Counter()
     total = 0
     rur = 0
@@ -274,12 +1721,50 @@ def show_currency_distribution(resumes):
             if currency == 'RUR':
                 rur += 1
             data[currency] += 1
+    return data, total, rur, undefined
+
+
+def get_currency_code(columns, currency):
+    if currency in columns.currencies:
+        return columns.currencies.index(currency)
+    # Code that never occurs in the column
+    return -2
+
+
+def get_currency_distribution_batch(columns):
+    currency = take_column(columns.currency)
+    total = len(currency)
+    defined = currency != -1
+    undefined = total - int(defined.sum())
+    rur = int((currency == get_currency_code(columns, 'RUR')).sum())
+    counts = count_values(currency[defined])
+    data = Counter({
+        columns.currencies[code]: count
+        for code, count in counts.iteritems()
+    })
+    return data, total, rur, undefined
+
+
+def plot_currency_distribution(data, path):
     fig, ax = plt.subplots()
     table = pd.Series(data)
     table = table.sort_values(ascending=False)
     table.plot(ax=ax, kind='bar')
+    save_figure(fig, path)
+    return fig
+
+
+def show_currency_distribution(resumes, path=None):
+    with measure_stage('show_currency_distribution', 'aggregate'):
+        if isinstance(resumes, ResumeColumns):
+            distribution = get_currency_distribution_batch(resumes)
+        else:
+            distribution = get_currency_distribution(resumes)
+    data, total, rur, undefined = distribution
     print 'Undefined: {0:0.2f}%'.format(float(undefined) / total * 100)
     print 'RUR from defined: {0:0.2f}%'.format(float(rur) / (total - undefined) * 100)
+    with measure_stage('show_currency_distribution', 'plot'):
+        return draw_figure('currency_distribution', (data,), path)
 
 
 def parse_areas(data):
@@ -302,12 +1787,321 @@ def load_areas():
         return parse_areas(data)
 
 
-def show_age_salary_correlation(resumes):
-    x = []
-    y = []
-    age_salary_sum = Counter()
-    age_salary_count = Counter()
-    for resume in sample(resumes, 500000):
+class AreaIndex(object):
+    # Area tree in arrays indexed by area id, -1 marks ids that are not
+    # areas. Subtree of an area is the range enters[id]:exits[id] of
+    # preorder, so subtree checks are two comparisons. All lookups take
+    # a single id or an array of ids, like the area_id column
+    def __init__(self, areas):
+        areas = list(areas)
+        size = max(_.id for _ in areas) + 1
+        self.areas = [None] * size
+        self.parents = np.full(size, -1, dtype=np.int32)
+        children = defaultdict(list)
+        roots = []
+        for area in areas:
+            self.areas[area.id] = area
+            if area.parent_id is None:
+                roots.append(area.id)
+            else:
+                self.parents[area.id] = area.parent_id
+                children[area.parent_id].append(area.id)
+
+        self.depths = np.full(size, -1, dtype=np.int32)
+        self.enters = np.full(size, -1, dtype=np.int32)
+        self.exits = np.full(size, -1, dtype=np.int32)
+        order = []
+        stack = [(id, 0, False) for id in reversed(roots)]
+        while stack:
+            id, depth, visited = stack.pop()
+            if visited:
+                self.exits[id] = len(order)
+                continue
+            self.depths[id] = depth
+            self.enters[id] = len(order)
+            order.append(id)
+            stack.append((id, depth, True))
+            for child in reversed(children[id]):
+                stack.append((child, depth + 1, False))
+        self.order = np.array(order, dtype=np.int32)
+
+        # ancestors[depth, id] is the ancestor of id at depth, an area is
+        # its own ancestor at its depth
+        ids = self.order
+        depths = self.depths[ids]
+        self.ancestors = np.full((depths.max() + 1, size), -1, dtype=np.int32)
+        self.ancestors[depths, ids] = ids
+        for depth in xrange(depths.max(), 0, -1):
+            row = self.ancestors[depth]
+            known = row != -1
+            self.ancestors[depth - 1][known] = self.parents[row[known]]
+
+    def lookup(self, table, ids):
+        ids = np.asarray(ids)
+        values = np.full(ids.shape, -1, dtype=table.dtype)
+        known = (ids >= 0) & (ids < len(table))
+        values[known] = table[ids[known]]
+        if values.ndim == 0:
+            return values.item()
+        return values
+
+    def get_depths(self, ids):
+        return self.lookup(self.depths, ids)
+
+    def get_ancestors(self, ids, depth):
+        if depth >= len(self.ancestors):
+            return self.lookup(np.full(len(self.areas), -1), ids)
+        return self.lookup(self.ancestors[depth], ids)
+
+    def is_inside(self, ids, ancestor_id):
+        # Area is inside itself
+        enters = self.lookup(self.enters, ids)
+        return (
+            (enters >= self.enters[ancestor_id])
+            & (enters < self.exits[ancestor_id])
+        )
+
+    def get_descendants(self, id):
+        return self.order[self.enters[id] + 1:self.exits[id]]
+
+    def get_regions(self, ids, country_id):
+        # Top level area of the country that contains ids, -1 outside
+        depth = self.depths[country_id] + 1
+        regions = self.get_ancestors(ids, depth)
+        return np.where(self.is_inside(ids, country_id), regions, -1)
+
+
+def load_area_index():
+    return AreaIndex(load_areas())
+
+
+def get_open_random(generator):
+    # Uniform in (0, 1), log of it is always defined
+    value = generator.random()
+    while value == 0.0:
+        value = generator.random()
+    return value
+
+
+def sample_stream(stream, size, seed=None):
+    # Reservoir sampling, algorithm L. Random numbers are drawn only for
+    # items that get into the reservoir, others are just skipped
+    generator = Random(seed)
+    stream = iter(stream)
+    reservoir = list(islice(stream, size))
+    if len(reservoir) < size or not size:
+        return reservoir
+    weight = exp(log(get_open_random(generator)) / size)
+    while True:
+        skip = int(log(get_open_random(generator)) / log(1 - weight))
+        for item in islice(stream, skip, skip + 1):
+            break
+        else:
+            return reservoir
+        reservoir[int(generator.random() * size)] = item
+        weight *= exp(log(get_open_random(generator)) / size)
+
+
+def sample_stream_weighted(stream, size, weight, seed=None):
+    # Algorithm A-Res: item is kept with the size largest keys
+    # u ** (1 / weight), items with no weight are never taken
+    generator = Random(seed)
+    heap = []
+    for index, item in enumerate(stream):
+        value = weight(item)
+        if value > 0:
+            key = get_open_random(generator) ** (1.0 / value)
+            if len(heap) < size:
+                heapq.heappush(heap, (key, index, item))
+            elif key > heap[0][0]:
+                heapq.heapreplace(heap, (key, index, item))
+    return [item for _, _, item in heap]
+
+
+def sample_stream_stratified(stream, size, key, seed=None):
+    # Separate reservoir of the given size for every key(item), for
+    # example key=lambda resume: resume.area_id
+    generator = Random(seed)
+    counts = Counter()
+    reservoirs = defaultdict(list)
+    for item in stream:
+        stratum = key(item)
+        count = counts[stratum]
+        counts[stratum] = count + 1
+        reservoir = reservoirs[stratum]
+        if count < size:
+            reservoir.append(item)
+        else:
+            index = int(generator.random() * (count + 1))
+            if index < size:
+                reservoir[index] = item
+    return reservoirs
+
+
+QUANTILE_SKETCH_SIZE = 200
+
+
+class QuantileSketch(object):
+    # KLL sketch. Compactor on level h holds items of weight 2 ** h, when
+    # it is full its items are sorted and every other one goes up a
+    # level. Memory is O(size * log(count / size)), count, sum, sum of
+    # squares, min and max are exact
+    def __init__(self, size=QUANTILE_SKETCH_SIZE):
+        self.size = size
+        self.count = 0
+        self.total = 0
+        self.squares = 0
+        self.min = None
+        self.max = None
+        self.compactors = [[]]
+        self.retained = 0
+        self.limit = self.get_capacity(0)
+
+    def get_capacity(self, level):
+        height = len(self.compactors)
+        return int(ceil(self.size * (2.0 / 3) ** (height - level - 1))) + 1
+
+    def grow(self):
+        self.compactors.append([])
+        self.limit = sum(
+            self.get_capacity(_)
+            for _ in xrange(len(self.compactors))
+        )
+
+    def compress(self):
+        for level, items in enumerate(self.compactors):
+            if len(items) >= self.get_capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.grow()
+                items.sort()
+                offset = int(random() < 0.5)
+                self.compactors[level + 1].extend(items[offset::2])
+                self.compactors[level] = []
+                break
+        self.retained = sum(len(_) for _ in self.compactors)
+
+    def update(self, value):
+        self.count += 1
+        self.total += value
+        self.squares += value * value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.compactors[0].append(value)
+        self.retained += 1
+        if self.retained >= self.limit:
+            self.compress()
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.count += other.count
+        self.total += other.total
+        self.squares += other.squares
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self.retained = sum(len(_) for _ in self.compactors)
+        while self.retained >= self.limit:
+            self.compress()
+        return self
+
+    def get_items(self):
+        items = [
+            (value, 2 ** level)
+            for level, values in enumerate(self.compactors)
+            for value in values
+        ]
+        items.sort()
+        return items
+
+    def get_quantiles(self, fractions):
+        items = self.get_items()
+        total = sum(weight for _, weight in items)
+        quantiles = []
+        for fraction in fractions:
+            target = fraction * total
+            cumulative = 0
+            for value, weight in items:
+                cumulative += weight
+                if cumulative >= target:
+                    break
+            quantiles.append(value)
+        return quantiles
+
+    def get_mean(self):
+        return float(self.total) / self.count
+
+    def get_std(self):
+        # Sample std, same as DataFrame.std
+        if self.count < 2:
+            return float('nan')
+        mean = self.get_mean()
+        variance = (self.squares - self.count * mean * mean) / (self.count - 1)
+        return sqrt(max(variance, 0))
+
+
+def get_box_stats(values, label=None):
+    # Stats for Axes.bxp, whiskers at 1.5 IQR like DataFrame.plot(kind='box')
+    if not isinstance(values, QuantileSketch):
+        stats, = cbook.boxplot_stats(np.asarray(values, dtype=float))
+        stats['label'] = label
+        return stats
+    sketch = values
+    q1, med, q3 = sketch.get_quantiles([0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    low = q1 - 1.5 * iqr
+    high = q3 + 1.5 * iqr
+    values = [value for value, _ in sketch.get_items()]
+    inside = [_ for _ in values if low <= _ <= high]
+    if sketch.min >= low:
+        whislo = sketch.min
+    else:
+        whislo = min(inside or [q1])
+    if sketch.max <= high:
+        whishi = sketch.max
+    else:
+        whishi = max(inside or [q3])
+    # Retained items stand for the outliers
+    fliers = [_ for _ in values if _ < whislo or _ > whishi]
+    return {
+        'label': label,
+        'mean': sketch.get_mean(),
+        'med': med,
+        'q1': q1,
+        'q3': q3,
+        'iqr': iqr,
+        'whislo': whislo,
+        'whishi': whishi,
+        'fliers': fliers
+    }
+
+
+def plot_box_stats(ax, groups, order):
+    stats = [get_box_stats(groups[_], _) for _ in order if _ in groups]
+    ax.bxp(stats)
+
+
+def sample_resume_index(columns, size, seed=None):
+    # Small stores are taken whole, same as sample_stream does
+    total = len(columns.age)
+    index = Random(seed).sample(xrange(total), min(size, total))
+    index.sort()
+    return np.array(index)
+
+
+def age_salary_accumulator():
+    def init():
+        return [], [], Counter(), Counter()
+
+    def update(state, resume):
+        ages, salaries, age_salary_sum, age_salary_count = state
         age = resume.age
         gender = resume.gender
         if gender is not None and 10 < age < 80 and resume.area_id == 1:
@@ -315,10 +2109,46 @@ def show_age_salary_correlation(resumes):
             if resume.currency == 'RUR' and salary and salary < 150000:
                 age_salary_sum[age] += salary
                 age_salary_count[age] += 1
-                age = age + (random() - 0.5) * 2
-                salary = salary + (random() - 0.5) * 3000
-                x.append(age)
-                y.append(salary)
+                ages.append(age)
+                salaries.append(salary)
+        return state
+
+    return Accumulator(init, update, merge_state, identity)
+
+
+def get_age_salary_correlation(resumes):
+    return run_accumulator(age_salary_accumulator(), resumes)
+
+
+def get_age_salary_correlation_batch(columns, index=None):
+    age = take_column(columns.age, index)
+    gender = take_column(columns.gender, index)
+    area_id = take_column(columns.area_id, index)
+    currency = take_column(columns.currency, index)
+    salary = take_column(columns.salary, index)
+    # Comparisons with nan are False, so undefined salaries drop out
+    with np.errstate(invalid='ignore'):
+        selection = (
+            (gender != -1) & (age != -1) & (age > 10) & (age < 80)
+            & (area_id == 1)
+            & (currency == get_currency_code(columns, 'RUR'))
+            & (salary != 0) & (salary < 150000)
+        )
+    ages = age[selection]
+    salaries = salary[selection]
+    counts = np.bincount(ages)
+    sums = np.bincount(ages, weights=salaries)
+    keys = np.flatnonzero(counts)
+    age_salary_sum = Counter(dict(zip(keys.tolist(), sums[keys].tolist())))
+    age_salary_count = Counter(dict(zip(keys.tolist(), counts[keys].tolist())))
+    return ages, salaries, age_salary_sum, age_salary_count
+
+
+def plot_age_salary_correlation(ages, salaries, age_salary_sum,
+                                age_salary_count, path):
+    size = len(ages)
+    x = np.asarray(ages) + (np.random.random(size) - 0.5) * 2
+    y = np.asarray(salaries) + (np.random.random(size) - 0.5) * 3000
     fig, ax = plt.subplots()
     ax.scatter(x, y, linewidth=0, color='#4a71b2', alpha=0.01)
     x = []
@@ -334,35 +2164,76 @@ def show_age_salary_correlation(resumes):
     ax.set_xlabel(u'Возраст')
     ax.set_ylabel(u'Ожидаемая зарплата')
     fig.set_size_inches(6, 4)
-    fig.savefig('fig.png', dpi=300, bbox_inches='tight')
+    save_figure(fig, path)
+    return fig
+
+
+def show_age_salary_correlation(resumes, seed=None, path=None):
+    with measure_stage('show_age_salary_correlation', 'aggregate'):
+        if isinstance(resumes, ResumeColumns):
+            index = sample_resume_index(resumes, 500000, seed)
+            correlation = get_age_salary_correlation_batch(resumes, index)
+        else:
+            resumes = sample_stream(resumes, 500000, seed)
+            correlation = get_age_salary_correlation(resumes)
+    with measure_stage('show_age_salary_correlation', 'plot'):
+        return draw_figure('age_salary_correlation', correlation, path)
 
 
-def show_gender_salary_correlation(resumes):
-    genders = defaultdict(list)
-    for resume in sample(resumes, 300000):
+def get_gender_salary_correlation(resumes):
+    genders = defaultdict(QuantileSketch)
+    for resume in resumes:
         gender = resume.gender
         salary = resume.salary
         if resume.area_id == 1 and gender is not None and salary and salary < 150000:
-            genders[gender].append(salary)
-    cap = max(len(_) for _ in genders.itervalues())
-    for gender, salaries in genders.iteritems():
-        size = len(salaries)
-        update = [None] * (cap - size)
-        salaries.extend(update)
-        genders[gender] = salaries
-    table = pd.DataFrame(genders)
+            genders[gender].update(salary)
+    return genders
+
+
+def get_gender_salary_correlation_batch(columns, index=None):
+    gender = take_column(columns.gender, index)
+    area_id = take_column(columns.area_id, index)
+    salary = take_column(columns.salary, index)
+    with np.errstate(invalid='ignore'):
+        selection = (
+            (area_id == 1) & (gender != -1)
+            & (salary != 0) & (salary < 150000)
+        )
+    gender = gender[selection]
+    salary = salary[selection]
+    # Exact box stats are cheap on arrays, no sketch needed
+    genders = {}
+    for value in np.unique(gender).tolist():
+        genders[value] = salary[gender == value]
+    return genders
+
+
+def plot_gender_salary_correlation(genders, path):
     fig, ax = plt.subplots()
-    table.plot(kind='box', ax=ax)
+    plot_box_stats(ax, genders, sorted(genders))
     ax.set_ylim(0, 110000)
     ax.set_xticklabels([u'Мужчины', u'Женщины'])
     ax.set_ylabel(u'Ожидаемая зарплата')
     fig.set_size_inches(6, 4)
-    fig.savefig('fig.png', dpi=300, bbox_inches='tight')
+    save_figure(fig, path)
+    return fig
+
+
+def show_gender_salary_correlation(resumes, seed=None, path=None):
+    with measure_stage('show_gender_salary_correlation', 'aggregate'):
+        if isinstance(resumes, ResumeColumns):
+            index = sample_resume_index(resumes, 300000, seed)
+            genders = get_gender_salary_correlation_batch(resumes, index)
+        else:
+            resumes = sample_stream(resumes, 300000, seed)
+            genders = get_gender_salary_correlation(resumes)
+    with measure_stage('show_gender_salary_correlation', 'plot'):
+        return draw_figure('gender_salary_correlation', (genders,), path)
 
 
-def load_school_universities(cap=10):
+def load_school_universities(cap=10, path=SCHOOLS):
     universities = defaultdict(Counter)
-    with open(SCHOOLS) as file:
+    with open(path) as file:
         data = json.load(file)
         for school in data:
             name = school['name']
@@ -393,366 +2264,1706 @@ def parse_university_filename(filename):
     return decode_university(code)
 
 
-def list_university_cache():
-    for filename in os.listdir(UNIVERSITIES_DIR):
+def list_university_directory(dir=UNIVERSITIES_DIR):
+    for filename in os.listdir(dir):
         yield parse_university_filename(filename)
 
 
-def get_university_path(university):
+def get_university_path(university, dir=UNIVERSITIES_DIR):
     filename = get_university_filename(university)
-    return os.path.join(UNIVERSITIES_DIR, filename)
+    return os.path.join(dir, filename)
 
 
-def download_university_suggest(university):
-    response = requests.get(
-        'https://api.hh.ru/suggests/educational_institutions',
-        params={
-            'text': university
-        }
-    )
-    return response.json()
+def read_university_directory(dir=UNIVERSITIES_DIR):
+    items = []
+    for university in list_university_directory(dir):
+        with open(get_university_path(university, dir)) as file:
+            items.append((university, json.load(file)))
+    return items
 
 
-def dump_university(data, university):
-    path = get_university_path(university)
-    with open(path, 'w') as file:
-        json.dump(data, file)
+# Suggest cache is one SQLite table name -> json. Connection is opened
+# once per path and shared by fetcher threads under the lock
+UNIVERSITY_CACHES = {}
+UNIVERSITY_CACHE_LOCK = threading.RLock()
 
 
-def load_university(university):
-    path = get_university_path(university)
-    with open(path) as file:
-        return json.load(file)
+def get_university_cache(path=UNIVERSITIES_DB):
+    with UNIVERSITY_CACHE_LOCK:
+        connection = UNIVERSITY_CACHES.get(path)
+        if connection is None:
+            connection = sqlite3.connect(path, check_same_thread=False)
+            with connection:
+                connection.execute('''
+                    CREATE TABLE IF NOT EXISTS universities (
+                        name TEXT PRIMARY KEY,
+                        data TEXT NOT NULL
+                    )
+                ''')
+            UNIVERSITY_CACHES[path] = connection
+        return connection
 
 
-def load_university_names():
-    universities = {}
-    table = pd.read_excel(UNIVERSITIES)
-    for index, row in table.iterrows():
-        label, correct, name = row
-        if correct == '+':
-            if name in universities and label != universities[name]:
-                print >>sys.stderr, u'Labels colide for "{name}"'.format(name=name)
-            else:
-                universities[name] = label
-    return universities
-                
+def close_university_cache(path=UNIVERSITIES_DB):
+    with UNIVERSITY_CACHE_LOCK:
+        connection = UNIVERSITY_CACHES.pop(path, None)
+        if connection is not None:
+            connection.close()
 
-def get_specializations(vacancies):
-    specializations = {}
-    for vacancy in vacancies:
-        for specialization in vacancy.specializations:
-            specializations[specialization.id] = specialization
-    return specializations
 
+def list_university_cache(path=UNIVERSITIES_DB):
+    with UNIVERSITY_CACHE_LOCK:
+        rows = get_university_cache(path).execute(
+            'SELECT name FROM universities'
+        ).fetchall()
+    for name, in rows:
+        yield name
 
-def show_gender_specializations(resumes, specializations):
-    gender_specializations = defaultdict(Counter)
-    for resume in resumes:
-        gender = resume.gender
-        if gender is not None:
-            groups = {specializations[_].group.name for _ in resume.specializations}
-            for group in groups:
-                gender_specializations[gender][group] += 1
-    table = pd.DataFrame({
-        0: gender_specializations[0],
-        1: gender_specializations[1]
-    })
-    table = table.div(table.sum(axis=1), axis=0)
-    order = table[0].sort_values().index
-    table = table.reindex(index=order)
-    fig, ax = plt.subplots()
-    table.plot(kind='bar', ax=ax)
-    ax.set_ylabel(u'Доля пола внутри отрасли')
-    fig.set_size_inches(12, 4)
-    fig.savefig('fig.png', dpi=300, bbox_inches='tight')
 
+class RateLimiter(object):
+    # Spaces calls at least 1 / rate seconds apart across threads, rate
+    # of 0 or less does not limit
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next = time()
+        self.lock = threading.Lock()
 
-def show_vacancy_resume_specializations(vacancies, resumes, specializations):
-    vacancy_specializations = Counter()
-    for vacancy in vacancies:
-        groups = {_.group.name for _ in vacancy.specializations}
-        for group in groups:
-            vacancy_specializations[group] += 1
-    resume_specializations = Counter()
-    for resume in resumes:
-        groups = {specializations[_].group.name for _ in resume.specializations}
-        for group in groups:
-            resume_specializations[group] += 1
-    table = pd.DataFrame({
-        u'Вакансии': vacancy_specializations,
-        u'Резюме': resume_specializations
-       })
-    table = table.div(table.sum(axis=0), axis=1)
-    order = table[u'Резюме'].sort_values(ascending=False).index
-    table = table.reindex(index=order)
-    fig, ax = plt.subplots()
-    table.plot(kind='bar', ax=ax)
-    ax.set_ylabel(u'Доля вакансий и доля резюме по отраслям')
-    fig.set_size_inches(12, 4)
-    fig.savefig('fig.png', dpi=300, bbox_inches='tight')
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            sleep(start - now)
 
 
-def show_vacancy_salary_bounds_distribution(vacancies):
-    counts = Counter()
-    for vacancy in vacancies:
-        salary = vacancy.salary
-        if salary is not None:
-            counts[salary.min is not None, salary.max is not None] += 1
-        else:
-            counts[False, False] += 1
-    table = pd.Series(counts)
-    fig, ax = plt.subplots()
-    table.plot(kind='bar', ax=ax)
-    ax.set_ylabel(u'Число вакансий')
-    ax.set_xticklabels([u'Не указано', u'До', u'От', u'От ... До'])
+def get_university_session(threads=1):
+    # One pool of keep-alive connections shared by all threads
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=threads
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
-def show_vacancy_salary_model(vacancies):
-    mins = []
-    maxes = []
-    min_sum = Counter()
-    min_count = Counter()
-    for vacancy in vacancies:
-        salary = vacancy.salary
-        if salary:
-            min = salary.min
-            max = salary.max
-            if min is not None and max is not None and max < 150000:
-                min_sum[min] += max
-                min_count[min] += 1
-                min = min + (random() - 0.5) * 3000
-                max = max + (random() - 0.5) * 3000
-                mins.append(min)
-                maxes.append(max)
-    fig, ax = plt.subplots()
-    ax.scatter(mins, maxes, linewidth=0, color='#4a71b2', alpha=0.01)
-    x = []
-    y = []
-    for min in sorted(min_sum):
-        count = min_count[min]
-        if count > 100:
-            mean = float(min_sum[min]) / count
-            x.append(min)
-            y.append(mean)
-    ax.plot(x, y, linewidth=1, color='#ff0000')
-    ax.set_xlim(0, 115000)
-    ax.set_ylim(0, None)
-    ax.set_xlabel(u'Нижняя граница зарплаты')
-    ax.set_ylabel(u'Верхняя граница зарплаты')
+def download_university_suggest(university, session=requests,
+                                url=UNIVERSITY_SUGGEST_URL, limiter=None,
+                                retries=3, backoff=1.0, timeout=30):
+    # Connection errors, 429, 5xx and malformed bodies (ValueError) are
+    # retried after backoff * 2 ** n seconds. Other 4xx bodies are api
+    # errors for bad names, they are returned to be cached like results
+    for attempt in xrange(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            response = session.get(
+                url,
+                params={
+                    'text': university
+                },
+                timeout=timeout
+            )
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError):
+            if attempt == retries:
+                raise
+            sleep(backoff * 2 ** attempt)
 
 
-def get_mean_salary(salary):
-    min = salary.min
-    max = salary.max
-    if min is None:
-        if max < 60000:
-            min = max - 10000
-        else:
-            min = max - 20000
-    elif max is None:
-        if min < 50000:
-            max = min + 10000
-        else:
-            max = min + 20000
-    return float(min + max) / 2
+def dump_universities(items, path=UNIVERSITIES_DB):
+    rows = [
+        (university, json.dumps(data))
+        for university, data in items
+    ]
+    with UNIVERSITY_CACHE_LOCK:
+        connection = get_university_cache(path)
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO universities VALUES (?, ?)',
+                rows
+            )
 
 
-def show_vacancy_resume_salaries(vacancies, resumes, specializations):
-    vacancy_salaries_sum = Counter()
-    vacancy_salaries_count = Counter()
-    for vacancy in vacancies:
-        if vacancy.area_id == 1:
-            salary = vacancy.salary
-            if salary is not None:
-                salary = get_mean_salary(salary)
-                groups = {_.group.name for _ in vacancy.specializations}
-                for group in groups:
-                    vacancy_salaries_sum[group] += salary
-                    vacancy_salaries_count[group] += 1
-    vacancy_salaries = {
-        group: float(vacancy_salaries_sum[group]) / vacancy_salaries_count[group]
-        for group in vacancy_salaries_sum
-    }
-    resume_salaries_sum = Counter()
-    resume_salaries_count = Counter()
-    for resume in resumes:
-        age = resume.age
-        if resume.area_id == 1 and age and age > 30:
-            salary = resume.salary
-            if salary is not None and salary < 150000:
-                groups = {
-                    specializations[_].group.name for _ in resume.specializations
-                }
-                for group in groups:
-                    resume_salaries_sum[group] += salary
-                    resume_salaries_count[group] += 1
-    resume_salaries = {
-        group: float(resume_salaries_sum[group]) / resume_salaries_count[group]
-        for group in resume_salaries_sum
-    }
-    table = pd.DataFrame({
-        'resumes': resume_salaries,
-        'vacancies': vacancy_salaries
-    })
-    order = table['vacancies'].sort_values(ascending=False).index
-    table = table.reindex(index=order)
-    fig, ax = plt.subplots()
-    table.plot(kind='bar', ax=ax)
-    ax.set_ylabel(u'Зарплата в резюме и в вакансиях')
+def dump_university(data, university, path=UNIVERSITIES_DB):
+    dump_universities([(university, data)], path)
 
 
-def get_russian_areas(areas):
-    id_areas = {_.id: _ for _ in areas}
-    russian_areas = {}
-    for area in areas:
-        id = area.id
-        if area.level == 2:     # Town
-            parent = id_areas[area.parent_id]
-            if parent.parent_id == 113:  # Russia
-                russian_areas[id] = parent
-        elif area.level == 1 and area.parent_id == 113: # Msk and Spb
-            russian_areas[id] = area
-    return russian_areas
+def load_university(university, path=UNIVERSITIES_DB):
+    with UNIVERSITY_CACHE_LOCK:
+        row = get_university_cache(path).execute(
+            'SELECT data FROM universities WHERE name = ?',
+            (university,)
+        ).fetchone()
+    if row is None:
+        raise KeyError(university)
+    return json.loads(row[0])
 
 
-def show_geography_salary(resumes, russian_areas):
-    areas = defaultdict(list)
-    for resume in sample(resumes, 1000000):
-        area = russian_areas.get(resume.area_id)
-        if area:
-            area = area.name
-            salary = resume.salary
-            if salary and salary < 150000:
-                areas[area].append(salary)
-    cap = max(len(_) for _ in areas.itervalues())
-    for area, salaries in areas.iteritems():
-        size = len(salaries)
-        update = [None] * (cap - size)
-        salaries.extend(update)
-        areas[area] = salaries
-    table = pd.DataFrame(areas)
-    order = table.mean(axis=0) - table.std(axis=0)
-    order = order.sort_values(ascending=False).index
-    order = order[:30]
-    table = table.reindex(columns=order)
-    fig, ax = plt.subplots()
-    table.plot(kind='box', ax=ax)
-    ax.set_ylim(0, 115000)
-    ax.set_xticklabels(order, rotation=90)
-    ax.set_ylabel(u'Ожидаемая зарплата')
-    fig.set_size_inches(12, 4)
-    fig.savefig('fig.png', dpi=300, bbox_inches='tight')
+def load_universities(path=UNIVERSITIES_DB):
+    # Whole cache in one query
+    with UNIVERSITY_CACHE_LOCK:
+        rows = get_university_cache(path).execute(
+            'SELECT name, data FROM universities'
+        ).fetchall()
+    return {name: json.loads(data) for name, data in rows}
 
 
-def show_university_salary(resumes, university_names):
-    universities = defaultdict(list)
-    for resume in resumes:
-        age = resume.age
-        if age and age > 25 and resume.area_id == 1:
-            for education in resume.educations:
-                university = university_names.get(education)
-                if university:
-                    salary = resume.salary
-                    if salary and salary < 150000:
-                        universities[university].append(salary)
-    cap = max(len(_) for _ in universities.itervalues())
-    for university, salaries in universities.iteritems():
-        size = len(salaries)
-        update = [None] * (cap - size)
-        salaries.extend(update)
-        universities[university] = salaries
-    table = pd.DataFrame(universities)
-    order = [
-        u'МГУ',
-        u'МГТУ им. Баумана',
-        u'МПГУ',
-        u'РЭА им.Плеханова',
-        u'ГУУ',
-        u'МАИ',
-        u'МГПУ',
-        u'РУДН',
-        u'ГУ-ВШЭ',
-        u'МЭСИ',
-        u'РГГУ',
-        u'ММА им. Сеченова',
-        u'МИРЭА',
-        u'МГИМО (у) МИД РФ',
-        u'МГСУ-МИСИ',
-        u'МАДИ',
-        u'МИИТ',
-        u'МИФИ',
-        u'РГСУ',
-        u'МГЛУ',
-        u'МЭИ',
-        u'МГИУ',
-        u'МАТИ',
-        u'МФПА',
-        u'МГУПИ',
-        u'МГОПУ им.Шолохова',
-        u'МФЮА',
-        u'МТУСИ',
-        u'МГТУ МАМИ',
-        u'РГТЭУ',
-        u'МГЮА',
-    ]
-    table = table.reindex(columns=order)
-    fig, ax = plt.subplots()
-    table.plot(kind='box', ax=ax)
-    ax.set_ylim(0, 115000)
-    ax.set_xticklabels(order, rotation=90)
-    ax.set_ylabel(u'Ожидаемая зарплата')
-    fig.set_size_inches(12, 4)
-    fig.savefig('fig.png', dpi=300, bbox_inches='tight')
+def read_university_cache(path=UNIVERSITIES_DB):
+    # Like load_universities but only reads, the file and the table are
+    # never created
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute(
+            'SELECT name, data FROM universities'
+        ).fetchall()
+    finally:
+        connection.close()
+    return {name: json.loads(data) for name, data in rows}
 
 
-def shorten_string(string, cap=20):
-    if len(string) <= cap:
-        return string
-    else:
-        return string[:cap] + '...'
+def load_university_suggests(path=UNIVERSITIES_DB, dir=UNIVERSITIES_DIR):
+    # Suggests for UniversityIndex: the cache, the old directory when
+    # there is no cache yet, None when neither exists. Analysis does not
+    # write, the cache is filled by universities and migrate-universities
+    if os.path.exists(path):
+        return read_university_cache(path)
+    if os.path.isdir(dir):
+        return dict(read_university_directory(dir))
 
 
-def show_geography_specializations(resumes, russian_areas, specializations):
-    geography_specializations = defaultdict(Counter)
-    for resume in resumes:
-        area = russian_areas.get(resume.area_id)
-        if area:
-            area = area.name
-            groups = {specializations[_].group.name for _ in resume.specializations}
-            for group in groups:
-                group = shorten_string(group)
-                geography_specializations[area][group] += 1
-    total = Counter()
-    order = Counter()
+def load_university_index(university_names, strings=None):
+    return UniversityIndex(
+        university_names,
+        load_university_suggests(),
+        strings
+    )
+
+
+def migrate_university_cache(dir=UNIVERSITIES_DIR, path=UNIVERSITIES_DB):
+    # Copies the old one file per university directory into the SQLite
+    # cache, returns number of entries
+    items = read_university_directory(dir)
+    dump_universities(items, path)
+    return len(items)
+
+
+def fetch_university(task):
+    university, session, url, limiter, retries, backoff, path = task
+    try:
+        data = download_university_suggest(
+            university, session, url, limiter,
+            retries, backoff
+        )
+    except (requests.RequestException, ValueError) as error:
+        return university, error
+    dump_university(data, university, path)
+    return university, None
+
+
+def fetch_universities(universities, url=UNIVERSITY_SUGGEST_URL, threads=4,
+                       rate=5, retries=3, backoff=1.0, path=UNIVERSITIES_DB):
+    # Downloads suggests for universities missing from the cache, returns
+    # the ones that failed after all retries
+    cached = set(list_university_cache(path))
+    universities = sorted(set(universities) - cached)
+    session = get_university_session(threads)
+    limiter = RateLimiter(rate)
+    tasks = [
+        (university, session, url, limiter, retries, backoff, path)
+        for university in universities
+    ]
+    failed = []
+    pool = ThreadPool(threads)
+    try:
+        results = pool.imap_unordered(fetch_university, tasks)
+        for university, error in log_progress(results, total=len(tasks)):
+            if error is not None:
+                print >>sys.stderr, u'Failed "{name}": {error}'.format(
+                    name=university,
+                    error=error
+                )
+                failed.append(university)
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+    return failed
+
+
+class UniversitySuggestHandler(BaseHTTPRequestHandler):
+    # Keep-alive like the real api, so pooled connections are reused
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            count = server.requests
+        if server.fail_every and count % server.fail_every == 0:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        text = query.get('text', [''])[0].decode('utf8')
+        status = 200
+        body = json.dumps({
+            'items': [{
+                'id': str(count),
+                'text': text
+            }]
+        })
+        if len(text) < 2:
+            # Real api rejects short texts
+            status = 400
+            body = json.dumps({
+                'errors': [{'type': 'bad_argument', 'value': 'text'}]
+            })
+        if server.malformed_every and count % server.malformed_every == 0:
+            # Cut off like a dropped proxy response
+            body = body[:len(body) // 2]
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UniversitySuggestStub(ThreadingMixIn, HTTPServer):
+    # Local stand-in for the suggest api. Every fail_every-th request gets
+    # 503 and every malformed_every-th a truncated body to exercise
+    # retries, texts shorter than 2 characters get 400 with an api error
+    daemon_threads = True
+
+    def __init__(self, port=0, fail_every=None, malformed_every=None):
+        HTTPServer.__init__(
+            self,
+            ('127.0.0.1', port),
+            UniversitySuggestHandler
+        )
+        self.fail_every = fail_every
+        self.malformed_every = malformed_every
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def get_url(self):
+        host, port = self.server_address
+        return 'http://{host}:{port}/suggests/educational_institutions'.format(
+            host=host,
+            port=port
+        )
+
+
+def start_university_suggest_stub(port=0, fail_every=None,
+                                  malformed_every=None):
+    server = UniversitySuggestStub(port, fail_every, malformed_every)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def parse_university_labels(table):
+    # Name -> label of rows marked "+", first label wins when a name has
+    # several. Such names go to collisions with all their labels
+    table = table.copy()
+    table.columns = ['label', 'correct', 'name']
+    table = table[table['correct'] == '+']
+    first = table.drop_duplicates('name')
+    labels = table.drop_duplicates(['name', 'label']).groupby('name')['label']
+    counts = labels.count()
+    collisions = [
+        {
+            'name': name,
+            'labels': list(labels.get_group(name)),
+            'kept': first['label'][first['name'] == name].iloc[0]
+        }
+        for name in counts[counts > 1].index
+    ]
+    return {
+        'names': dict(zip(first['name'], first['label'])),
+        'collisions': collisions
+    }
+
+
+def load_university_labels(path=UNIVERSITY_NAMES, source=UNIVERSITIES):
+    # Parsed label table cached next to the xlsx, Excel is read only when
+    # the file changes
+    cache = read_cache(path, UNIVERSITY_NAMES_VERSION)
+    valid, stamp = check_cache(cache, source)
+    if not valid:
+        cache = parse_university_labels(pd.read_excel(source))
+        cache['version'] = UNIVERSITY_NAMES_VERSION
+    if stamp is not None:
+        cache['source'] = stamp
+        write_cache(cache, path)
+    return cache
+
+
+def load_university_names():
+    return load_university_labels()['names']
+
+
+def get_university_collisions():
+    return load_university_labels()['collisions']
+
+
+UNIVERSITY_NAME_PUNCTUATION = re.compile(ur'[\s.,:;()"\'«»„“”-]+', re.UNICODE)
+
+
+def normalize_university_name(name):
+    # Case, ё, quotes and punctuation vary between spellings
+    name = name.lower().replace(u'ё', u'е')
+    return UNIVERSITY_NAME_PUNCTUATION.sub(u' ', name).strip()
+
+
+def get_university_name_variants(name):
+    yield name
+    # Labeled names are suggest texts that end with ", City", resumes
+    # often omit it
+    if u',' in name:
+        yield name.rsplit(u',', 1)[0]
+
+
+class UniversityIndex(object):
+    # Maps education strings to integer ids of university labels, -1 for
+    # no match. Ids are 'university' codes of the string table. Keys are
+    # normalized labeled names, their versions without city and, with
+    # suggests, acronyms of labeled items. Variant that points to
+    # several labels is dropped
+    def __init__(self, university_names, suggests=None, strings=None):
+        if strings is None:
+            strings = StringTable()
+        codes = strings.encode_all('university', university_names.values())
+        self.labels = strings.get_strings('university')
+        names = {}
+        variants = defaultdict(set)
+        for name, label in university_names.iteritems():
+            id = codes[label]
+            names[normalize_university_name(name)] = id
+            for variant in get_university_name_variants(name):
+                variants[normalize_university_name(variant)].add(id)
+        if suggests:
+            for data in suggests.itervalues():
+                # Cache also holds api errors for bad names
+                for item in data.get('items', ()):
+                    label = university_names.get(item['text'])
+                    if label is not None and item.get('acronym'):
+                        acronym = normalize_university_name(item['acronym'])
+                        variants[acronym].add(codes[label])
+        self.ids = {
+            key: ids.pop()
+            for key, ids in variants.iteritems()
+            if len(ids) == 1
+        }
+        self.ids.update(names)
+        self.ids.pop(u'', None)
+        self.memo = {}
+
+    def get_id(self, education):
+        id = self.memo.get(education)
+        if id is None:
+            id = self.ids.get(normalize_university_name(education), -1)
+            self.memo[education] = id
+        return id
+
+    def get_ids(self, educations):
+        return np.array(
+            [self.get_id(_) for _ in educations],
+            dtype=np.int32
+        )
+
+    def get_education_ids(self, columns):
+        # Educations column is dictionary coded, so only distinct names
+        # are matched and the rest is a gather
+        ids = self.get_ids(columns.education_names)
+        return ids[np.asarray(columns.educations)]
+
+
+def get_specializations(vacancies):
+    specializations = {}
+    for vacancy in vacancies:
+        for specialization in vacancy.specializations:
+            specializations[specialization.id] = specialization
+    return specializations
+
+
+def get_file_stamp(path):
+    stat = os.stat(path)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime
+    }
+
+
+def get_file_hash(path):
+    hash = hashlib.sha1()
+    for chunk in iterate_chunks(path, chunksize=1024 * 1024):
+        hash.update(chunk)
+    return hash.hexdigest()
+
+
+def read_cache(path, version):
+    if not os.path.exists(path):
+        return
+    with open(path) as file:
+        cache = json.load(file)
+    if cache.get('version') == version:
+        return cache
+
+
+def write_cache(data, path):
+    # Readers never see a half written cache
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(data, file)
+    os.rename(temporary, path)
+
+
+def check_cache(cache, path):
+    # Whether cache was built from current content of path and new stamp
+    # of path if cache has to be written again. Size and mtime are
+    # checked first, hash confirms the change
+    source = get_file_stamp(path)
+    if cache is not None:
+        cached = cache['source']
+        if (cached['size'] == source['size']
+                and cached['mtime'] == source['mtime']):
+            return True, None
+    source['sha1'] = get_file_hash(path)
+    valid = cache is not None and cache['source']['sha1'] == source['sha1']
+    return valid, source
+
+
+def dump_specializations(specializations, source, path=SPECIALIZATIONS):
+    write_cache({
+        'version': SPECIALIZATIONS_VERSION,
+        'source': source,
+        'specializations': [
+            [_.group.id, _.group.name, _.id, _.name]
+            for _ in specializations.itervalues()
+        ]
+    }, path)
+
+
+def parse_cached_specializations(data):
+    specializations = {}
+    for group_id, group_name, id, name in data['specializations']:
+        group = Profarea(group_id, group_name)
+        specializations[id] = Specialization(group, id, name)
+    return specializations
+
+
+def load_specializations(path=SPECIALIZATIONS, vacancies=VACANCIES):
+    # Same as get_specializations(read_vacancies()) but the full scan of
+    # vacancies happens only when the file changes
+    cache = read_cache(path, SPECIALIZATIONS_VERSION)
+    valid, source = check_cache(cache, vacancies)
+    if valid:
+        specializations = parse_cached_specializations(cache)
+    else:
+        specializations = get_specializations(read_vacancies(vacancies))
+    if source is not None:
+        dump_specializations(specializations, source, path)
+    return specializations
+
+
+def get_profarea_index(specializations, strings=None):
+    # Profarea codes are 'profarea' codes of the string table
+    if strings is None:
+        strings = StringTable()
+    codes = strings.encode_all(
+        'profarea',
+        [_.group.name for _ in specializations.itervalues()]
+    )
+    profareas = [None] * (max(specializations) + 1)
+    for id, specialization in specializations.iteritems():
+        profareas[id] = codes[specialization.group.name]
+    return ProfareaIndex(profareas, strings.get_strings('profarea'))
+
+
+def get_profarea_column(columns, profarea_index):
+    # One gather over the specialization column: rows and profarea codes
+    # of unique (resume, profarea) pairs
+    profareas = np.array(
+        [-1 if _ is None else _ for _ in profarea_index.profareas],
+        dtype=np.int32
+    )
+    offsets = np.asarray(columns.specialization_offsets)
+    values = profareas[np.asarray(columns.specializations)]
+    if (values == -1).any():
+        raise KeyError('Unknown specializations')
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    size = len(profarea_index.names)
+    pairs = np.unique(rows.astype(np.int64) * size + values)
+    return pairs // size, pairs % size
+
+
+def get_resume_specializations_batch(columns, profarea_index):
+    _, profareas = get_profarea_column(columns, profarea_index)
+    counts = np.bincount(profareas, minlength=len(profarea_index.names))
+    return Counter({
+        profarea_index.names[code]: count
+        for code, count in enumerate(counts.tolist())
+        if count
+    })
+
+
+def get_gender_specializations_batch(columns, profarea_index):
+    rows, profareas = get_profarea_column(columns, profarea_index)
+    genders = np.asarray(columns.gender)[rows]
+    gender_specializations = defaultdict(Counter)
+    for gender in np.unique(genders[genders != -1]).tolist():
+        counts = np.bincount(
+            profareas[genders == gender],
+            minlength=len(profarea_index.names)
+        )
+        gender_specializations[gender] = Counter({
+            profarea_index.names[code]: count
+            for code, count in enumerate(counts.tolist())
+            if count
+        })
+    return gender_specializations
+
+
+def identity(value):
+    return value
+
+
+def merge_counters(counter, other):
+    counter.update(other)
+    return counter
+
+
+def merge_counter_tables(table, other):
+    for key, counter in other.iteritems():
+        table[key].update(counter)
+    return table
+
+
+def merge_list_tables(table, other):
+    for key, values in other.iteritems():
+        table[key].extend(values)
+    return table
+
+
+def merge_sketch_tables(table, other):
+    for key, sketch in other.iteritems():
+        table[key].merge(sketch)
+    return table
+
+
+def merge_state(state, other):
+    if isinstance(state, tuple):
+        return tuple(merge_state(*_) for _ in zip(state, other))
+    elif isinstance(state, Counter):
+        return merge_counters(state, other)
+    elif isinstance(state, defaultdict) and state.default_factory is Counter:
+        return merge_counter_tables(state, other)
+    elif isinstance(state, defaultdict) and state.default_factory is list:
+        return merge_list_tables(state, other)
+    elif (isinstance(state, defaultdict)
+          and state.default_factory is QuantileSketch):
+        return merge_sketch_tables(state, other)
+    elif isinstance(state, list):
+        state.extend(other)
+        return state
+    raise TypeError('Can not merge {type}'.format(type=type(state)))
+
+
+def pack_values(values):
+    values = np.array(values)
+    return {
+        'dtype': values.dtype.str,
+        'data': values.tobytes()
+    }
+
+
+def unpack_values(data):
+    dtype = np.dtype(data['dtype'])
+    return np.frombuffer(data['data'], dtype=dtype).tolist()
+
+
+def pack_sketch(sketch):
+    return {
+        'size': sketch.size,
+        'count': sketch.count,
+        'total': sketch.total,
+        'squares': sketch.squares,
+        'min': sketch.min,
+        'max': sketch.max,
+        'compactors': [pack_values(_) for _ in sketch.compactors]
+    }
+
+
+def unpack_sketch(data):
+    sketch = QuantileSketch(data['size'])
+    for _ in data['compactors'][1:]:
+        sketch.grow()
+    sketch.compactors = [unpack_values(_) for _ in data['compactors']]
+    sketch.retained = sum(len(_) for _ in sketch.compactors)
+    sketch.count = data['count']
+    sketch.total = data['total']
+    sketch.squares = data['squares']
+    sketch.min = data['min']
+    sketch.max = data['max']
+    return sketch
+
+
+def pack_state(state):
+    # Plain msgpack maps and typed arrays, the type of state is restored
+    # from the init() template in unpack_state
+    if isinstance(state, tuple):
+        return [pack_state(_) for _ in state]
+    elif isinstance(state, Counter):
+        keys = list(state)
+        return {
+            'keys': keys,
+            'values': pack_values([state[_] for _ in keys])
+        }
+    elif isinstance(state, defaultdict) and state.default_factory is Counter:
+        # Sparse table as (row, column, value) triplets
+        columns = {}
+        rows = []
+        row_codes = []
+        column_codes = []
+        values = []
+        for row, counter in state.iteritems():
+            code = len(rows)
+            rows.append(row)
+            for column, value in counter.iteritems():
+                row_codes.append(code)
+                column_codes.append(encode_string(columns, column))
+                values.append(value)
+        return {
+            'rows': rows,
+            'columns': get_string_table(columns),
+            'row': pack_values(np.array(row_codes, dtype=np.int32)),
+            'column': pack_values(np.array(column_codes, dtype=np.int32)),
+            'values': pack_values(values)
+        }
+    elif isinstance(state, defaultdict) and state.default_factory is list:
+        keys = list(state)
+        offsets = [0]
+        values = []
+        for key in keys:
+            values.extend(state[key])
+            offsets.append(len(values))
+        return {
+            'keys': keys,
+            'offsets': pack_values(np.array(offsets, dtype=np.int64)),
+            'values': pack_values(values)
+        }
+    elif (isinstance(state, defaultdict)
+          and state.default_factory is QuantileSketch):
+        keys = list(state)
+        return {
+            'keys': keys,
+            'sketches': [pack_sketch(state[_]) for _ in keys]
+        }
+    elif isinstance(state, list):
+        return pack_values(state)
+    raise TypeError('Can not pack {type}'.format(type=type(state)))
+
+
+def unpack_state(template, data):
+    if isinstance(template, tuple):
+        return tuple(unpack_state(*_) for _ in zip(template, data))
+    elif isinstance(template, Counter):
+        template.update(dict(zip(data['keys'], unpack_values(data['values']))))
+        return template
+    elif isinstance(template, defaultdict) and template.default_factory is Counter:
+        rows = data['rows']
+        columns = data['columns']
+        for row, column, value in zip(
+                unpack_values(data['row']),
+                unpack_values(data['column']),
+                unpack_values(data['values'])):
+            template[rows[row]][columns[column]] = value
+        return template
+    elif isinstance(template, defaultdict) and template.default_factory is list:
+        offsets = unpack_values(data['offsets'])
+        values = unpack_values(data['values'])
+        for index, key in enumerate(data['keys']):
+            template[key] = values[offsets[index]:offsets[index + 1]]
+        return template
+    elif (isinstance(template, defaultdict)
+          and template.default_factory is QuantileSketch):
+        for key, sketch in zip(data['keys'], data['sketches']):
+            template[key] = unpack_sketch(sketch)
+        return template
+    elif isinstance(template, list):
+        template.extend(unpack_values(data))
+        return template
+    raise TypeError('Can not unpack {type}'.format(type=type(template)))
+
+
+def dump_accumulated(accumulators, states, strings):
+    # States hold profarea and university codes, dump keeps the string
+    # table they were coded with
+    data = {
+        'version': PARTITIONS_VERSION,
+        'strings': strings.get_tables(),
+        'states': {
+            name: pack_state(states[name])
+            for name in accumulators
+        }
+    }
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def load_accumulated(accumulators, dump, strings):
+    # Codes are not remapped, dump must be coded with strings or with an
+    # earlier state of it
+    data = msgpack.unpackb(dump, raw=False)
+    if (not isinstance(data, dict)
+            or data.get('version') != PARTITIONS_VERSION
+            or not strings.is_extension(data['strings'])):
+        raise ValueError('Dump is coded with another string table')
+    return {
+        name: unpack_state(accumulator.init(), data['states'][name])
+        for name, accumulator in accumulators.iteritems()
+    }
+
+
+def dump_partial(accumulators, states, path, strings):
+    with open(path, 'wb') as file:
+        file.write(dump_accumulated(accumulators, states, strings))
+
+
+def load_partial(accumulators, path, strings):
+    with open(path, 'rb') as file:
+        return load_accumulated(accumulators, file.read(), strings)
+
+
+def merge_partials(accumulators, paths, strings):
+    # Partials of shards computed on different workers or machines, all
+    # coded with one shared string table
+    states = None
+    for path in paths:
+        partial = load_partial(accumulators, path, strings)
+        if states is None:
+            states = partial
+        else:
+            states = merge_accumulated(accumulators, states, partial)
+    return states
+
+
+# Incremental store: every new raw export, or new tail of a raw file,
+# becomes an append-only partition, converted resumes plus their report
+# partial. Manifest records partitions and how far every raw file was
+# processed. Partials are coded with the global string table and
+# depend on the report dictionaries: specializations, regions,
+# university names and suggests. Manifest keeps the table and a hash of
+# the dictionaries, when the table is replaced or any dictionary changes
+# partials are recomputed from partition resumes
+
+
+def get_partition_path(name, extension, dir=PARTITIONS):
+    return os.path.join(dir, '{name}.{extension}'.format(
+        name=name,
+        extension=extension
+    ))
+
+
+def get_partitions_manifest_path(dir=PARTITIONS):
+    return os.path.join(dir, 'manifest.json')
+
+
+def load_partitions_manifest(dir=PARTITIONS):
+    manifest = read_cache(
+        get_partitions_manifest_path(dir),
+        PARTITIONS_VERSION
+    )
+    if manifest is None:
+        manifest = {
+            'version': PARTITIONS_VERSION,
+            'sources': {},
+            'partitions': [],
+            'strings': None,
+            'dictionaries': None,
+            'next': 0
+        }
+    return manifest
+
+
+def get_resume_tail_hash(path, stop, size=4096):
+    # Hash of bytes right before stop, tells whether the processed part
+    # of a raw file is still the same
+    with open(path, 'rb') as file:
+        start = max(stop - size, 0)
+        file.seek(start)
+        return hashlib.sha1(file.read(stop - start)).hexdigest()
+
+
+def get_resume_source_start(source, path):
+    if source is None:
+        return 0
+    stop = source['stop']
+    if (os.path.getsize(path) >= stop
+            and get_resume_tail_hash(path, stop) == source['tail_sha1']):
+        return stop
+
+
+def update_partitions(paths, dir=PARTITIONS, processes=None,
+                      dictionaries=None, strings_path=STRINGS):
+    # Converts and aggregates only what is new in raw files, then merges
+    # new partials into the report. Returns names of new partitions
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    manifest = load_partitions_manifest(dir)
+    if dictionaries is None:
+        dictionaries = load_report_dictionaries()
+    dictionaries_hash = get_dictionaries_hash(dictionaries)
+    accumulators, strings = load_report_accumulators(
+        dictionaries,
+        strings_path
+    )
+    partitions = manifest['partitions']
+    report = os.path.join(dir, 'report.msgpack')
+    rebuild = not os.path.exists(report)
+    if (manifest['strings'] is None
+            or not strings.is_extension(manifest['strings'])
+            or manifest['dictionaries'] != dictionaries_hash):
+        # New manifest, strings.json was replaced and codes of old
+        # partials mean other strings, or resumes now count elsewhere
+        for partition in partitions:
+            name = partition['name']
+            states = accumulate(
+                accumulators,
+                load_resumes(get_partition_path(name, 'json', dir))
+            )
+            dump_partial(
+                accumulators,
+                states,
+                get_partition_path(name, 'msgpack', dir),
+                strings
+            )
+        rebuild = True
+    created = []
+    for path in paths:
+        path = os.path.abspath(path)
+        source = manifest['sources'].get(path)
+        start = get_resume_source_start(source, path)
+        if start is None:
+            # Raw file changed before the processed offset
+            for partition in partitions:
+                if partition['source'] == path:
+                    for extension in ('json', 'msgpack'):
+                        os.remove(get_partition_path(
+                            partition['name'],
+                            extension,
+                            dir
+                        ))
+            partitions = [_ for _ in partitions if _['source'] != path]
+            rebuild = True
+            start = 0
+        name = 'part-{index:05d}'.format(index=manifest['next'])
+        target = get_partition_path(name, 'json', dir)
+        stop, count = convert_resumes(path, target, processes, start=start)
+        if not count:
+            os.remove(target)
+            continue
+        states = accumulate(accumulators, load_resumes(target))
+        partial = get_partition_path(name, 'msgpack', dir)
+        dump_partial(accumulators, states, partial, strings)
+        partitions.append({
+            'name': name,
+            'source': path,
+            'start': start,
+            'stop': stop,
+            'resumes': count
+        })
+        manifest['sources'][path] = {
+            'stop': stop,
+            'tail_sha1': get_resume_tail_hash(path, stop)
+        }
+        manifest['next'] += 1
+        created.append(name)
+
+    if rebuild:
+        names = [_['name'] for _ in partitions]
+        partials = [get_partition_path(_, 'msgpack', dir) for _ in names]
+    else:
+        partials = [report] + [
+            get_partition_path(_, 'msgpack', dir)
+            for _ in created
+        ]
+    if rebuild or created:
+        states = merge_partials(accumulators, partials, strings)
+        if states is None:
+            states = {
+                name: accumulator.init()
+                for name, accumulator in accumulators.iteritems()
+            }
+        dump_partial(accumulators, states, report, strings)
+    manifest['partitions'] = partitions
+    manifest['strings'] = strings.get_tables()
+    manifest['dictionaries'] = dictionaries_hash
+    write_cache(manifest, get_partitions_manifest_path(dir))
+    return created
+
+
+def load_partition_resumes(dir=PARTITIONS):
+    manifest = load_partitions_manifest(dir)
+    for partition in manifest['partitions']:
+        path = get_partition_path(partition['name'], 'json', dir)
+        for resume in load_resumes(path):
+            yield resume
+
+
+def load_partitions_report(dir=PARTITIONS, dictionaries=None,
+                           strings_path=STRINGS):
+    accumulators, strings = load_report_accumulators(
+        dictionaries,
+        strings_path
+    )
+    states = load_partial(
+        accumulators,
+        os.path.join(dir, 'report.msgpack'),
+        strings
+    )
+    return finalize_accumulated(accumulators, states)
+
+
+def accumulate(accumulators, resumes):
+    # One pass over resumes feeds every accumulator
+    names = list(accumulators)
+    updates = [accumulators[_].update for _ in names]
+    states = [accumulators[_].init() for _ in names]
+    indexes = range(len(names))
+    for resume in resumes:
+        for index in indexes:
+            states[index] = updates[index](states[index], resume)
+    return dict(zip(names, states))
+
+
+def merge_accumulated(accumulators, states, other):
+    return {
+        name: accumulator.merge(states[name], other[name])
+        for name, accumulator in accumulators.iteritems()
+    }
+
+
+def finalize_accumulated(accumulators, states):
+    return {
+        name: accumulator.finalize(states[name])
+        for name, accumulator in accumulators.iteritems()
+    }
+
+
+def run_accumulators(accumulators, resumes):
+    states = accumulate(accumulators, resumes)
+    return finalize_accumulated(accumulators, states)
+
+
+def run_accumulator(accumulator, resumes):
+    results = run_accumulators({None: accumulator}, resumes)
+    return results[None]
+
+
+def get_resume_profareas(resume, profareas):
+    # Negative ids would wrap around the list, so bounds are checked
+    # explicitly instead of catching IndexError
+    size = len(profareas)
+    groups = {
+        profareas[_] if 0 <= _ < size else None
+        for _ in resume.specializations
+    }
+    if None in groups:
+        raise KeyError(resume.specializations)
+    return groups
+
+
+def decode_keys(mapping, names):
+    return {names[key]: value for key, value in mapping.iteritems()}
+
+
+def decode_counter(counter, names):
+    return Counter(decode_keys(counter, names))
+
+
+def decode_counter_table(table, names):
+    decoded = defaultdict(Counter)
+    for key, counter in table.iteritems():
+        decoded[key] = decode_counter(counter, names)
+    return decoded
+
+
+def gender_specializations_accumulator(profarea_index):
+    profareas, names = profarea_index
+
+    def update(gender_specializations, resume):
+        gender = resume.gender
+        if gender is not None:
+            groups = get_resume_profareas(resume, profareas)
+            for group in groups:
+                gender_specializations[gender][group] += 1
+        return gender_specializations
+
+    return Accumulator(
+        lambda: defaultdict(Counter),
+        update,
+        merge_counter_tables,
+        lambda _: decode_counter_table(_, names)
+    )
+
+
+def plot_gender_specializations(gender_specializations, path):
+    table = pd.DataFrame({
+        0: gender_specializations[0],
+        1: gender_specializations[1]
+    })
+    table = table.div(table.sum(axis=1), axis=0)
+    order = table[0].sort_values().index
+    table = table.reindex(index=order)
+    fig, ax = plt.subplots()
+    table.plot(kind='bar', ax=ax)
+    ax.set_ylabel(u'Доля пола внутри отрасли')
+    fig.set_size_inches(12, 4)
+    save_figure(fig, path)
+    return fig
+
+
+def show_gender_specializations(resumes, specializations, path=None):
+    with measure_stage('show_gender_specializations', 'aggregate'):
+        profarea_index = get_profarea_index(specializations)
+        accumulator = gender_specializations_accumulator(profarea_index)
+        gender_specializations = run_accumulator(accumulator, resumes)
+    with measure_stage('show_gender_specializations', 'plot'):
+        return draw_figure(
+            'gender_specializations',
+            (gender_specializations,),
+            path
+        )
+
+
+def get_vacancy_specializations(vacancies):
+    vacancy_specializations = Counter()
+    for vacancy in vacancies:
+        groups = {_.group.name for _ in vacancy.specializations}
+        for group in groups:
+            vacancy_specializations[group] += 1
+    return vacancy_specializations
+
+
+def get_vacancy_profarea_column(columns):
+    # Rows and name codes of unique (vacancy, profarea name) pairs and
+    # the names. Group names may repeat across ids, vacancy counts once
+    # per name like in get_vacancy_specializations
+    offsets = np.asarray(columns.specialization_offsets)
+    ids = np.asarray(columns.profareas).astype(np.int64)
+    names = sorted(set(columns.profarea_names.itervalues()))
+    codes = {name: code for code, name in enumerate(names)}
+    table = np.zeros(int(ids.max()) + 1 if len(ids) else 1, dtype=np.int64)
+    for id, name in columns.profarea_names.iteritems():
+        table[id] = codes[name]
+    profareas = table[ids]
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    size = max(len(names), 1)
+    pairs = np.unique(rows * size + profareas)
+    return pairs // size, pairs % size, names
+
+
+def sum_profarea_values(names, profareas, weights=None):
+    counts = np.bincount(profareas, minlength=len(names))
+    values = np.bincount(profareas, weights=weights, minlength=len(names))
+    values = values.tolist()
+    return Counter({
+        names[code]: values[code]
+        for code in np.flatnonzero(counts).tolist()
+    })
+
+
+def get_vacancy_specializations_batch(columns):
+    _, profareas, names = get_vacancy_profarea_column(columns)
+    return sum_profarea_values(names, profareas)
+
+
+def resume_specializations_accumulator(profarea_index):
+    profareas, names = profarea_index
+
+    def update(resume_specializations, resume):
+        groups = get_resume_profareas(resume, profareas)
+        for group in groups:
+            resume_specializations[group] += 1
+        return resume_specializations
+
+    return Accumulator(
+        Counter,
+        update,
+        merge_counters,
+        lambda _: decode_counter(_, names)
+    )
+
+
+def plot_vacancy_resume_specializations(vacancy_specializations,
+                                        resume_specializations, path):
+    table = pd.DataFrame({
+        u'Вакансии': vacancy_specializations,
+        u'Резюме': resume_specializations
+       })
+    table = table.div(table.sum(axis=0), axis=1)
+    order = table[u'Резюме'].sort_values(ascending=False).index
+    table = table.reindex(index=order)
+    fig, ax = plt.subplots()
+    table.plot(kind='bar', ax=ax)
+    ax.set_ylabel(u'Доля вакансий и доля резюме по отраслям')
+    fig.set_size_inches(12, 4)
+    save_figure(fig, path)
+    return fig
+
+
+def show_vacancy_resume_specializations(vacancies, resumes, specializations,
+                                        path=None):
+    stage = 'show_vacancy_resume_specializations'
+    with measure_stage(stage, 'aggregate'):
+        profarea_index = get_profarea_index(specializations)
+        accumulator = resume_specializations_accumulator(profarea_index)
+        if isinstance(vacancies, VacancyColumns):
+            vacancy_specializations = get_vacancy_specializations_batch(
+                vacancies
+            )
+        else:
+            vacancy_specializations = get_vacancy_specializations(vacancies)
+        resume_specializations = run_accumulator(accumulator, resumes)
+    with measure_stage(stage, 'plot'):
+        return draw_figure(
+            'vacancy_resume_specializations',
+            (vacancy_specializations, resume_specializations),
+            path
+        )
+
+
+def get_vacancy_salary_bounds(vacancies):
+    counts = Counter()
+    for vacancy in vacancies:
+        salary = vacancy.salary
+        if salary is not None:
+            counts[salary.min is not None, salary.max is not None] += 1
+        else:
+            counts[False, False] += 1
+    return counts
+
+
+def get_vacancy_salary_bounds_batch(columns):
+    salary = take_column(columns.salary) == 1
+    has_min = salary & ~np.isnan(take_column(columns.salary_min))
+    has_max = salary & ~np.isnan(take_column(columns.salary_max))
+    counts = Counter()
+    for min in (False, True):
+        for max in (False, True):
+            count = int(((has_min == min) & (has_max == max)).sum())
+            if count:
+                counts[min, max] = count
+    return counts
+
+
+def plot_vacancy_salary_bounds_distribution(counts, path):
+    table = pd.Series(counts)
+    fig, ax = plt.subplots()
+    table.plot(kind='bar', ax=ax)
+    ax.set_ylabel(u'Число вакансий')
+    ax.set_xticklabels([u'Не указано', u'До', u'От', u'От ... До'])
+    save_figure(fig, path)
+    return fig
+
+
+def show_vacancy_salary_bounds_distribution(vacancies, path=None):
+    with measure_stage('show_vacancy_salary_bounds_distribution', 'aggregate'):
+        if isinstance(vacancies, VacancyColumns):
+            counts = get_vacancy_salary_bounds_batch(vacancies)
+        else:
+            counts = get_vacancy_salary_bounds(vacancies)
+    with measure_stage('show_vacancy_salary_bounds_distribution', 'plot'):
+        return draw_figure('vacancy_salary_bounds_distribution', (counts,), path)
+
+
+def vacancy_salary_model_accumulator():
+    def init():
+        return [], [], Counter(), Counter()
+
+    def update(state, vacancy):
+        mins, maxes, min_sum, min_count = state
+        salary = vacancy.salary
+        if salary:
+            min = salary.min
+            max = salary.max
+            if min is not None and max is not None and max < 150000:
+                min_sum[min] += max
+                min_count[min] += 1
+                mins.append(min)
+                maxes.append(max)
+        return state
+
+    return Accumulator(init, update, merge_state, identity)
+
+
+def get_vacancy_salary_model_batch(columns):
+    salary_min = take_column(columns.salary_min)
+    salary_max = take_column(columns.salary_max)
+    # nan bounds fail the comparison and drop out
+    with np.errstate(invalid='ignore'):
+        selection = ~np.isnan(salary_min) & (salary_max < 150000)
+    mins = salary_min[selection].astype(np.int64)
+    maxes = salary_max[selection].astype(np.int64)
+    keys, inverse, counts = np.unique(
+        mins,
+        return_inverse=True,
+        return_counts=True
+    )
+    sums = np.bincount(inverse, weights=maxes).astype(np.int64)
+    min_sum = Counter(dict(zip(keys.tolist(), sums.tolist())))
+    min_count = Counter(dict(zip(keys.tolist(), counts.tolist())))
+    return mins, maxes, min_sum, min_count
+
+
+def plot_vacancy_salary_model(mins, maxes, min_sum, min_count, path):
+    size = len(mins)
+    x = np.asarray(mins) + (np.random.random(size) - 0.5) * 3000
+    y = np.asarray(maxes) + (np.random.random(size) - 0.5) * 3000
+    fig, ax = plt.subplots()
+    ax.scatter(x, y, linewidth=0, color='#4a71b2', alpha=0.01)
+    x = []
+    y = []
+    for min in sorted(min_sum):
+        count = min_count[min]
+        if count > 100:
+            mean = float(min_sum[min]) / count
+            x.append(min)
+            y.append(mean)
+    ax.plot(x, y, linewidth=1, color='#ff0000')
+    ax.set_xlim(0, 115000)
+    ax.set_ylim(0, None)
+    ax.set_xlabel(u'Нижняя граница зарплаты')
+    ax.set_ylabel(u'Верхняя граница зарплаты')
+    save_figure(fig, path)
+    return fig
+
+
+def show_vacancy_salary_model(vacancies, path=None):
+    with measure_stage('show_vacancy_salary_model', 'aggregate'):
+        if isinstance(vacancies, VacancyColumns):
+            model = get_vacancy_salary_model_batch(vacancies)
+        else:
+            accumulator = vacancy_salary_model_accumulator()
+            model = run_accumulator(accumulator, vacancies)
+    with measure_stage('show_vacancy_salary_model', 'plot'):
+        return draw_figure('vacancy_salary_model', model, path)
+
+
+def get_mean_salary(salary):
+    min = salary.min
+    max = salary.max
+    if min is None:
+        if max < 60000:
+            min = max - 10000
+        else:
+            min = max - 20000
+    elif max is None:
+        if min < 50000:
+            max = min + 10000
+        else:
+            max = min + 20000
+    return float(min + max) / 2
+
+
+def get_mean_salaries(state):
+    salaries_sum, salaries_count = state
+    return {
+        group: float(salaries_sum[group]) / salaries_count[group]
+        for group in salaries_sum
+    }
+
+
+def vacancy_salaries_accumulator():
+    def init():
+        return Counter(), Counter()
+
+    def update(state, vacancy):
+        vacancy_salaries_sum, vacancy_salaries_count = state
+        if vacancy.area_id == 1:
+            salary = vacancy.salary
+            if salary is not None:
+                salary = get_mean_salary(salary)
+                groups = {_.group.name for _ in vacancy.specializations}
+                for group in groups:
+                    vacancy_salaries_sum[group] += salary
+                    vacancy_salaries_count[group] += 1
+        return state
+
+    return Accumulator(init, update, merge_state, get_mean_salaries)
+
+
+def get_vacancy_salaries(vacancies):
+    return run_accumulator(vacancy_salaries_accumulator(), vacancies)
+
+
+def get_vacancy_salaries_batch(columns):
+    rows, profareas, names = get_vacancy_profarea_column(columns)
+    area_id = take_column(columns.area_id)[rows]
+    salary = take_column(columns.salary)[rows]
+    selection = (area_id == 1) & (salary == 1)
+    rows = rows[selection]
+    profareas = profareas[selection]
+    # Same guesses for a missing bound as get_mean_salary
+    min = take_column(columns.salary_min)[rows]
+    max = take_column(columns.salary_max)[rows]
+    with np.errstate(invalid='ignore'):
+        min = np.where(
+            np.isnan(min),
+            np.where(max < 60000, max - 10000, max - 20000),
+            min
+        )
+        max = np.where(
+            np.isnan(max),
+            np.where(min < 50000, min + 10000, min + 20000),
+            max
+        )
+    sums = sum_profarea_values(names, profareas, (min + max) / 2)
+    counts = sum_profarea_values(names, profareas)
+    return get_mean_salaries((sums, counts))
+
+
+def resume_salaries_accumulator(profarea_index):
+    profareas, names = profarea_index
+
+    def init():
+        return Counter(), Counter()
+
+    def update(state, resume):
+        resume_salaries_sum, resume_salaries_count = state
+        age = resume.age
+        if resume.area_id == 1 and age and age > 30:
+            salary = resume.salary
+            if salary is not None and salary < 150000:
+                groups = get_resume_profareas(resume, profareas)
+                for group in groups:
+                    resume_salaries_sum[group] += salary
+                    resume_salaries_count[group] += 1
+        return state
+
+    def finalize(state):
+        return decode_keys(get_mean_salaries(state), names)
+
+    return Accumulator(init, update, merge_state, finalize)
+
+
+def plot_vacancy_resume_salaries(vacancy_salaries, resume_salaries,
+                                 path):
+    table = pd.DataFrame({
+        'resumes': resume_salaries,
+        'vacancies': vacancy_salaries
+    })
+    order = table['vacancies'].sort_values(ascending=False).index
+    table = table.reindex(index=order)
+    fig, ax = plt.subplots()
+    table.plot(kind='bar', ax=ax)
+    ax.set_ylabel(u'Зарплата в резюме и в вакансиях')
+    save_figure(fig, path)
+    return fig
+
+
+def show_vacancy_resume_salaries(vacancies, resumes, specializations,
+                                 path=None):
+    with measure_stage('show_vacancy_resume_salaries', 'aggregate'):
+        profarea_index = get_profarea_index(specializations)
+        accumulator = resume_salaries_accumulator(profarea_index)
+        if isinstance(vacancies, VacancyColumns):
+            vacancy_salaries = get_vacancy_salaries_batch(vacancies)
+        else:
+            vacancy_salaries = get_vacancy_salaries(vacancies)
+        resume_salaries = run_accumulator(accumulator, resumes)
+    with measure_stage('show_vacancy_resume_salaries', 'plot'):
+        return draw_figure(
+            'vacancy_resume_salaries',
+            (vacancy_salaries, resume_salaries),
+            path
+        )
+
+
+def get_russian_areas(areas, country_id=RUSSIA_AREA_ID):
+    # Region of every area in the country: towns go to their region, Msk
+    # and Spb are regions themselves
+    if not isinstance(areas, AreaIndex):
+        areas = AreaIndex(areas)
+    ids = areas.get_descendants(country_id)
+    regions = areas.get_regions(ids, country_id)
+    return {
+        id: areas.areas[region]
+        for id, region in zip(ids.tolist(), regions.tolist())
+    }
+
+
+def get_geography_salary(resumes, russian_areas):
+    areas = defaultdict(QuantileSketch)
+    for resume in resumes:
+        area = russian_areas.get(resume.area_id)
+        if area:
+            area = area.name
+            salary = resume.salary
+            if salary and salary < 150000:
+                areas[area].update(salary)
+    return areas
+
+
+def get_geography_salary_batch(columns, russian_areas, index=None):
+    area_id = take_column(columns.area_id, index)
+    salary = take_column(columns.salary, index)
+    regions = np.full(max(russian_areas) + 1, -1, dtype=np.int32)
+    for id, area in russian_areas.iteritems():
+        regions[id] = area.id
+    known = (area_id >= 0) & (area_id < len(regions))
+    region = np.full(len(area_id), -1, dtype=np.int32)
+    region[known] = regions[area_id[known]]
+    with np.errstate(invalid='ignore'):
+        selection = (region != -1) & (salary != 0) & (salary < 150000)
+    region = region[selection]
+    salary = salary[selection]
+    names = {_.id: _.name for _ in russian_areas.itervalues()}
+    areas = {}
+    for id in np.unique(region).tolist():
+        areas[names[id]] = salary[region == id]
+    return areas
+
+
+def get_salary_rank(values):
+    # Mean minus sample std, for sketches and arrays
+    if isinstance(values, QuantileSketch):
+        return values.get_mean() - values.get_std()
+    if len(values) < 2:
+        return float('nan')
+    return values.mean() - values.std(ddof=1)
+
+
+def plot_geography_salary(areas, path):
+    order = pd.Series({
+        area: get_salary_rank(values)
+        for area, values in areas.iteritems()
+    })
+    order = order.sort_values(ascending=False).index
+    order = order[:30]
+    fig, ax = plt.subplots()
+    plot_box_stats(ax, areas, order)
+    ax.set_ylim(0, 115000)
+    ax.set_xticklabels(order, rotation=90)
+    ax.set_ylabel(u'Ожидаемая зарплата')
+    fig.set_size_inches(12, 4)
+    save_figure(fig, path)
+    return fig
+
+
+def show_geography_salary(resumes, russian_areas, seed=None, path=None):
+    with measure_stage('show_geography_salary', 'aggregate'):
+        if isinstance(resumes, ResumeColumns):
+            index = sample_resume_index(resumes, 1000000, seed)
+            areas = get_geography_salary_batch(resumes, russian_areas, index)
+        else:
+            resumes = sample_stream(resumes, 1000000, seed)
+            areas = get_geography_salary(resumes, russian_areas)
+    with measure_stage('show_geography_salary', 'plot'):
+        return draw_figure('geography_salary', (areas,), path)
+
+
+def university_salary_accumulator(university_index):
+    labels = university_index.labels
+
+    def update(universities, resume):
+        age = resume.age
+        if age and age > 25 and resume.area_id == 1:
+            for education in resume.educations:
+                university = university_index.get_id(education)
+                if university != -1:
+                    salary = resume.salary
+                    if salary and salary < 150000:
+                        universities[university].update(salary)
+        return universities
+
+    return Accumulator(
+        lambda: defaultdict(QuantileSketch),
+        update,
+        merge_sketch_tables,
+        lambda _: decode_keys(_, labels)
+    )
+
+
+def get_university_salary_batch(columns, university_index, index=None):
+    universities = university_index.get_education_ids(columns)
+    offsets = np.asarray(columns.education_offsets)
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    if index is not None:
+        selection = np.zeros(len(offsets) - 1, dtype=bool)
+        selection[index] = True
+        selection = selection[rows]
+        rows = rows[selection]
+        universities = universities[selection]
+    age = np.asarray(columns.age)[rows]
+    area_id = np.asarray(columns.area_id)[rows]
+    salary = np.asarray(columns.salary)[rows]
+    with np.errstate(invalid='ignore'):
+        selection = (
+            (universities != -1) & (age > 25) & (area_id == 1)
+            & (salary != 0) & (salary < 150000)
+        )
+    universities = universities[selection]
+    salary = salary[selection]
+    return {
+        university_index.labels[id]: salary[universities == id]
+        for id in np.unique(universities).tolist()
+    }
+
+
+UNIVERSITY_ORDER = [
+    u'МГУ',
+    u'МГТУ им. Баумана',
+    u'МПГУ',
+    u'РЭА им.Плеханова',
+    u'ГУУ',
+    u'МАИ',
+    u'МГПУ',
+    u'РУДН',
+    u'ГУ-ВШЭ',
+    u'МЭСИ',
+    u'РГГУ',
+    u'ММА им. Сеченова',
+    u'МИРЭА',
+    u'МГИМО (у) МИД РФ',
+    u'МГСУ-МИСИ',
+    u'МАДИ',
+    u'МИИТ',
+    u'МИФИ',
+    u'РГСУ',
+    u'МГЛУ',
+    u'МЭИ',
+    u'МГИУ',
+    u'МАТИ',
+    u'МФПА',
+    u'МГУПИ',
+    u'МГОПУ им.Шолохова',
+    u'МФЮА',
+    u'МТУСИ',
+    u'МГТУ МАМИ',
+    u'РГТЭУ',
+    u'МГЮА',
+]
+
+
+def plot_university_salary(universities, path):
+    order = UNIVERSITY_ORDER
+    order = [_ for _ in order if _ in universities]
+    fig, ax = plt.subplots()
+    plot_box_stats(ax, universities, order)
+    ax.set_ylim(0, 115000)
+    ax.set_xticklabels(order, rotation=90)
+    ax.set_ylabel(u'Ожидаемая зарплата')
+    fig.set_size_inches(12, 4)
+    save_figure(fig, path)
+    return fig
+
+
+def show_university_salary(resumes, university_names, path=None):
+    with measure_stage('show_university_salary', 'aggregate'):
+        university_index = load_university_index(university_names)
+        if isinstance(resumes, ResumeColumns):
+            universities = get_university_salary_batch(
+                resumes,
+                university_index
+            )
+        else:
+            accumulator = university_salary_accumulator(university_index)
+            universities = run_accumulator(accumulator, resumes)
+    with measure_stage('show_university_salary', 'plot'):
+        return draw_figure('university_salary', (universities,), path)
+
+
+def shorten_string(string, cap=20):
+    if len(string) <= cap:
+        return string
+    else:
+        return string[:cap] + '...'
+
+
+def shorten_counters(table):
+    shortened = defaultdict(Counter)
+    for key, counter in table.iteritems():
+        for string, count in counter.iteritems():
+            shortened[key][shorten_string(string)] += count
+    return shortened
+
+
+def geography_specializations_accumulator(russian_areas, profarea_index):
+    profareas, names = profarea_index
+    # Counts go by region id, names are needed only for labels
+    regions = {id: area.id for id, area in russian_areas.iteritems()}
+    area_names = {_.id: _.name for _ in russian_areas.itervalues()}
+
+    def update(geography_specializations, resume):
+        area = regions.get(resume.area_id)
+        if area is not None:
+            groups = get_resume_profareas(resume, profareas)
+            for group in groups:
+                geography_specializations[area][group] += 1
+        return geography_specializations
+
+    def finalize(geography_specializations):
+        decoded = defaultdict(Counter)
+        for area, counter in geography_specializations.iteritems():
+            decoded[area_names[area]] += decode_counter(counter, names)
+        return decoded
+
+    return Accumulator(
+        lambda: defaultdict(Counter),
+        update,
+        merge_counter_tables,
+        finalize
+    )
+
+
+PROFAREA_SELECTION = [
+    u'Страхование',
+    u'Закупки',
+    u'Государственная служба, некоммерческие организации',
+    u'Добыча сырья',
+    u'Спортивные клубы, фитнес, салоны красоты',
+    u'Наука, образование',
+    u'Автомобильный бизнес',
+    u'Искусство, развлечения, масс-медиа',
+    u'Юристы',
+    u'Медицина, фармацевтика',
+    u'Управление персоналом, тренинги',
+    u'Туризм, гостиницы, рестораны',
+    u'Маркетинг, реклама, PR',
+    u'Рабочий персонал',
+    u'Банки, инвестиции, лизинг',
+    u'Информационные технологии, интернет, телеком',
+    u'Строительство, недвижимость',
+    u'Производство',
+    u'Бухгалтерия, управленческий учет, финансы предприятия',
+    u'Транспорт, логистика',
+    u'Продажи',
+]
+
+
+def plot_geography_specializations(geography_specializations, path):
+    geography_specializations = shorten_counters(geography_specializations)
+    total = Counter()
+    order = Counter()
     for area in geography_specializations:
         groups = geography_specializations[area]
         total += groups
         order[area] = sum(groups.itervalues())
     order = [area for area, _ in order.most_common()]
-    selection = map(shorten_string, [
-        u'Страхование',
-        u'Закупки',
-        u'Государственная служба, некоммерческие организации',
-        u'Добыча сырья',
-        u'Спортивные клубы, фитнес, салоны красоты',
-        u'Наука, образование',
-        u'Автомобильный бизнес',
-        u'Искусство, развлечения, масс-медиа',
-        u'Юристы',
-        u'Медицина, фармацевтика',
-        u'Управление персоналом, тренинги',
-        u'Туризм, гостиницы, рестораны',
-        u'Маркетинг, реклама, PR',
-        u'Рабочий персонал',
-        u'Банки, инвестиции, лизинг',
-        u'Информационные технологии, интернет, телеком',
-        u'Строительство, недвижимость',
-        u'Производство',
-        u'Бухгалтерия, управленческий учет, финансы предприятия',
-        u'Транспорт, логистика',
-        u'Продажи',
-    ])
+    selection = map(shorten_string, PROFAREA_SELECTION)
     total = pd.Series(total)
     total = total.reindex(selection)
     total = total / total.sum()
@@ -767,84 +3978,64 @@ def show_geography_specializations(resumes, russian_areas, specializations):
         ax.set_title(area)
         ax.set_xlim(-1, 1)
     fig.tight_layout()
-    fig.savefig('fig.png', dpi=80, bbox_inches='tight')
+    save_figure(fig, path, dpi=80)
+    return fig
 
 
-def show_universities_specializations(resumes, university_names, specializations):
-    university_specializations = defaultdict(Counter)
-    for resume in resumes:
+def show_geography_specializations(resumes, russian_areas, specializations,
+                                   path=None):
+    with measure_stage('show_geography_specializations', 'aggregate'):
+        accumulator = geography_specializations_accumulator(
+            russian_areas,
+            get_profarea_index(specializations)
+        )
+        geography_specializations = run_accumulator(accumulator, resumes)
+    with measure_stage('show_geography_specializations', 'plot'):
+        return draw_figure(
+            'geography_specializations',
+            (geography_specializations,),
+            path
+        )
+
+
+def university_specializations_accumulator(university_index, profarea_index):
+    profareas, names = profarea_index
+    labels = university_index.labels
+
+    def update(university_specializations, resume):
         age = resume.age
         if age and age > 25 and resume.area_id == 1:
             for education in resume.educations:
-                university = university_names.get(education)
-                if university:
-                    groups = {
-                        specializations[_].group.name
-                        for _ in resume.specializations
-                    }
+                university = university_index.get_id(education)
+                if university != -1:
+                    groups = get_resume_profareas(resume, profareas)
                     for group in groups:
-                        group = shorten_string(group)
                         university_specializations[university][group] += 1
+        return university_specializations
+
+    def finalize(university_specializations):
+        return decode_keys(
+            decode_counter_table(university_specializations, names),
+            labels
+        )
+
+    return Accumulator(
+        lambda: defaultdict(Counter),
+        update,
+        merge_counter_tables,
+        finalize
+    )
+
+
+def plot_universities_specializations(university_specializations,
+                                      path):
+    university_specializations = shorten_counters(university_specializations)
     total = Counter()
     for university in university_specializations:
         groups = university_specializations[university]
         total += groups
-    order = [
-        u'МГУ',
-        u'МГТУ им. Баумана',
-        u'МПГУ',
-        u'РЭА им.Плеханова',
-        u'ГУУ',
-        u'МАИ',
-        u'МГПУ',
-        u'РУДН',
-        u'ГУ-ВШЭ',
-        u'МЭСИ',
-        u'РГГУ',
-        u'ММА им. Сеченова',
-        u'МИРЭА',
-        u'МГИМО (у) МИД РФ',
-        u'МГСУ-МИСИ',
-        u'МАДИ',
-        u'МИИТ',
-        u'МИФИ',
-        u'РГСУ',
-        u'МГЛУ',
-        u'МЭИ',
-        u'МГИУ',
-        u'МАТИ',
-        u'МФПА',
-        u'МГУПИ',
-        u'МГОПУ им.Шолохова',
-        u'МФЮА',
-        u'МТУСИ',
-        u'МГТУ МАМИ',
-        u'РГТЭУ',
-        u'МГЮА',
-    ]
-    selection = map(shorten_string, [
-        u'Страхование',
-        u'Закупки',
-        u'Государственная служба, некоммерческие организации',
-        u'Добыча сырья',
-        u'Спортивные клубы, фитнес, салоны красоты',
-        u'Наука, образование',
-        u'Автомобильный бизнес',
-        u'Искусство, развлечения, масс-медиа',
-        u'Юристы',
-        u'Медицина, фармацевтика',
-        u'Управление персоналом, тренинги',
-        u'Туризм, гостиницы, рестораны',
-        u'Маркетинг, реклама, PR',
-        u'Рабочий персонал',
-        u'Банки, инвестиции, лизинг',
-        u'Информационные технологии, интернет, телеком',
-        u'Строительство, недвижимость',
-        u'Производство',
-        u'Бухгалтерия, управленческий учет, финансы предприятия',
-        u'Транспорт, логистика',
-        u'Продажи',
-    ])
+    order = UNIVERSITY_ORDER
+    selection = map(shorten_string, PROFAREA_SELECTION)
     total = pd.Series(total)
     total = total.reindex(selection)
     total = total / total.sum()
@@ -859,114 +4050,143 @@ def show_universities_specializations(resumes, university_names, specializations
         ax.set_title(university)
         ax.set_xlim(-1, 1)
     fig.tight_layout()
-    fig.savefig('fig.png', dpi=80, bbox_inches='tight')
+    save_figure(fig, path, dpi=80)
+    return fig
 
 
-def normalize_distribution(distribution):
-    total = sum(distribution.itervalues())
-    normalized = {}
-    for key, value in distribution.iteritems():
-        normalized[key] = float(value) / total
-    return normalized
+def show_universities_specializations(resumes, university_names, specializations,
+                                      path=None):
+    with measure_stage('show_universities_specializations', 'aggregate'):
+        accumulator = university_specializations_accumulator(
+            load_university_index(university_names),
+            get_profarea_index(specializations)
+        )
+        university_specializations = run_accumulator(accumulator, resumes)
+    with measure_stage('show_universities_specializations', 'plot'):
+        return draw_figure(
+            'universities_specializations',
+            (university_specializations,),
+            path
+        )
 
 
-def scale_distribution(distribution, scale):
-    scaled = {}
-    for key, value in distribution.iteritems():
-        scaled[key] = value * scale
-    return scaled
+def get_sparse_table(table, rows, columns):
+    # CSR matrix of table[row][column], keys missing from columns are
+    # skipped
+    codes = {key: code for code, key in enumerate(columns)}
+    data = []
+    indices = []
+    indptr = [0]
+    for row in rows:
+        for key, value in table[row].iteritems():
+            code = codes.get(key)
+            if code is not None:
+                indices.append(code)
+                data.append(value)
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (data, indices, indptr),
+        shape=(len(rows), len(columns)),
+        dtype=np.float64
+    )
 
 
-def get_school_specializations(resumes, university_names, specializations,
-                               school_universities):
-    university_specializations = defaultdict(Counter)
-    for resume in resumes:
-        age = resume.age
-        if age and age > 25 and resume.area_id == 1:
-            for education in resume.educations:
-                university = university_names.get(education)
-                if university:
-                    groups = {
-                        specializations[_].group.name
-                        for _ in resume.specializations
-                    }
-                    for group in groups:
-                        university_specializations[university][group] += 1
-    for university in university_specializations:
-        distribution = normalize_distribution(university_specializations[university])
-        university_specializations[university] = Counter(distribution)
+def normalize_rows(matrix):
+    # Every row sums to 1, empty rows stay empty
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.zeros(len(totals))
+    defined = totals != 0
+    scale[defined] = 1.0 / totals[defined]
+    matrix = sparse.diags(scale).dot(matrix).tocsr()
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def combine_school_specializations(university_specializations,
+                                   school_universities):
+    # School distribution is the share weighted sum of normalized
+    # university distributions, normalized again: one sparse product
+    universities = sorted(university_specializations)
+    groups = sorted({
+        group
+        for distribution in university_specializations.itervalues()
+        for group in distribution
+    })
+    university_groups = normalize_rows(get_sparse_table(
+        university_specializations,
+        universities,
+        groups
+    ))
+    schools = list(school_universities)
+    school_universities = get_sparse_table(
+        school_universities,
+        schools,
+        universities
+    )
+    school_groups = normalize_rows(school_universities.dot(university_groups))
     school_specializations = {}
-    for school, universities in school_universities.iteritems():
-        distribution = Counter()
-        for university, share in universities.iteritems():
-            if university in university_specializations:
-                distribution += Counter(scale_distribution(
-                    university_specializations[university],
-                    share
-                ))
-        school_specializations[school] = normalize_distribution(distribution)
+    for index, school in enumerate(schools):
+        start = school_groups.indptr[index]
+        stop = school_groups.indptr[index + 1]
+        school_specializations[school] = dict(zip(
+            [groups[_] for _ in school_groups.indices[start:stop]],
+            school_groups.data[start:stop].tolist()
+        ))
     return school_specializations
 
 
-def show_school_specializations(school_specializations):
-    selection = map(shorten_string, [
-        u'Страхование',
-        u'Закупки',
-        u'Государственная служба, некоммерческие организации',
-        u'Добыча сырья',
-        u'Спортивные клубы, фитнес, салоны красоты',
-        u'Наука, образование',
-        u'Автомобильный бизнес',
-        u'Искусство, развлечения, масс-медиа',
-        u'Юристы',
-        u'Медицина, фармацевтика',
-        u'Управление персоналом, тренинги',
-        u'Туризм, гостиницы, рестораны',
-        u'Маркетинг, реклама, PR',
-        u'Рабочий персонал',
-        u'Банки, инвестиции, лизинг',
-        u'Информационные технологии, интернет, телеком',
-        u'Строительство, недвижимость',
-        u'Производство',
-        u'Бухгалтерия, управленческий учет, финансы предприятия',
-        u'Транспорт, логистика',
-        u'Продажи',
-    ])
-    order = [
-        u'Лицей №1535',
-        u'Специализированный учебно-научный центр МГУ',
-        u'Школа №57',
-        u'Лицей №1501',
-        u'Лицей №2 «Вторая школа»',
-        u'Школа-интернат «Интеллектуал»',
-        u'Школа №179 МИОО',
-        u'Лицей №1580',
-        u'Лицей №1502',
-        u'Гимназия №1543',
-        u'Гимназия №1514',
-        u'Центр образования №548 «Царицыно»',
-        u'Школа №171',
-        u'Лицей №1568',
-        u'Школа №2007',
-        u'Школа №962',
-        u'Школа №192',
-        u'Школа №218',
-        u'Гимназия №1518',
-        u'Школа №1955',
-        u'Школа №1253',
-        u'Лицей №1574',
-        u'Гимназия №1534',
-        u'Школа №2086',
-        u'Гимназия №1567',
-        u'Школа №109',
-        u'Гимназия №1517',
-        u'Школа №1252 имени Сервантеса',
-        u'Школа №627',
-        u'Гимназия №1529',
-        u'Гимназия №1554',
-        u'Гимназия №1576',
-        u'Школа №1359',
-    ]
+def get_school_specializations(resumes, university_names, specializations,
+                               school_universities):
+    accumulator = university_specializations_accumulator(
+        load_university_index(university_names),
+        get_profarea_index(specializations)
+    )
+    return combine_school_specializations(
+        run_accumulator(accumulator, resumes),
+        school_universities
+    )
+
+
+SCHOOL_ORDER = [
+    u'Лицей №1535',
+    u'Специализированный учебно-научный центр МГУ',
+    u'Школа №57',
+    u'Лицей №1501',
+    u'Лицей №2 «Вторая школа»',
+    u'Школа-интернат «Интеллектуал»',
+    u'Школа №179 МИОО',
+    u'Лицей №1580',
+    u'Лицей №1502',
+    u'Гимназия №1543',
+    u'Гимназия №1514',
+    u'Центр образования №548 «Царицыно»',
+    u'Школа №171',
+    u'Лицей №1568',
+    u'Школа №2007',
+    u'Школа №962',
+    u'Школа №192',
+    u'Школа №218',
+    u'Гимназия №1518',
+    u'Школа №1955',
+    u'Школа №1253',
+    u'Лицей №1574',
+    u'Гимназия №1534',
+    u'Школа №2086',
+    u'Гимназия №1567',
+    u'Школа №109',
+    u'Гимназия №1517',
+    u'Школа №1252 имени Сервантеса',
+    u'Школа №627',
+    u'Гимназия №1529',
+    u'Гимназия №1554',
+    u'Гимназия №1576',
+    u'Школа №1359',
+]
+
+
+def plot_school_specializations(school_specializations, path):
+    selection = map(shorten_string, PROFAREA_SELECTION)
+    order = SCHOOL_ORDER
     total = Counter()
     for school, distribution in school_specializations.iteritems():
         total += Counter(distribution)
@@ -993,9 +4213,1201 @@ def show_school_specializations(school_specializations):
         ax.set_xlim(-1, 1)
         ax.set_title(school)
     fig.tight_layout()
-    fig.savefig('fig.png', dpi=80, bbox_inches='tight')
+    save_figure(fig, path, dpi=80)
+    return fig
+
+
+def show_school_specializations(school_specializations, path=None):
+    with measure_stage('show_school_specializations', 'plot'):
+        return draw_figure(
+            'school_specializations',
+            (school_specializations,),
+            path
+        )
 
 
 def dump_school_specializations(school_specializations):
     with open(SCHOOL_SPECIALIZATIONS, 'w') as file:
         json.dump(school_specializations, file)
+
+
+PLOTS = {
+    'age_distribution': plot_age_distribution,
+    'gender_distribution': plot_gender_distribution,
+    'currency_distribution': plot_currency_distribution,
+    'age_salary_correlation': plot_age_salary_correlation,
+    'gender_salary_correlation': plot_gender_salary_correlation,
+    'gender_specializations': plot_gender_specializations,
+    'vacancy_resume_specializations': plot_vacancy_resume_specializations,
+    'vacancy_salary_bounds_distribution': (
+        plot_vacancy_salary_bounds_distribution
+    ),
+    'vacancy_salary_model': plot_vacancy_salary_model,
+    'vacancy_resume_salaries': plot_vacancy_resume_salaries,
+    'geography_salary': plot_geography_salary,
+    'university_salary': plot_university_salary,
+    'geography_specializations': plot_geography_specializations,
+    'universities_specializations': plot_universities_specializations,
+    'school_specializations': plot_school_specializations,
+}
+# 18x50 inch grids render longest, pool starts them first
+LARGE_PLOTS = [
+    'geography_specializations',
+    'universities_specializations',
+    'school_specializations'
+]
+TABLE_SCALARS = (
+    int, long, float, str, unicode, bool, type(None), np.generic
+)
+
+
+def get_figure_path(name, dir=FIGURES):
+    return os.path.join(dir, name + '.png')
+
+
+def get_figure_hash_path(path):
+    return path + '.sha1'
+
+
+def update_table_hash(hash, value):
+    # Same content gives same hash regardless of dict order or array
+    # layout
+    if isinstance(value, dict):
+        hash.update('{')
+        for key, item in sorted(value.iteritems()):
+            update_table_hash(hash, key)
+            update_table_hash(hash, item)
+        hash.update('}')
+    elif isinstance(value, (list, tuple)):
+        if all(isinstance(_, TABLE_SCALARS) for _ in value):
+            hash.update(repr(list(value)))
+        else:
+            hash.update('[')
+            for item in value:
+                update_table_hash(hash, item)
+            hash.update(']')
+    elif isinstance(value, np.ndarray):
+        hash.update('{0}{1}'.format(value.dtype, value.shape))
+        hash.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (pd.Series, pd.DataFrame)):
+        update_table_hash(hash, value.to_dict())
+    elif isinstance(value, QuantileSketch):
+        # Retained items depend on random compactions, exact summaries
+        # identify the data
+        update_table_hash(hash, (
+            value.count, value.total, value.squares, value.min, value.max
+        ))
+    elif isinstance(value, TABLE_SCALARS):
+        hash.update(repr(value))
+        hash.update(',')
+    else:
+        hash.update(type(value).__name__)
+        update_table_hash(hash, vars(value))
+
+
+def update_code_hash(hash, code):
+    # Repr of nested code objects (comprehensions, lambdas) holds their
+    # address, so they are hashed by content and the hash is the same in
+    # every process
+    hash.update(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            update_code_hash(hash, const)
+        else:
+            hash.update(repr(const))
+        hash.update(',')
+
+
+def get_table_hash(name, table):
+    # Plot code is part of the hash, so edits of a plot function redraw
+    # its figure. Changes of constants it reads need FIGURES_VERSION
+    plot = PLOTS[name]
+    hash = hashlib.sha1()
+    hash.update('{0}:{1}:'.format(FIGURES_VERSION, name))
+    update_code_hash(hash, plot.__code__)
+    update_table_hash(hash, table)
+    return hash.hexdigest()
+
+
+def read_figure_hash(path):
+    hash_path = get_figure_hash_path(path)
+    if os.path.exists(path) and os.path.exists(hash_path):
+        with open(hash_path) as file:
+            return file.read().strip()
+
+
+def draw_figure(name, table, path=None):
+    # Draws and returns the figure, it stays open for notebooks
+    if path is None:
+        path = get_figure_path(name)
+    dir = os.path.dirname(path)
+    if dir and not os.path.exists(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            # Other worker made it
+            if not os.path.isdir(dir):
+                raise
+    return PLOTS[name](*tuple(table) + (path,))
+
+
+def draw_figure_task(task):
+    name, table, path, hash = task
+    # Pyplot keeps figures until closed, batches would pile them up
+    plt.close(draw_figure(name, table, path))
+    with open(get_figure_hash_path(path), 'w') as file:
+        file.write(hash)
+    return name
+
+
+def render_figure(name, table, path=None, force=False):
+    # Table is the tuple of plot arguments. Figure is drawn and closed
+    # only when the table or the plot changed since the last render to
+    # path. Returns whether it was drawn
+    if path is None:
+        path = get_figure_path(name)
+    hash = get_table_hash(name, table)
+    if not force and read_figure_hash(path) == hash:
+        return False
+    draw_figure_task((name, table, path, hash))
+    return True
+
+
+def render_figures(figures, dir=FIGURES, processes=None, force=False):
+    # Renders name -> table in a process pool, skipping unchanged
+    # figures. Returns names of drawn figures
+    tasks = []
+    for name, table in figures.iteritems():
+        path = get_figure_path(name, dir)
+        hash = get_table_hash(name, table)
+        if force or read_figure_hash(path) != hash:
+            tasks.append((name, table, path, hash))
+    tasks.sort(key=lambda task: (task[0] not in LARGE_PLOTS, task[0]))
+    if processes == 1 or len(tasks) <= 1:
+        return [draw_figure_task(_) for _ in tasks]
+    pool = Pool(processes)
+    try:
+        return list(pool.imap_unordered(draw_figure_task, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_report_figures(report, vacancy_columns=None, resume_columns=None,
+                       russian_areas=None, school_universities=None,
+                       seed=0):
+    # Figure tables from the finalized report and, when given, column
+    # stores. Same tables show_* functions draw. Samples are seeded, so
+    # unchanged stores give unchanged tables and the cache holds
+    figures = {
+        'gender_specializations': (report['gender_specializations'],),
+        'geography_specializations': (report['geography_specializations'],),
+        'university_salary': (report['university_salary'],),
+        'universities_specializations': (
+            report['university_specializations'],
+        ),
+    }
+    if school_universities is not None:
+        figures['school_specializations'] = (
+            combine_school_specializations(
+                report['university_specializations'],
+                school_universities
+            ),
+        )
+    if vacancy_columns is not None:
+        figures.update({
+            'vacancy_resume_specializations': (
+                get_vacancy_specializations_batch(vacancy_columns),
+                report['resume_specializations']
+            ),
+            'vacancy_resume_salaries': (
+                get_vacancy_salaries_batch(vacancy_columns),
+                report['resume_salaries']
+            ),
+            'vacancy_salary_bounds_distribution': (
+                get_vacancy_salary_bounds_batch(vacancy_columns),
+            ),
+            'vacancy_salary_model': get_vacancy_salary_model_batch(
+                vacancy_columns
+            ),
+        })
+    if resume_columns is not None:
+        figures.update({
+            'age_distribution': (
+                get_age_distribution_batch(resume_columns)[0],
+            ),
+            'gender_distribution': (
+                get_gender_distribution_batch(resume_columns)[0],
+            ),
+            'currency_distribution': (
+                get_currency_distribution_batch(resume_columns)[0],
+            ),
+            'age_salary_correlation': get_age_salary_correlation_batch(
+                resume_columns,
+                sample_resume_index(resume_columns, 500000, seed)
+            ),
+            'gender_salary_correlation': (
+                get_gender_salary_correlation_batch(
+                    resume_columns,
+                    sample_resume_index(resume_columns, 300000, seed)
+                ),
+            ),
+        })
+        if russian_areas is not None:
+            figures['geography_salary'] = (
+                get_geography_salary_batch(
+                    resume_columns,
+                    russian_areas,
+                    sample_resume_index(resume_columns, 1000000, seed)
+                ),
+            )
+    return figures
+
+
+def get_report_accumulators(specializations, russian_areas, university_names,
+                            suggests=None, strings=None):
+    profarea_index = get_profarea_index(specializations, strings)
+    university_index = UniversityIndex(university_names, suggests, strings)
+    return {
+        'gender_specializations': gender_specializations_accumulator(
+            profarea_index
+        ),
+        'resume_specializations': resume_specializations_accumulator(
+            profarea_index
+        ),
+        'resume_salaries': resume_salaries_accumulator(profarea_index),
+        'geography_specializations': geography_specializations_accumulator(
+            russian_areas,
+            profarea_index
+        ),
+        'university_salary': university_salary_accumulator(university_index),
+        'university_specializations': university_specializations_accumulator(
+            university_index,
+            profarea_index
+        ),
+    }
+
+
+def load_report_dictionaries():
+    # Everything besides resumes that report accumulators depend on
+    return (
+        load_specializations(),
+        get_russian_areas(load_area_index()),
+        load_university_names(),
+        load_university_suggests()
+    )
+
+
+def get_dictionaries_hash(dictionaries):
+    hash = hashlib.sha1()
+    update_table_hash(hash, dictionaries)
+    return hash.hexdigest()
+
+
+def load_report_accumulators(dictionaries=None, strings_path=STRINGS):
+    if dictionaries is None:
+        dictionaries = load_report_dictionaries()
+    specializations, russian_areas, university_names, suggests = dictionaries
+    strings = load_string_table(strings_path)
+    accumulators = get_report_accumulators(
+        specializations,
+        russian_areas,
+        university_names,
+        suggests,
+        strings
+    )
+    dump_string_table(strings, strings_path)
+    return accumulators, strings
+
+
+def get_report(resumes, specializations, russian_areas, university_names):
+    accumulators = get_report_accumulators(
+        specializations,
+        russian_areas,
+        university_names,
+        load_university_suggests()
+    )
+    return run_accumulators(accumulators, resumes)
+
+
+# Profareas of hh.ru in rough order of popularity, synthetic resumes and
+# vacancies take them with weights 1 / rank
+SYNTHETIC_PROFAREAS = [
+    (17, u'Продажи'),
+    (1, u'Информационные технологии, интернет, телеком'),
+    (2, u'Бухгалтерия, управленческий учет, финансы предприятия'),
+    (4, u'Административный персонал'),
+    (21, u'Транспорт, логистика'),
+    (18, u'Производство'),
+    (3, u'Маркетинг, реклама, PR'),
+    (20, u'Строительство, недвижимость'),
+    (5, u'Банки, инвестиции, лизинг'),
+    (15, u'Начало карьеры, студенты'),
+    (29, u'Рабочий персонал'),
+    (22, u'Туризм, гостиницы, рестораны'),
+    (6, u'Управление персоналом, тренинги'),
+    (13, u'Медицина, фармацевтика'),
+    (23, u'Юристы'),
+    (9, u'Высший менеджмент'),
+    (14, u'Наука, образование'),
+    (7, u'Автомобильный бизнес'),
+    (11, u'Искусство, развлечения, масс-медиа'),
+    (12, u'Консультирование'),
+    (26, u'Закупки'),
+    (8, u'Безопасность'),
+    (16, u'Государственная служба, некоммерческие организации'),
+    (25, u'Инсталляция и сервис'),
+    (24, u'Спортивные клубы, фитнес, салоны красоты'),
+    (10, u'Добыча сырья'),
+    (19, u'Страхование'),
+    (27, u'Домашний персонал'),
+]
+SYNTHETIC_SPECIALIZATIONS = 12
+RAW_RESUME_FIELDS = [
+    'desireable_compensation', 'desireable_compensation_currency_code',
+    'age', 'gender', 'area_id', 'language', 'specialization',
+    'primary_education'
+]
+BENCHMARKS = os.path.join(DATA_DIR, 'benchmarks')
+
+
+def get_synthetic_specializations(size=SYNTHETIC_SPECIALIZATIONS):
+    specializations = []
+    for index, (id, name) in enumerate(SYNTHETIC_PROFAREAS):
+        group = Profarea(id, name)
+        for offset in xrange(size):
+            id = index * size + offset + 1
+            name = u'Специализация {id}'.format(id=id)
+            specializations.append(Specialization(group, id, name))
+    return specializations
+
+
+def get_rank_weights(size):
+    return [1.0 / (rank + 1) for rank in xrange(size)]
+
+
+class WeightedChoice(object):
+    def __init__(self, values, weights):
+        self.values = list(values)
+        self.totals = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.totals.append(total)
+        self.total = total
+
+    def __call__(self, generator):
+        index = bisect_right(self.totals, generator.random() * self.total)
+        return self.values[min(index, len(self.values) - 1)]
+
+
+class SyntheticData(object):
+    # Resumes and vacancies with the schema of the dumps. Distributions
+    # are approximations: ~45% of resumes in Msk and Spb, log-normal
+    # salaries around 40k RUR, zipf-like universities and profareas.
+    # Same seed, areas and university names give the same files
+    def __init__(self, area_index, university_names, seed=None):
+        self.generator = Random(seed)
+        russian_areas = [
+            id for id in area_index.get_descendants(RUSSIA_AREA_ID).tolist()
+            if id not in (1, 2)
+        ]
+        inside = area_index.is_inside(area_index.order, RUSSIA_AREA_ID)
+        foreign_areas = area_index.order[~inside].tolist()
+        self.areas = WeightedChoice(
+            [1, 2] + russian_areas + foreign_areas,
+            (
+                [0.33, 0.12]
+                + [0.5 / len(russian_areas)] * len(russian_areas)
+                + [0.05 / len(foreign_areas)] * len(foreign_areas)
+            )
+        )
+
+        names = defaultdict(list)
+        for name, label in sorted(university_names.iteritems()):
+            names[label].append(name)
+        labels = [_ for _ in UNIVERSITY_ORDER if _ in names]
+        labels += sorted(set(names) - set(labels))
+        self.labels = WeightedChoice(labels, get_rank_weights(len(labels)))
+        self.names = names
+
+        self.specializations = defaultdict(list)
+        for specialization in get_synthetic_specializations():
+            self.specializations[specialization.group].append(specialization)
+        profareas = [Profarea(*_) for _ in SYNTHETIC_PROFAREAS]
+        self.profareas = WeightedChoice(
+            profareas,
+            get_rank_weights(len(profareas))
+        )
+        self.currencies = WeightedChoice(['RUR', 'USD', 'EUR'], [94, 4, 2])
+
+    def get_area_id(self):
+        if self.generator.random() >= 0.03:
+            return self.areas(self.generator)
+
+    def get_salary(self):
+        salary = self.generator.lognormvariate(log(40000), 0.6)
+        return int(round(salary, -3))
+
+    def get_specializations(self):
+        generator = self.generator
+        profareas = [self.profareas(generator)]
+        if generator.random() < 0.2:
+            profareas.append(self.profareas(generator))
+        specializations = set()
+        for profarea in profareas:
+            specializations.update(generator.sample(
+                self.specializations[profarea],
+                generator.randint(1, 3)
+            ))
+        return sorted(specializations, key=lambda _: _.id)
+
+    def get_education(self):
+        label = self.labels(self.generator)
+        name = self.generator.choice(self.names[label])
+        if self.generator.random() < 0.05:
+            # Dump holds both unicode and utf8 strings
+            return name
+        return name.encode('utf8')
+
+    def get_resume(self):
+        generator = self.generator
+        salary = currency = None
+        if generator.random() < 0.6:
+            salary = float(self.get_salary())
+            currency = self.currencies(generator)
+        age = None
+        if generator.random() < 0.88:
+            age = float(min(max(int(generator.gauss(33, 10)), 16), 80))
+        gender = 0 if generator.random() < 0.5 else 1
+        if generator.random() < 0.03:
+            gender = -1
+        area_id = self.get_area_id()
+        if area_id is not None:
+            area_id = str(area_id)
+        languages = ['']
+        if generator.random() < 0.4:
+            ids = generator.sample(xrange(1, 11), generator.randint(1, 3))
+            languages = [
+                '{id}: {score}'.format(id=id, score=generator.randint(1, 5))
+                for id in sorted(ids)
+            ]
+        specializations = ['']
+        if generator.random() < 0.85:
+            specializations = [str(_.id) for _ in self.get_specializations()]
+        educations = []
+        if generator.random() < 0.75:
+            educations = [
+                self.get_education()
+                for _ in xrange(generator.randint(1, 2))
+            ]
+        return [
+            salary, currency, age, gender, area_id,
+            languages, specializations, educations
+        ]
+
+    def get_vacancy(self, id):
+        generator = self.generator
+        salary = None
+        if generator.random() < 0.5:
+            min = max = None
+            bounds = generator.random()
+            if bounds < 0.7:
+                min = self.get_salary()
+            if bounds > 0.4:
+                max = min or self.get_salary()
+                max += generator.randint(0, 40) * 1000
+            salary = {
+                'from': min,
+                'to': max,
+                'currency': self.currencies(generator)
+            }
+        return {
+            'alternate_url': 'https://hh.ru/vacancy/{id}'.format(id=id),
+            'area': {'id': str(self.get_area_id() or 1)},
+            'salary': salary,
+            'specializations': [
+                {
+                    'id': '{group}.{id}'.format(
+                        group=specialization.group.id,
+                        id=specialization.id
+                    ),
+                    'name': specialization.name,
+                    'profarea_id': str(specialization.group.id),
+                    'profarea_name': specialization.group.name
+                }
+                for specialization in self.get_specializations()
+            ]
+        }
+
+    def get_school_universities(self, size=20):
+        schools = []
+        for name in SCHOOL_ORDER:
+            universities = Counter()
+            for _ in xrange(size):
+                universities[self.labels(self.generator)] += 1
+            schools.append({'name': name, 'universities': universities})
+        return schools
+
+
+def format_raw_value(value):
+    if value is None:
+        return 'nan'
+    return repr(value)
+
+
+def format_raw_resume(values):
+    return '{' + ', '.join(
+        "'{key}': {value}".format(key=key, value=format_raw_value(value))
+        for key, value in zip(RAW_RESUME_FIELDS, values)
+    ) + '}'
+
+
+def generate_raw_resumes(data, count, path):
+    with open(path, 'wb') as file:
+        file.write('[')
+        for index in xrange(count):
+            if index:
+                file.write(', ')
+            file.write(format_raw_resume(data.get_resume()))
+        file.write(']\n')
+
+
+def generate_vacancies(data, count, path):
+    with open(path, 'w') as file:
+        for index in xrange(count):
+            file.write(json.dumps(data.get_vacancy(index + 1)))
+            file.write('\n')
+
+
+def get_benchmark_path(name, dir=BENCHMARKS):
+    return os.path.join(dir, name)
+
+
+def generate_benchmark_data(dir=BENCHMARKS, resumes=100000, vacancies=10000,
+                            seed=0, processes=None):
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    data = SyntheticData(load_area_index(), load_university_names(), seed)
+    raw = get_benchmark_path('resumes.repr', dir)
+    generate_raw_resumes(data, resumes, raw)
+    generate_vacancies(
+        data,
+        vacancies,
+        get_benchmark_path('vacancies.json', dir)
+    )
+    with open(get_benchmark_path('schools.json', dir), 'w') as file:
+        json.dump(data.get_school_universities(), file)
+    convert_resumes(raw, get_benchmark_path('resumes.json', dir), processes)
+    strings = StringTable()
+    dump_resume_columns(
+        load_resumes(get_benchmark_path('resumes.json', dir)),
+        get_benchmark_path('resume_columns', dir),
+        strings
+    )
+    dump_vacancy_columns(
+        read_vacancies(get_benchmark_path('vacancies.json', dir)),
+        get_benchmark_path('vacancy_columns', dir),
+        strings
+    )
+    manifest = {'resumes': resumes, 'vacancies': vacancies, 'seed': seed}
+    with open(get_benchmark_path('manifest.json', dir), 'w') as file:
+        json.dump(manifest, file)
+    return manifest
+
+
+def count_items(stream):
+    count = 0
+    for _ in stream:
+        count += 1
+    return count
+
+
+def get_show_benchmark(show, path, *args, **options):
+    def run():
+        # show_* leave their figure open
+        plt.close(show(*args, path=path, **options))
+    return run
+
+
+def get_benchmarks(dir=BENCHMARKS):
+    # Name, records processed and function to time. Inputs are loaded
+    # once, so get_* and show_* timings exclude decoding
+    raw = get_benchmark_path('resumes.repr', dir)
+    path = get_benchmark_path('resumes.json', dir)
+    vacancies_path = get_benchmark_path('vacancies.json', dir)
+    records = list(iterate_resumes(raw))
+    resumes = list(load_resumes(path))
+    vacancies = list(read_vacancies(vacancies_path))
+    resume_columns = load_resume_columns(
+        get_benchmark_path('resume_columns', dir)
+    )
+    vacancy_columns = load_vacancy_columns(
+        get_benchmark_path('vacancy_columns', dir)
+    )
+    # Few vacancies may miss specializations resumes have, generator's
+    # full list covers both
+    specializations = {
+        specialization.id: specialization
+        for specialization in get_synthetic_specializations()
+    }
+    profarea_index = get_profarea_index(specializations)
+    # Cache is written here, so load_specializations times the hit
+    specializations_path = get_benchmark_path('specializations.json', dir)
+    cached = load_specializations(specializations_path, vacancies_path)
+    area_index = load_area_index()
+    russian_areas = get_russian_areas(area_index)
+    university_names = load_university_names()
+    university_index = load_university_index(university_names)
+    school_universities = load_school_universities(
+        path=get_benchmark_path('schools.json', dir)
+    )
+    school_specializations = get_school_specializations(
+        resumes, university_names, specializations, school_universities
+    )
+    report_figures = get_report_figures(
+        get_report(resumes, specializations, russian_areas, university_names),
+        vacancy_columns,
+        resume_columns,
+        russian_areas,
+        school_universities
+    )
+    figures = get_benchmark_path('figures', dir)
+    figure = lambda name: get_figure_path(name, figures)
+    size = len(resumes)
+    vacancy_size = len(vacancies)
+    both_size = size + vacancy_size
+    return [
+        ('iterate_resumes', size,
+         lambda: count_items(iterate_resumes(raw))),
+        ('parse_resumes', size,
+         lambda: count_items(
+             chain.from_iterable(imap(parse_resumes, records))
+         )),
+        ('load_resumes', size, lambda: count_items(load_resumes(path))),
+        ('load_resumes_compact', size,
+         lambda: count_items(load_resumes(path, compact=True))),
+        ('read_vacancies', vacancy_size,
+         lambda: count_items(read_vacancies(vacancies_path))),
+
+        ('get_specializations', vacancy_size,
+         lambda: get_specializations(vacancies)),
+        ('load_specializations', len(cached),
+         lambda: load_specializations(specializations_path, vacancies_path)),
+        ('get_profarea_index', len(specializations),
+         lambda: get_profarea_index(specializations)),
+        ('get_russian_areas', len(area_index.order),
+         lambda: get_russian_areas(area_index)),
+
+        ('get_age_distribution', size,
+         lambda: get_age_distribution(resumes)),
+        ('get_age_distribution_batch', size,
+         lambda: get_age_distribution_batch(resume_columns)),
+        ('get_gender_distribution', size,
+         lambda: get_gender_distribution(resumes)),
+        ('get_gender_distribution_batch', size,
+         lambda: get_gender_distribution_batch(resume_columns)),
+        ('get_currency_distribution', size,
+         lambda: get_currency_distribution(resumes)),
+        ('get_currency_distribution_batch', size,
+         lambda: get_currency_distribution_batch(resume_columns)),
+        ('get_age_salary_correlation', size,
+         lambda: get_age_salary_correlation(resumes)),
+        ('get_age_salary_correlation_batch', size,
+         lambda: get_age_salary_correlation_batch(resume_columns)),
+        ('get_gender_salary_correlation', size,
+         lambda: get_gender_salary_correlation(resumes)),
+        ('get_gender_salary_correlation_batch', size,
+         lambda: get_gender_salary_correlation_batch(resume_columns)),
+        ('get_resume_specializations_batch', size,
+         lambda: get_resume_specializations_batch(
+             resume_columns, profarea_index
+         )),
+        ('get_gender_specializations_batch', size,
+         lambda: get_gender_specializations_batch(
+             resume_columns, profarea_index
+         )),
+        ('get_vacancy_specializations', vacancy_size,
+         lambda: get_vacancy_specializations(vacancies)),
+        ('get_vacancy_specializations_batch', vacancy_size,
+         lambda: get_vacancy_specializations_batch(vacancy_columns)),
+        ('get_vacancy_salary_bounds', vacancy_size,
+         lambda: get_vacancy_salary_bounds(vacancies)),
+        ('get_vacancy_salary_bounds_batch', vacancy_size,
+         lambda: get_vacancy_salary_bounds_batch(vacancy_columns)),
+        ('get_vacancy_salary_model_batch', vacancy_size,
+         lambda: get_vacancy_salary_model_batch(vacancy_columns)),
+        ('get_vacancy_salaries', vacancy_size,
+         lambda: get_vacancy_salaries(vacancies)),
+        ('get_vacancy_salaries_batch', vacancy_size,
+         lambda: get_vacancy_salaries_batch(vacancy_columns)),
+        ('get_geography_salary', size,
+         lambda: get_geography_salary(resumes, russian_areas)),
+        ('get_geography_salary_batch', size,
+         lambda: get_geography_salary_batch(resume_columns, russian_areas)),
+        ('get_university_salary_batch', size,
+         lambda: get_university_salary_batch(
+             resume_columns, university_index
+         )),
+        ('get_school_specializations', size,
+         lambda: get_school_specializations(
+             resumes, university_names, specializations, school_universities
+         )),
+        ('get_report', size,
+         lambda: get_report(
+             resumes, specializations, russian_areas, university_names
+         )),
+
+        ('show_age_distribution', size,
+         get_show_benchmark(
+             show_age_distribution,
+             figure('age_distribution'),
+             resumes
+         )),
+        ('show_gender_distribution', size,
+         get_show_benchmark(
+             show_gender_distribution,
+             figure('gender_distribution'),
+             resumes
+         )),
+        ('show_currency_distribution', size,
+         get_show_benchmark(
+             show_currency_distribution,
+             figure('currency_distribution'),
+             resumes
+         )),
+        ('show_age_salary_correlation', size,
+         get_show_benchmark(
+             show_age_salary_correlation,
+             figure('age_salary_correlation'),
+             resumes, seed=0
+         )),
+        ('show_gender_salary_correlation', size,
+         get_show_benchmark(
+             show_gender_salary_correlation,
+             figure('gender_salary_correlation'),
+             resumes, seed=0
+         )),
+        ('show_gender_specializations', size,
+         get_show_benchmark(
+             show_gender_specializations,
+             figure('gender_specializations'),
+             resumes, specializations
+         )),
+        ('show_vacancy_resume_specializations', both_size,
+         get_show_benchmark(
+             show_vacancy_resume_specializations,
+             figure('vacancy_resume_specializations'),
+             vacancies, resumes, specializations
+         )),
+        ('show_vacancy_salary_bounds_distribution', vacancy_size,
+         get_show_benchmark(
+             show_vacancy_salary_bounds_distribution,
+             figure('vacancy_salary_bounds_distribution'),
+             vacancies
+         )),
+        ('show_vacancy_salary_model', vacancy_size,
+         get_show_benchmark(
+             show_vacancy_salary_model,
+             figure('vacancy_salary_model'),
+             vacancies
+         )),
+        ('show_vacancy_resume_salaries', both_size,
+         get_show_benchmark(
+             show_vacancy_resume_salaries,
+             figure('vacancy_resume_salaries'),
+             vacancies, resumes, specializations
+         )),
+        ('show_geography_salary', size,
+         get_show_benchmark(
+             show_geography_salary,
+             figure('geography_salary'),
+             resumes, russian_areas, seed=0
+         )),
+        ('show_university_salary', size,
+         get_show_benchmark(
+             show_university_salary,
+             figure('university_salary'),
+             resumes, university_names
+         )),
+        ('show_geography_specializations', size,
+         get_show_benchmark(
+             show_geography_specializations,
+             figure('geography_specializations'),
+             resumes, russian_areas, specializations
+         )),
+        ('show_universities_specializations', size,
+         get_show_benchmark(
+             show_universities_specializations,
+             figure('universities_specializations'),
+             resumes, university_names, specializations
+         )),
+        ('show_school_specializations', len(school_specializations),
+         get_show_benchmark(
+             show_school_specializations,
+             figure('school_specializations'),
+             school_specializations
+         )),
+        ('render_figures', len(report_figures),
+         lambda: render_figures(report_figures, figures, force=True)),
+    ]
+
+
+def time_call(function, repeat=3):
+    # Best of several runs is the least noisy estimate
+    best = None
+    for _ in xrange(repeat):
+        start = time()
+        function()
+        duration = time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def run_benchmarks(dir=BENCHMARKS, repeat=3, pattern=None):
+    with open(get_benchmark_path('manifest.json', dir)) as file:
+        manifest = json.load(file)
+    results = {}
+    for name, records, function in get_benchmarks(dir):
+        if pattern and not re.search(pattern, name):
+            continue
+        seconds = time_call(function, repeat)
+        results[name] = {
+            'seconds': seconds,
+            'records': records,
+            'records_per_second': records / seconds if seconds else None
+        }
+        print >>sys.stderr, '{name}: {seconds:0.3f}s'.format(
+            name=name,
+            seconds=seconds
+        )
+    return {
+        'time': time(),
+        'data': manifest,
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def list_benchmark_results(dir=BENCHMARKS):
+    dir = get_benchmark_path('results', dir)
+    if not os.path.exists(dir):
+        return []
+    return sorted(
+        os.path.join(dir, _)
+        for _ in os.listdir(dir)
+        if _.endswith('.json')
+    )
+
+
+def dump_benchmark_result(result, dir=BENCHMARKS):
+    results = get_benchmark_path('results', dir)
+    if not os.path.exists(results):
+        os.makedirs(results)
+    name = strftime('%Y%m%d-%H%M%S', localtime(result['time'])) + '.json'
+    path = os.path.join(results, name)
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2, sort_keys=True)
+    return path
+
+
+def load_benchmark_result(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_benchmark_results(old, new, threshold=0.1):
+    # Ratio of new to old time of benchmarks in both runs, above
+    # 1 + threshold is a regression. Runs on other data don't compare
+    if old['data'] != new['data']:
+        raise ValueError('Benchmarks ran on different data')
+    comparison = []
+    for name in sorted(new['results']):
+        if name in old['results']:
+            before = old['results'][name]['seconds']
+            after = new['results'][name]['seconds']
+            ratio = after / before if before else None
+            regression = ratio is not None and ratio > 1 + threshold
+            comparison.append((name, before, after, ratio, regression))
+    return comparison
+
+
+def show_benchmark_comparison(comparison, stream=sys.stderr):
+    for name, before, after, ratio, regression in comparison:
+        line = '{mark} {name}: {before:0.3f}s -> {after:0.3f}s'.format(
+            mark='!' if regression else ' ',
+            name=name,
+            before=before,
+            after=after
+        )
+        if ratio is not None:
+            line += ' x{ratio:0.2f}'.format(ratio=ratio)
+        print >>stream, line
+
+
+def run_convert(args):
+    convert_resumes(args.source, args.target, args.processes)
+
+
+def run_columns(args):
+    resumes = chain.from_iterable(
+        load_resume_batches(processes=args.processes)
+    )
+    resumes = log_progress(resumes, total=TOTAL_RESUMES)
+    strings = load_string_table()
+    dump_resume_columns(resumes, args.target, strings)
+    dump_string_table(strings)
+
+
+def run_vacancy_columns(args):
+    vacancies = chain.from_iterable(
+        load_vacancy_batches(processes=args.processes)
+    )
+    vacancies = log_progress(vacancies, total=TOTAL_VACANCIES)
+    strings = load_string_table()
+    dump_vacancy_columns(vacancies, args.target, strings)
+    dump_string_table(strings)
+
+
+def run_partial(args):
+    accumulators, strings = load_report_accumulators()
+    resumes = load_resumes(args.resumes)
+    states = accumulate(accumulators, resumes)
+    dump_partial(accumulators, states, args.target, strings)
+
+
+def run_universities(args):
+    if not os.path.exists(UNIVERSITIES_DB) and os.path.isdir(UNIVERSITIES_DIR):
+        # First fetch starts from the old directory, so nothing cached
+        # there is downloaded again
+        migrate_university_cache()
+    universities = set()
+    for school_universities in load_school_universities().itervalues():
+        universities.update(school_universities)
+    failed = fetch_universities(
+        universities, args.url, args.threads,
+        args.rate, args.retries
+    )
+    print >>sys.stderr, 'Failed: {count}'.format(count=len(failed))
+
+
+def run_suggest_stub(args):
+    server = UniversitySuggestStub(
+        args.port,
+        args.fail_every,
+        args.malformed_every
+    )
+    print >>sys.stderr, server.get_url()
+    server.serve_forever()
+
+
+def run_migrate_universities(args):
+    count = migrate_university_cache(args.source, args.target)
+    print >>sys.stderr, 'Migrated: {count}'.format(count=count)
+
+
+def run_update(args):
+    created = update_partitions(args.raw, args.target, args.processes)
+    print >>sys.stderr, 'New partitions: {count}'.format(count=len(created))
+
+
+def run_render(args):
+    if args.report:
+        accumulators, strings = load_report_accumulators()
+        report = finalize_accumulated(
+            accumulators,
+            load_partial(accumulators, args.report, strings)
+        )
+    else:
+        report = load_partitions_report()
+    vacancy_columns = resume_columns = school_universities = None
+    if os.path.exists(args.vacancy_columns):
+        vacancy_columns = load_vacancy_columns(args.vacancy_columns)
+    if os.path.exists(args.resume_columns):
+        resume_columns = load_resume_columns(args.resume_columns)
+    if os.path.exists(SCHOOLS):
+        school_universities = load_school_universities()
+    figures = get_report_figures(
+        report,
+        vacancy_columns,
+        resume_columns,
+        get_russian_areas(load_area_index()),
+        school_universities
+    )
+    drawn = render_figures(figures, args.target, args.processes, args.force)
+    print >>sys.stderr, 'Rendered: {drawn}, unchanged: {unchanged}'.format(
+        drawn=len(drawn),
+        unchanged=len(figures) - len(drawn)
+    )
+
+
+def run_generate(args):
+    generate_benchmark_data(
+        args.target, args.resumes, args.vacancies,
+        args.seed, args.processes
+    )
+
+
+def run_benchmark(args):
+    previous = list_benchmark_results(args.source)
+    result = run_benchmarks(args.source, args.repeat, args.filter)
+    print >>sys.stderr, dump_benchmark_result(result, args.source)
+    baseline = args.compare
+    if baseline is None and previous:
+        baseline = previous[-1]
+    if baseline is not None:
+        comparison = compare_benchmark_results(
+            load_benchmark_result(baseline),
+            result
+        )
+        show_benchmark_comparison(comparison)
+
+
+def run_merge(args):
+    accumulators, strings = load_report_accumulators()
+    states = merge_partials(accumulators, args.partials, strings)
+    dump_partial(accumulators, states, args.target, strings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile-json',
+                        help='Write stage timings, rates and peak RSS here')
+    parser.add_argument('--profile-console', action='store_true',
+                        help='Print stage timings to stderr')
+    parser.add_argument('--profile-stage', action='append', default=[],
+                        help='Run the stage under cProfile, repeatable')
+    parser.add_argument('--profile-dir', default=PROFILES)
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser(
+        'convert',
+        help='Convert raw resumes.repr to resumes.json in parallel'
+    )
+    command.add_argument('--source', default=RAW_RESUMES)
+    command.add_argument('--target', default=RESUMES)
+    command.add_argument('--processes', type=int)
+    command.set_defaults(run=run_convert)
+
+    command = commands.add_parser(
+        'columns',
+        help='Convert resumes.json to columnar arrays'
+    )
+    command.add_argument('--target', default=RESUME_COLUMNS)
+    command.add_argument('--processes', type=int)
+    command.set_defaults(run=run_columns)
+
+    command = commands.add_parser(
+        'vacancy-columns',
+        help='Convert vacancies.json to columnar arrays'
+    )
+    command.add_argument('--target', default=VACANCY_COLUMNS)
+    command.add_argument('--processes', type=int)
+    command.set_defaults(run=run_vacancy_columns)
+
+    command = commands.add_parser(
+        'partial',
+        help='Compute report aggregates for a shard of resumes.json'
+    )
+    command.add_argument('resumes')
+    command.add_argument('target')
+    command.set_defaults(run=run_partial)
+
+    command = commands.add_parser(
+        'update',
+        help='Add new resumes of raw exports to partitions and the report'
+    )
+    command.add_argument('raw', nargs='+')
+    command.add_argument('--target', default=PARTITIONS)
+    command.add_argument('--processes', type=int)
+    command.set_defaults(run=run_update)
+
+    command = commands.add_parser(
+        'merge',
+        help='Merge report aggregates of several shards'
+    )
+    command.add_argument('partials', nargs='+')
+    command.add_argument('--target', required=True)
+    command.set_defaults(run=run_merge)
+
+    command = commands.add_parser(
+        'render',
+        help='Draw figures of the report, skip ones with unchanged tables'
+    )
+    command.add_argument('--report',
+                         help='Partial to draw, partitions report by default')
+    command.add_argument('--vacancy-columns', default=VACANCY_COLUMNS)
+    command.add_argument('--resume-columns', default=RESUME_COLUMNS)
+    command.add_argument('--target', default=FIGURES)
+    command.add_argument('--processes', type=int)
+    command.add_argument('--force', action='store_true')
+    command.set_defaults(run=run_render)
+
+    command = commands.add_parser(
+        'generate',
+        help='Write synthetic resumes and vacancies for benchmarks'
+    )
+    command.add_argument('--target', default=BENCHMARKS)
+    command.add_argument('--resumes', type=int, default=100000)
+    command.add_argument('--vacancies', type=int, default=10000)
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--processes', type=int)
+    command.set_defaults(run=run_generate)
+
+    command = commands.add_parser(
+        'benchmark',
+        help='Time parsers and analyses on synthetic data, compare runs'
+    )
+    command.add_argument('--source', default=BENCHMARKS)
+    command.add_argument('--repeat', type=int, default=3)
+    command.add_argument('--filter', help='Regex of benchmark names')
+    command.add_argument('--compare',
+                         help='Result to compare with, last run by default')
+    command.set_defaults(run=run_benchmark)
+
+    command = commands.add_parser(
+        'universities',
+        help='Download suggests for universities missing from the cache'
+    )
+    command.add_argument('--url', default=UNIVERSITY_SUGGEST_URL)
+    command.add_argument('--threads', type=int, default=4)
+    command.add_argument('--rate', type=float, default=5,
+                         help='Requests per second, 0 for no limit')
+    command.add_argument('--retries', type=int, default=3)
+    command.set_defaults(run=run_universities)
+
+    command = commands.add_parser(
+        'migrate-universities',
+        help='Copy the suggest cache directory into the SQLite cache'
+    )
+    command.add_argument('--source', default=UNIVERSITIES_DIR)
+    command.add_argument('--target', default=UNIVERSITIES_DB)
+    command.set_defaults(run=run_migrate_universities)
+
+    command = commands.add_parser(
+        'suggest-stub',
+        help='Serve a local stand-in for the suggest api'
+    )
+    command.add_argument('--port', type=int, default=8000)
+    command.add_argument('--fail-every', type=int)
+    command.add_argument('--malformed-every', type=int)
+    command.set_defaults(run=run_suggest_stub)
+
+    args = parser.parse_args()
+    sinks = []
+    if args.profile_json:
+        sinks.append(JsonProfileSink(args.profile_json))
+    if args.profile_console:
+        sinks.append(ConsoleProfileSink())
+    if sinks or args.profile_stage:
+        start_profiling(sinks, args.profile_stage, args.profile_dir)
+    try:
+        with measure_stage(args.run.__name__, 'aggregate'):
+            args.run(args)
+    finally:
+        stop_profiling()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1098 @@
+# encoding: utf8
+
+import os
+import multiprocessing
+import subprocess
+import sys
+from StringIO import StringIO
+from itertools import chain
+
+import numpy as np
+import pytest
+
+import main
+
+
+AREAS = [
+    main.Area(113, None, 0, u'Россия'),
+    main.Area(1, 113, 1, u'Москва'),
+    main.Area(2, 113, 1, u'Санкт-Петербург'),
+    main.Area(1620, 113, 1, u'Республика Марий Эл'),
+    main.Area(1621, 1620, 2, u'Йошкар-Ола'),
+    main.Area(5, None, 0, u'Украина'),
+    main.Area(115, 5, 1, u'Киев'),
+]
+UNIVERSITY_NAMES = {
+    u'Московский государственный университет им. М.В. Ломоносова, Москва':
+        u'МГУ',
+    u'МГУ им. Ломоносова': u'МГУ',
+    u'Московский авиационный институт, Москва': u'МАИ',
+    u'Национальный исследовательский университет '
+    u'«Высшая школа экономики», Москва': u'ГУ-ВШЭ',
+}
+
+
+@pytest.fixture(scope='module')
+def data(tmpdir_factory):
+    dir = tmpdir_factory.mktemp('data')
+    synthetic = main.SyntheticData(
+        main.AreaIndex(AREAS),
+        UNIVERSITY_NAMES,
+        seed=0
+    )
+    raw = str(dir.join('resumes.repr'))
+    main.generate_raw_resumes(synthetic, 3000, raw)
+    vacancies = str(dir.join('vacancies.json'))
+    main.generate_vacancies(synthetic, 1000, vacancies)
+    strings = main.StringTable()
+    resumes = list(main.read_resumes(raw))
+    main.dump_resume_columns(resumes, str(dir.join('resumes')), strings)
+    main.dump_vacancy_columns(
+        main.read_vacancies(vacancies),
+        str(dir.join('vacancies')),
+        strings
+    )
+    return {
+        'dir': dir,
+        'raw': raw,
+        'resumes': resumes,
+        'resume_columns': main.load_resume_columns(str(dir.join('resumes'))),
+        'vacancies_path': vacancies,
+        'vacancies': list(main.read_vacancies(vacancies)),
+        'vacancy_columns': main.load_vacancy_columns(
+            str(dir.join('vacancies'))
+        ),
+        'strings': strings,
+    }
+
+
+def get_specializations():
+    return {_.id: _ for _ in main.get_synthetic_specializations()}
+
+
+def assert_sketch_matches(sketch, values):
+    values = np.asarray(values).tolist()
+    assert sketch.count == len(values)
+    assert sketch.total == sum(values)
+    assert sketch.min == min(values)
+    assert sketch.max == max(values)
+
+
+def test_age_distribution_batch(data):
+    assert (main.get_age_distribution(data['resumes'])
+            == main.get_age_distribution_batch(data['resume_columns']))
+
+
+def test_gender_distribution_batch(data):
+    assert (main.get_gender_distribution(data['resumes'])
+            == main.get_gender_distribution_batch(data['resume_columns']))
+
+
+def test_currency_distribution_batch(data):
+    assert (main.get_currency_distribution(data['resumes'])
+            == main.get_currency_distribution_batch(data['resume_columns']))
+
+
+def test_age_salary_correlation_batch(data):
+    ages, salaries, sums, counts = main.get_age_salary_correlation(
+        data['resumes']
+    )
+    batch = main.get_age_salary_correlation_batch(data['resume_columns'])
+    assert ages == batch[0].tolist()
+    assert salaries == batch[1].tolist()
+    assert sums == batch[2]
+    assert counts == batch[3]
+
+
+def test_gender_salary_correlation_batch(data):
+    genders = main.get_gender_salary_correlation(data['resumes'])
+    batch = main.get_gender_salary_correlation_batch(data['resume_columns'])
+    assert sorted(genders) == sorted(batch)
+    for gender, sketch in genders.iteritems():
+        assert_sketch_matches(sketch, batch[gender])
+
+
+def test_resume_specializations_batch(data):
+    profarea_index = main.get_profarea_index(get_specializations())
+    accumulator = main.resume_specializations_accumulator(profarea_index)
+    assert (main.run_accumulator(accumulator, data['resumes'])
+            == main.get_resume_specializations_batch(
+                data['resume_columns'],
+                profarea_index
+            ))
+
+
+def test_gender_specializations_batch(data):
+    profarea_index = main.get_profarea_index(get_specializations())
+    accumulator = main.gender_specializations_accumulator(profarea_index)
+    assert (main.run_accumulator(accumulator, data['resumes'])
+            == main.get_gender_specializations_batch(
+                data['resume_columns'],
+                profarea_index
+            ))
+
+
+def test_geography_salary_batch(data):
+    russian_areas = main.get_russian_areas(AREAS)
+    areas = main.get_geography_salary(data['resumes'], russian_areas)
+    batch = main.get_geography_salary_batch(
+        data['resume_columns'],
+        russian_areas
+    )
+    assert sorted(areas) == sorted(batch)
+    for area, sketch in areas.iteritems():
+        assert_sketch_matches(sketch, batch[area])
+
+
+def test_university_salary_batch(data):
+    university_index = main.UniversityIndex(UNIVERSITY_NAMES)
+    accumulator = main.university_salary_accumulator(university_index)
+    universities = main.run_accumulator(accumulator, data['resumes'])
+    batch = main.get_university_salary_batch(
+        data['resume_columns'],
+        university_index
+    )
+    assert universities
+    assert sorted(universities) == sorted(batch)
+    for university, sketch in universities.iteritems():
+        assert_sketch_matches(sketch, batch[university])
+
+
+def assert_vacancy_batches(vacancies, columns):
+    assert (main.get_vacancy_specializations(vacancies)
+            == main.get_vacancy_specializations_batch(columns))
+    assert (main.get_vacancy_salaries(vacancies)
+            == main.get_vacancy_salaries_batch(columns))
+
+
+def test_vacancy_batches(data):
+    vacancies = data['vacancies']
+    columns = data['vacancy_columns']
+    assert_vacancy_batches(vacancies, columns)
+    assert (main.get_vacancy_salary_bounds(vacancies)
+            == main.get_vacancy_salary_bounds_batch(columns))
+    accumulator = main.vacancy_salary_model_accumulator()
+    mins, maxes, sums, counts = main.run_accumulator(accumulator, vacancies)
+    batch = main.get_vacancy_salary_model_batch(columns)
+    assert mins == batch[0].tolist()
+    assert maxes == batch[1].tolist()
+    assert sums == batch[2]
+    assert counts == batch[3]
+
+
+def test_vacancy_batches_shared_profarea_name(tmpdir):
+    # Two profarea ids with one name, vacancy counts once per name
+    sales = main.Profarea(17, u'Продажи')
+    retail = main.Profarea(40, u'Продажи')
+    it = main.Profarea(1, u'Информационные технологии, интернет, телеком')
+    salary = main.Salary(50000, 70000, 'RUR')
+    vacancies = [
+        main.Vacancy(1, salary, [
+            main.Specialization(sales, 1, u'Розница'),
+            main.Specialization(retail, 2, u'Опт'),
+        ]),
+        main.Vacancy(1, salary, [
+            main.Specialization(retail, 2, u'Опт'),
+            main.Specialization(it, 3, u'Программирование'),
+        ]),
+        main.Vacancy(2, None, [main.Specialization(it, 3, u'Разработка')]),
+    ]
+    main.dump_vacancy_columns(vacancies, str(tmpdir))
+    columns = main.load_vacancy_columns(str(tmpdir))
+    assert main.get_vacancy_specializations_batch(columns) == {
+        u'Продажи': 2,
+        u'Информационные технологии, интернет, телеком': 2,
+    }
+    assert_vacancy_batches(vacancies, columns)
+
+
+def get_report_accumulators(strings):
+    return main.get_report_accumulators(
+        get_specializations(),
+        main.get_russian_areas(AREAS),
+        UNIVERSITY_NAMES,
+        strings=strings
+    )
+
+
+def get_exact_report(report):
+    # Sketches compact in merge order, only their summaries are exact
+    if isinstance(report, main.QuantileSketch):
+        return report.count, report.total, report.min, report.max
+    elif isinstance(report, dict):
+        return {
+            key: get_exact_report(value)
+            for key, value in report.iteritems()
+        }
+    elif isinstance(report, (list, tuple)):
+        return [get_exact_report(_) for _ in report]
+    return report
+
+
+def assert_reports_equal(report, other):
+    assert get_exact_report(report) == get_exact_report(other)
+
+
+def test_merged_partials_report(data, tmpdir):
+    resumes = data['resumes']
+    strings = main.StringTable()
+    accumulators = get_report_accumulators(strings)
+    report = main.run_accumulators(accumulators, resumes)
+    paths = []
+    for index, shard in enumerate((resumes[:1000], resumes[1000:])):
+        path = str(tmpdir.join('part-{index}.msgpack'.format(index=index)))
+        states = main.accumulate(accumulators, shard)
+        main.dump_partial(accumulators, states, path, strings)
+        paths.append(path)
+    states = main.merge_partials(accumulators, paths, strings)
+    assert_reports_equal(
+        report,
+        main.finalize_accumulated(accumulators, states)
+    )
+
+
+def test_report_string_codes(data):
+    # Report does not depend on the order of codes in the string table
+    strings = main.StringTable({
+        'profarea': sorted(
+            {_.group.name for _ in main.get_synthetic_specializations()},
+            reverse=True
+        ),
+        'university': [u'ГУ-ВШЭ', u'МАИ', u'МГУ'],
+    })
+    assert_reports_equal(
+        main.run_accumulators(
+            get_report_accumulators(main.StringTable()),
+            data['resumes']
+        ),
+        main.run_accumulators(get_report_accumulators(strings), data['resumes'])
+    )
+
+
+def test_partial_string_table(data, tmpdir):
+    path = str(tmpdir.join('partial.msgpack'))
+    strings = main.StringTable()
+    accumulators = get_report_accumulators(strings)
+    states = main.accumulate(accumulators, data['resumes'][:100])
+    main.dump_partial(accumulators, states, path, strings)
+
+    # Appended strings keep old codes
+    grown = main.StringTable(strings.get_tables())
+    grown.encode('profarea', u'Новая')
+    main.load_partial(get_report_accumulators(grown), path, grown)
+
+    other = main.StringTable({'university': [u'МАИ']})
+    with pytest.raises(ValueError):
+        main.load_partial(get_report_accumulators(other), path, other)
+
+
+def test_show_distribution(data, tmpdir, capsys):
+    # Stats are printed and the figure is drawn on every call, it stays
+    # open for notebooks
+    path = str(tmpdir.join('age_distribution.png'))
+    for _ in range(2):
+        fig = main.show_age_distribution(data['resume_columns'], path=path)
+        assert 'Unbound' in capsys.readouterr().out
+        assert main.plt.fignum_exists(fig.number)
+        main.plt.close(fig)
+
+
+def test_parse_resumes(data):
+    # Common layout takes the one-match path, others go field by field
+    records = list(main.iterate_resumes(data['raw']))
+    fields = (
+        "'desireable_compensation': {0}, "
+        "'desireable_compensation_currency_code': {1}, 'age': {2}, "
+        "'gender': {3}, 'area_id': {4}, 'language': {5}, "
+        "'specialization': {6}, 'primary_education': {7}"
+    )
+    records.extend([
+        '{' + fields.format(
+            30000, "u'RUR'", 'nan', -1, "'1'", "[u'1: 2', '3: 4']", '[]',
+            "['\\xd0\\x9c\\xd0\\x93\\xd0\\xa3', 'a\\'b', u'\\u041c']"
+        ) + '}',
+        '{' + fields.format(
+            'nan', 'nan', 30.0, 0, "'2'", "['']", "['1', '2']",
+            '["\'O\'"]'
+        ) + '}',
+        "{'extra': {'nested': (1, 2)}, " + fields.format(
+            '1e5', "'USD'", 20.0, 1, 'None', "['']", "['']", "['']"
+        ) + '}, {' + fields.format(
+            'nan', 'nan', 21.0, 0, "'3'", "['']", "['']", "['']"
+        ) + '}',
+    ])
+    for record in records:
+        assert list(main.eval_resumes(record)) == list(
+            main.parse_resumes(record)
+        )
+
+
+@pytest.fixture
+def suggest_stub(request):
+    servers = []
+
+    def start(**options):
+        server = main.start_university_suggest_stub(**options)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download_university_suggest_backoff(suggest_stub):
+    server = suggest_stub(fail_every=1)
+    start = main.time()
+    with pytest.raises(main.requests.HTTPError):
+        main.download_university_suggest(
+            u'МГУ', url=server.get_url(),
+            retries=2, backoff=0.05
+        )
+    # Sleeps 0.05 and 0.1 between three attempts
+    assert main.time() - start >= 0.15
+    assert server.requests == 3
+
+
+def test_fetch_universities_retries(suggest_stub, tmpdir):
+    path = str(tmpdir.join('universities.db'))
+    names = [u'МГУ', u'МАИ', u'ГУ-ВШЭ', u'МФТИ']
+    server = suggest_stub(fail_every=3, malformed_every=4)
+    failed = main.fetch_universities(
+        names, server.get_url(), threads=2, rate=0,
+        retries=3, backoff=0.01, path=path
+    )
+    assert failed == []
+    assert server.requests > len(names)
+    universities = main.load_universities(path)
+    assert sorted(universities) == sorted(names)
+    for name, data in universities.iteritems():
+        assert data['items'][0]['text'] == name
+
+
+def test_fetch_universities_api_errors(suggest_stub, tmpdir):
+    # 4xx bodies are cached at once, they are answers for bad names
+    path = str(tmpdir.join('universities.db'))
+    server = suggest_stub()
+    failed = main.fetch_universities(
+        [u'М', u'МГУ'], server.get_url(), threads=1, rate=0,
+        retries=3, backoff=0.01, path=path
+    )
+    assert failed == []
+    assert server.requests == 2
+    universities = main.load_universities(path)
+    assert universities[u'М'] == {
+        'errors': [{'type': 'bad_argument', 'value': 'text'}]
+    }
+    assert universities[u'МГУ']['items'][0]['text'] == u'МГУ'
+
+
+def test_fetch_universities_failed(suggest_stub, tmpdir):
+    path = str(tmpdir.join('universities.db'))
+    server = suggest_stub(malformed_every=1)
+    failed = main.fetch_universities(
+        [u'МГУ'], server.get_url(), threads=1,
+        retries=1, backoff=0.01, path=path
+    )
+    assert failed == [u'МГУ']
+    assert server.requests == 2
+    assert main.load_universities(path) == {}
+
+
+def test_profiler_rss(data):
+    stream = StringIO()
+    main.start_profiling([main.ConsoleProfileSink(stream)])
+    try:
+        resumes = list(main.read_resumes(data['raw']))
+    finally:
+        report = main.stop_profiling()
+    assert resumes == data['resumes']
+    stats = report['stages']['parse_resumes']
+    assert stats['records'] == len(resumes)
+    assert stats['rss'] > 0 and stats['process_peak_rss'] > 0
+    assert 'Process peak RSS' in stream.getvalue()
+
+
+def test_resume_profareas_unknown():
+    profareas = [None, 0, 0, 1]
+    resume = main.Resume(30, 0, None, None, 1, {}, [1, 3], [])
+    assert main.get_resume_profareas(resume, profareas) == {0, 1}
+    for specializations in ([0], [4], [-1], [1, -3]):
+        with pytest.raises(KeyError):
+            main.get_resume_profareas(
+                resume._replace(specializations=specializations),
+                profareas
+            )
+
+
+def get_table_hashes():
+    # Hashes of plots with nested code objects, computed in a new process
+    return subprocess.check_output([
+        sys.executable, '-c',
+        'import main; '
+        'print main.get_table_hash("geography_salary", ({u"A": [1, 2]},)); '
+        'print main.get_table_hash("school_specializations", ({},))'
+    ], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_table_hash_processes():
+    assert get_table_hashes() == get_table_hashes()
+
+
+def test_profiler_pool_workers(data, tmpdir):
+    # Stages run in pool workers are reported by the parent
+    target = str(tmpdir.join('resumes.json'))
+    main.start_profiling(stages=['parse_resumes'], dir=str(tmpdir))
+    try:
+        _, count = main.convert_resumes(data['raw'], target, processes=2)
+        resumes = list(chain.from_iterable(
+            main.load_resume_batches(target, processes=2, size=4096)
+        ))
+    finally:
+        report = main.stop_profiling()
+    assert count == len(resumes) == len(data['resumes'])
+    stages = report['stages']
+    for stage in ('iterate_resumes', 'parse_resumes', 'load_resumes'):
+        assert stages[stage]['records'] == count
+    assert stages['iterate_resumes']['bytes'] > 0
+    assert os.path.exists(report['profiles']['parse_resumes'])
+
+
+def get_dictionaries(university_names=UNIVERSITY_NAMES):
+    return (
+        get_specializations(),
+        main.get_russian_areas(AREAS),
+        university_names,
+        None
+    )
+
+
+def generate_raw(dir, name, count, seed):
+    path = str(dir.join(name))
+    synthetic = main.SyntheticData(
+        main.AreaIndex(AREAS),
+        UNIVERSITY_NAMES,
+        seed=seed
+    )
+    main.generate_raw_resumes(synthetic, count, path)
+    with open(path, 'rb') as file:
+        return path, file.read()
+
+
+class Partitions(object):
+    def __init__(self, dir):
+        self.dir = str(dir.join('partitions'))
+        self.strings = str(dir.join('strings.json'))
+
+    def update(self, paths, dictionaries):
+        return main.update_partitions(
+            paths, self.dir, processes=1,
+            dictionaries=dictionaries, strings_path=self.strings
+        )
+
+    def assert_report(self, dictionaries, count):
+        # Incremental report equals a full pass over partition resumes
+        resumes = list(main.load_partition_resumes(self.dir))
+        assert len(resumes) == count
+        accumulators, _ = main.load_report_accumulators(
+            dictionaries,
+            self.strings
+        )
+        assert_reports_equal(
+            main.load_partitions_report(
+                self.dir, dictionaries, self.strings
+            ),
+            main.run_accumulators(accumulators, resumes)
+        )
+
+
+def test_partitions_append(tmpdir):
+    path, first = generate_raw(tmpdir, 'resumes.repr', 300, seed=1)
+    _, second = generate_raw(tmpdir, 'tail.repr', 200, seed=2)
+    partitions = Partitions(tmpdir)
+    dictionaries = get_dictionaries()
+    assert len(partitions.update([path], dictionaries)) == 1
+    partitions.assert_report(dictionaries, 300)
+    assert partitions.update([path], dictionaries) == []
+    with open(path, 'ab') as file:
+        file.write(second)
+    assert len(partitions.update([path], dictionaries)) == 1
+    partitions.assert_report(dictionaries, 500)
+
+
+def test_partitions_rewrite(tmpdir):
+    path, first = generate_raw(tmpdir, 'resumes.repr', 300, seed=1)
+    other, second = generate_raw(tmpdir, 'other.repr', 200, seed=2)
+    partitions = Partitions(tmpdir)
+    dictionaries = get_dictionaries()
+    partitions.update([path, other], dictionaries)
+    # Processed part of the file changed, its partitions are redone
+    with open(path, 'wb') as file:
+        file.write(second)
+    assert len(partitions.update([path, other], dictionaries)) == 1
+    partitions.assert_report(dictionaries, 400)
+
+
+def test_partitions_dictionaries(tmpdir):
+    path, _ = generate_raw(tmpdir, 'resumes.repr', 300, seed=1)
+    partitions = Partitions(tmpdir)
+    dictionaries = get_dictionaries()
+    partitions.update([path], dictionaries)
+    report = main.load_partitions_report(
+        partitions.dir, dictionaries, partitions.strings
+    )
+    # Names move to another label, old partials count them elsewhere
+    university_names = dict(UNIVERSITY_NAMES)
+    for name, label in university_names.items():
+        if label == u'МГУ':
+            university_names[name] = u'МАИ'
+    dictionaries = get_dictionaries(university_names)
+    assert partitions.update([path], dictionaries) == []
+    partitions.assert_report(dictionaries, 300)
+    assert (get_exact_report(report['university_salary'])
+            != get_exact_report(main.load_partitions_report(
+                partitions.dir, dictionaries, partitions.strings
+            )['university_salary']))
+
+
+def write_resumes(resumes, path):
+    with open(path, 'w') as file:
+        for resume in resumes:
+            file.write(main.dump_resume(resume).encode('utf8') + '\n')
+
+
+def test_resume_rows_load_resumes(data, tmpdir):
+    # Row view is a drop-in replacement for load_resumes
+    path = str(tmpdir.join('resumes.json'))
+    write_resumes(data['resumes'], path)
+    resumes = list(main.load_resumes(path))
+    main.dump_resume_columns(resumes, str(tmpdir.join('columns')))
+    rows = main.ResumeRows(
+        main.load_resume_columns(str(tmpdir.join('columns')))
+    )
+    assert list(rows) == resumes
+    assert rows[-1] == resumes[-1]
+
+
+def test_compact_resumes(data, tmpdir):
+    path = str(tmpdir.join('resumes.json'))
+    write_resumes(data['resumes'], path)
+    resumes = list(main.load_resumes(path))
+    assert list(main.load_resumes(path, compact=True)) == resumes
+    values = main.ResumeValues(limit=10)
+    compact = [values.compact(_) for _ in resumes]
+    assert compact == resumes
+    assert len(values.lists) <= 10
+    with pytest.raises(TypeError):
+        compact[0].specializations.append(1)
+
+
+def get_rank_error(sketch, values, fractions):
+    # Largest distance between the rank of a sketch quantile and the
+    # asked one, as a fraction of count. values are ranks themselves
+    quantiles = sketch.get_quantiles(fractions)
+    return max(
+        abs(quantile - fraction * len(values)) / len(values)
+        for quantile, fraction in zip(quantiles, fractions)
+    )
+
+
+def test_quantile_sketch_error(monkeypatch):
+    monkeypatch.setattr(main, 'random', main.Random(0).random)
+    values = np.random.RandomState(0).permutation(100000).tolist()
+    fractions = [_ / 100.0 for _ in xrange(1, 100)]
+    sketch = main.QuantileSketch()
+    for value in values:
+        sketch.update(value)
+    assert sketch.retained < 3 * main.QUANTILE_SKETCH_SIZE + 100
+    assert get_rank_error(sketch, values, fractions) < 0.02
+
+    shards = []
+    for index in xrange(10):
+        shard = main.QuantileSketch()
+        for value in values[index::10]:
+            shard.update(value)
+        shards.append(shard)
+    merged = reduce(main.QuantileSketch.merge, shards)
+    assert_sketch_matches(merged, values)
+    assert get_rank_error(merged, values, fractions) < 0.02
+
+
+def test_sample_stream_distribution():
+    # Every item gets into the sample with probability size / count
+    counts = np.zeros(100)
+    runs = 2000
+    for seed in xrange(runs):
+        sample = main.sample_stream(xrange(100), 10, seed=seed)
+        assert len(set(sample)) == 10
+        counts[sample] += 1
+    expected = runs * 10 / 100.0
+    assert np.abs(counts - expected).max() < 5 * np.sqrt(expected)
+    assert main.sample_stream(xrange(5), 10) == range(5)
+
+
+def get_random_areas(count, depth, seed):
+    # Random forest of areas with Russia as one of the roots
+    generator = main.Random(seed)
+    areas = [main.Area(113, None, 0, u'Россия'), main.Area(5, None, 0, u'')]
+    for id in xrange(200, 200 + count):
+        parent = generator.choice(areas)
+        if parent.level < depth:
+            areas.append(main.Area(id, parent.id, parent.level + 1, u''))
+    return areas
+
+
+def get_walk_russian_areas(areas):
+    # Tree walk the area index replaced
+    id_areas = {_.id: _ for _ in areas}
+    russian_areas = {}
+    for area in areas:
+        id = area.id
+        if area.level == 2:
+            parent = id_areas[area.parent_id]
+            if parent.parent_id == 113:
+                russian_areas[id] = parent
+        elif area.level == 1 and area.parent_id == 113:
+            russian_areas[id] = area
+    return russian_areas
+
+
+def get_walk_ancestors(areas, id):
+    parents = {_.id: _.parent_id for _ in areas}
+    ancestors = [id]
+    while parents[ancestors[-1]] is not None:
+        ancestors.append(parents[ancestors[-1]])
+    return ancestors[::-1]
+
+
+def test_area_index_tree_walk():
+    for seed in xrange(5):
+        areas = get_random_areas(300, 2, seed)
+        assert main.get_russian_areas(areas) == get_walk_russian_areas(areas)
+    assert main.get_russian_areas(AREAS) == get_walk_russian_areas(AREAS)
+
+    areas = get_random_areas(500, 5, 0)
+    index = main.AreaIndex(areas)
+    walks = {_.id: get_walk_ancestors(areas, _.id) for _ in areas}
+    ids = np.array(sorted(walks) + [0, 10 ** 6])
+    for ancestor in areas:
+        inside = index.is_inside(ids, ancestor.id).tolist()
+        descendants = set(index.get_descendants(ancestor.id).tolist())
+        for id, flag in zip(ids.tolist(), inside):
+            walk = id in walks and ancestor.id in walks[id]
+            assert flag == walk
+            assert (id in descendants) == (walk and id != ancestor.id)
+    for area in areas:
+        walk = walks[area.id]
+        assert index.get_depths(area.id) == len(walk) - 1
+        for depth in xrange(6):
+            expected = walk[depth] if depth < len(walk) else -1
+            assert index.get_ancestors(area.id, depth) == expected
+    assert index.get_depths(10 ** 6) == -1
+
+
+def test_university_index_matches(data):
+    names = dict(UNIVERSITY_NAMES)
+    names[u'Институт экономики, Казань'] = u'ИЭ Казань'
+    names[u'Институт экономики, Самара'] = u'ИЭ Самара'
+    suggests = {
+        u'МАИ': {'items': [{
+            'text': u'Московский авиационный институт, Москва',
+            'acronym': u'МАИ'
+        }]},
+        u'bad': {'errors': [{'type': 'bad_argument'}]},
+    }
+    index = main.UniversityIndex(names, suggests)
+
+    def get_label(education):
+        id = index.get_id(education)
+        return index.labels[id] if id != -1 else None
+
+    # Exact names give what the old exact-key lookup gave
+    for name, label in names.iteritems():
+        assert get_label(name) == label
+    assert get_label(u'московский авиационный институт') == u'МАИ'
+    assert get_label(u'Московский Авиационный Институт,  Москва.') == u'МАИ'
+    assert get_label(u'мгу им ломоносова') == u'МГУ'
+    assert get_label(u'МАИ') == u'МАИ'
+    assert get_label(u'Национальный исследовательский университет '
+                     u'"Высшая школа экономики"') == u'ГУ-ВШЭ'
+    # Without city the name points to both institutes
+    assert get_label(u'Институт экономики') is None
+    assert get_label(u'Институт экономики, Самара') == u'ИЭ Самара'
+    assert get_label(u'') is None
+    assert get_label(u'Тверской университет') is None
+
+    columns = data['resume_columns']
+    index = main.UniversityIndex(UNIVERSITY_NAMES, strings=main.StringTable())
+    ids = index.get_education_ids(columns)
+    expected = [
+        index.get_id(education)
+        for resume in data['resumes']
+        for education in resume.educations
+    ]
+    assert ids.tolist() == expected
+    assert (ids != -1).any()
+
+
+def get_dense_table(table, rows, columns):
+    matrix = np.zeros((len(rows), len(columns)))
+    for row, key in enumerate(rows):
+        for column, other in enumerate(columns):
+            matrix[row, column] = table[key].get(other, 0)
+    return matrix
+
+
+def test_school_specializations_dense():
+    generator = np.random.RandomState(0)
+    groups = [u'group%d' % _ for _ in xrange(15)]
+    universities = sorted(u'university%d' % _ for _ in xrange(40))
+    university_specializations = {
+        university: {
+            group: int(generator.randint(1, 100))
+            for group in generator.choice(groups, 5, replace=False)
+        }
+        for university in universities
+    }
+    school_universities = {
+        u'school%d' % index: {
+            university: float(generator.rand())
+            for university in generator.choice(
+                universities + [u'unknown'], 4, replace=False
+            )
+        }
+        for index in xrange(30)
+    }
+    school_universities[u'empty'] = {u'unknown': 1.0}
+
+    matrix = main.get_sparse_table(
+        university_specializations,
+        universities,
+        groups
+    )
+    dense = get_dense_table(university_specializations, universities, groups)
+    assert np.array_equal(matrix.toarray(), dense)
+
+    dense = dense / dense.sum(axis=1)[:, None]
+    schools = sorted(school_universities)
+    weights = get_dense_table(
+        school_universities,
+        schools,
+        universities
+    ).dot(dense)
+    school_specializations = main.combine_school_specializations(
+        university_specializations,
+        school_universities
+    )
+    assert school_specializations[u'empty'] == {}
+    for school, row in zip(schools, weights):
+        distribution = school_specializations[school]
+        expected = row / row.sum() if row.sum() else row
+        actual = [distribution.get(_, 0) for _ in groups]
+        assert np.allclose(actual, expected)
+
+
+def read_chunked_resumes(path, chunksize):
+    # Chunked scan the memory map replaced, also yields the last resume
+    buffer = ''
+    for chunk in main.read_chunks(path, chunksize):
+        buffer += chunk
+        parts = buffer.split(main.RESUME_DELIMITER)
+        parts[1:] = [main.RESUME_START + _ for _ in parts[1:]]
+        for part in parts[:-1]:
+            yield part[part.index(main.RESUME_START):] + '}'
+        buffer = parts[-1]
+    buffer = buffer[buffer.index(main.RESUME_START):]
+    yield buffer[:buffer.rindex('}') + 1]
+
+
+def test_resume_spans(data):
+    resumes = list(read_chunked_resumes(data['raw'], 1000))
+    assert len(resumes) == len(data['resumes'])
+    assert list(main.slice_resumes(data['raw'])) == resumes
+
+    raw = main.open_raw_resumes(data['raw'])
+    try:
+        ranges = main.split_resume_ranges(raw, 10000)
+        assert len(ranges) > 10
+        assert ranges[0][1] == ranges[1][0]
+        spans = [
+            raw[offset:offset + length]
+            for start, stop in ranges
+            for offset, length in main.iterate_resume_spans(raw, start, stop)
+        ]
+    finally:
+        raw.close()
+    assert spans == resumes
+
+
+def test_convert_resumes_serial(data, tmpdir):
+    # Pool conversion writes what a serial dump of read_resumes writes
+    serial = ''.join(
+        main.dump_resume(_).encode('utf8') + '\n'
+        for _ in main.read_resumes(data['raw'])
+    )
+    target = str(tmpdir.join('resumes.json'))
+    stop, count = main.convert_resumes(
+        data['raw'],
+        target,
+        processes=3,
+        size=10000
+    )
+    assert count == len(data['resumes'])
+    assert stop == os.path.getsize(data['raw']) - 2
+    assert open(target).read() == serial
+
+    raw = main.open_raw_resumes(data['raw'])
+    try:
+        offset, _ = list(main.iterate_resume_spans(raw))[1000]
+    finally:
+        raw.close()
+    _, count = main.convert_resumes(data['raw'], target, processes=3,
+                                    size=10000, start=offset)
+    assert count == len(data['resumes']) - 1000
+    assert open(target).read() == ''.join(serial.splitlines(True)[1000:])
+
+
+def test_json_batches(data, tmpdir):
+    path = str(tmpdir.join('resumes.json'))
+    write_resumes(data['resumes'], path)
+    resumes = list(main.load_resumes(path))
+    batches = list(main.load_resume_batches(path, processes=3, size=4096))
+    assert len(batches) > 10
+    assert list(chain.from_iterable(batches)) == resumes
+    batches = main.load_resume_batches(path, processes=3, ordered=False,
+                                       prefetch=2, size=4096)
+    assert (sorted(chain.from_iterable(batches))
+            == sorted(resumes))
+
+    vacancies = main.load_vacancy_batches(data['vacancies_path'],
+                                          processes=2, size=4096)
+    assert list(chain.from_iterable(vacancies)) == data['vacancies']
+
+    # Closing the generator early stops the pool
+    batches = main.load_resume_batches(path, processes=2, size=4096)
+    next(batches)
+    batches.close()
+    assert not multiprocessing.active_children()
+
+
+def test_university_cache_migration(tmpdir):
+    dir = str(tmpdir.mkdir('universities'))
+    items = {
+        u'МГУ': {'items': [
+            {'text': u'МГУ им. Ломоносова', 'acronym': u'МГУ'}
+        ]},
+        u'Университет / №1': {'items': []},
+        u'bad': {'errors': [{'type': 'bad_argument'}]},
+    }
+    for university, data in items.iteritems():
+        path = main.get_university_path(university, dir)
+        with open(path, 'w') as file:
+            main.json.dump(data, file)
+    path = str(tmpdir.join('universities.db'))
+    try:
+        assert main.migrate_university_cache(dir, path) == len(items)
+        assert main.load_universities(path) == items
+        assert dict(main.read_university_directory(dir)) == items
+        assert sorted(main.list_university_cache(path)) == sorted(items)
+        assert main.load_university(u'МГУ', path) == items[u'МГУ']
+        with pytest.raises(KeyError):
+            main.load_university(u'МАИ', path)
+        main.dump_university({'items': []}, u'МАИ', path)
+        assert main.load_university(u'МАИ', path) == {'items': []}
+    finally:
+        main.close_university_cache(path)
+
+
+def get_iterrows_labels(table):
+    # Row loop the vectorized parse replaced
+    names = {}
+    collisions = set()
+    for _, row in table.iterrows():
+        label, correct, name = row
+        if correct == '+':
+            if name in names and label != names[name]:
+                collisions.add(name)
+            else:
+                names[name] = label
+    return names, collisions
+
+
+def get_label_table(seed):
+    generator = np.random.RandomState(seed)
+    rows = [
+        (
+            u'label%d' % generator.randint(10),
+            generator.choice([u'+', u'-', None]),
+            u'name%d' % generator.randint(50)
+        )
+        for _ in xrange(300)
+    ]
+    return main.pd.DataFrame(rows, columns=[u'Метка', u'Верно', u'Название'])
+
+
+def test_university_labels_iterrows():
+    for seed in xrange(5):
+        table = get_label_table(seed)
+        labels = main.parse_university_labels(table)
+        names, collisions = get_iterrows_labels(table)
+        assert labels['names'] == names
+        assert {_['name'] for _ in labels['collisions']} == collisions
+        for collision in labels['collisions']:
+            assert collision['kept'] == names[collision['name']]
+            assert len(set(collision['labels'])) == len(collision['labels'])
+            assert collision['kept'] in collision['labels']
+
+
+def test_university_labels_cache(tmpdir, monkeypatch):
+    # Excel is read again only when the file changes
+    source = tmpdir.join('universities.xlsx')
+    source.write('table')
+    reads = []
+
+    def read_excel(path):
+        reads.append(path)
+        return get_label_table(len(reads))
+
+    monkeypatch.setattr(main.pd, 'read_excel', read_excel)
+    path = str(tmpdir.join('university_names.json'))
+    labels = main.load_university_labels(path, str(source))
+    assert main.load_university_labels(path, str(source)) == labels
+    assert len(reads) == 1
+    source.write('other table')
+    assert main.load_university_labels(path, str(source)) != labels
+    assert len(reads) == 2
+
+
+def test_specializations_cache(data, tmpdir, monkeypatch):
+    vacancies = tmpdir.join('vacancies.json')
+    vacancies.write(open(data['vacancies_path']).read())
+    vacancies = str(vacancies)
+    path = str(tmpdir.join('specializations.json'))
+    specializations = main.get_specializations(data['vacancies'])
+    assert main.load_specializations(path, vacancies) == specializations
+
+    scans = []
+    read_vacancies = main.read_vacancies
+
+    def count_scans(path):
+        scans.append(path)
+        return read_vacancies(path)
+
+    monkeypatch.setattr(main, 'read_vacancies', count_scans)
+    assert main.load_specializations(path, vacancies) == specializations
+    # Touched but same content, sha1 keeps the cache
+    os.utime(vacancies, (0, 0))
+    assert main.load_specializations(path, vacancies) == specializations
+    assert not scans
+    with open(vacancies, 'a') as file:
+        file.write(main.json.dumps({
+            'alternate_url': 'https://hh.ru/vacancy/0',
+            'area': {'id': '1'},
+            'salary': None,
+            'specializations': [{
+                'id': '1.1000',
+                'name': u'Новая',
+                'profarea_id': '1',
+                'profarea_name': u'Информационные технологии'
+            }]
+        }) + '\n')
+    assert 1000 in main.load_specializations(path, vacancies)
+    assert len(scans) == 1
+
+
+def test_report_one_pass(data):
+    # One pass over resumes gives what separate per-figure loops gave
+    resumes = data['resumes']
+    accumulators = get_report_accumulators(main.StringTable())
+    report = main.run_accumulators(accumulators, resumes)
+    for name, accumulator in accumulators.iteritems():
+        assert_reports_equal(
+            report[name],
+            main.run_accumulator(accumulator, resumes)
+        )
+
+    specializations = get_specializations()
+    russian_areas = main.get_russian_areas(AREAS)
+    genders = main.defaultdict(main.Counter)
+    geography = main.defaultdict(main.Counter)
+    for resume in resumes:
+        groups = {specializations[_].group.name for _ in resume.specializations}
+        if resume.gender is not None:
+            for group in groups:
+                genders[resume.gender][group] += 1
+        area = russian_areas.get(resume.area_id)
+        if area:
+            for group in groups:
+                geography[area.name][main.shorten_string(group)] += 1
+    assert report['gender_specializations'] == genders
+    assert main.shorten_counters(
+        report['geography_specializations']
+    ) == geography
+
+
+def test_synthetic_data_seed(tmpdir):
+    def generate(name, seed):
+        synthetic = main.SyntheticData(
+            main.AreaIndex(AREAS),
+            UNIVERSITY_NAMES,
+            seed=seed
+        )
+        raw = str(tmpdir.join(name + '.repr'))
+        main.generate_raw_resumes(synthetic, 500, raw)
+        vacancies = str(tmpdir.join(name + '.json'))
+        main.generate_vacancies(synthetic, 100, vacancies)
+        return open(raw, 'rb').read(), open(vacancies, 'rb').read()
+
+    files = generate('first', 1)
+    assert generate('second', 1) == files
+    assert generate('other', 2) != files
+    assert len(list(main.read_resumes(str(tmpdir.join('first.repr'))))) == 500
+
+
+def test_compare_benchmark_results():
+    def get_result(seconds, data=None):
+        return {
+            'data': data or {'resumes': 10, 'vacancies': 1, 'seed': 0},
+            'results': {
+                name: {'seconds': value}
+                for name, value in seconds.iteritems()
+            }
+        }
+
+    old = get_result({'a': 1.0, 'b': 1.0, 'c': 0.0})
+    new = get_result({'a': 1.05, 'b': 1.5, 'c': 0.1, 'd': 1.0})
+    assert main.compare_benchmark_results(old, new) == [
+        ('a', 1.0, 1.05, 1.05, False),
+        ('b', 1.0, 1.5, 1.5, True),
+        ('c', 0.0, 0.1, None, False),
+    ]
+    with pytest.raises(ValueError):
+        main.compare_benchmark_results(old, get_result({}, {'seed': 1}))
+
+
+def test_university_suggests_read_only(tmpdir):
+    # Analysis reads the old directory or the cache and writes neither
+    dir = str(tmpdir.mkdir('universities'))
+    data = {'items': [{'text': u'МГУ им. Ломоносова', 'acronym': u'МГУ'}]}
+    with open(main.get_university_path(u'МГУ', dir), 'w') as file:
+        main.json.dump(data, file)
+    path = str(tmpdir.join('universities.db'))
+    assert main.load_university_suggests(path, dir) == {u'МГУ': data}
+    assert not os.path.exists(path)
+    assert main.load_university_suggests(
+        path,
+        str(tmpdir.join('missing'))
+    ) is None
+
+    try:
+        main.dump_university({'items': []}, u'МАИ', path)
+    finally:
+        main.close_university_cache(path)
+    size = os.path.getsize(path)
+    assert main.load_university_suggests(path, dir) == {
+        u'МАИ': {'items': []}
+    }
+    assert os.path.getsize(path) == size